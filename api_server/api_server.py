@@ -1,36 +1,54 @@
+import asyncio
 import io
 import json
 import os
-import subprocess
-import tempfile
 import urllib.parse
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from functools import partial
 from typing import List
 from typing import Literal
 from typing import Optional
 
-import boto3
-import librosa
-import numpy as np
-import soundfile as sf
+import clients
+import multipart_upload
+import music_db
+import stream_mixer
+import upload_sessions
+import youtube_ingest
 from dotenv import load_dotenv
+from fastapi import BackgroundTasks
 from fastapi import FastAPI
-from fastapi import File
-from fastapi import Form
-from fastapi import UploadFile
+from fastapi import HTTPException
+from fastapi import Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import HTMLResponse
 from pydantic import BaseModel
+from pydantic import ValidationError
 from pydantic_settings import BaseSettings
-from pymongo import MongoClient
+from pymongo import ReturnDocument
 from pymongo.errors import PyMongoError
-from pytube import Search
-from pytube import YouTube
-from smart_open import open
 
 load_dotenv()
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # indexes of the collections queried below, see music_db.py
+    try:
+        await run_io(music_db.ensure_indexes, settings)
+    except PyMongoError as e:
+        print(f"MongoDB error: {e}")
+    sweeper = asyncio.create_task(sweep_upload_sessions())
+    yield
+    sweeper.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -41,15 +59,48 @@ app.add_middleware(
 )
 
 
+# separation presets of the inference server, see inference_server/presets.json
+SeparationPreset = Literal["preview", "balanced", "max"]
+
+
 class APIServerSettings(BaseSettings):
     bucket_name: str = "s3musicproject"
     aws_access_key: str
     aws_secret_access_key: str
     region_name: str
     mongodb_uri: str
+    # connection pools shared by all requests of a process, see clients.py
+    aws_max_pool_connections: int = 50
+    mongo_max_pool_size: int = 100
+    mongo_min_pool_size: int = 0
+    mongo_max_idle_time_ms: int = 300000
+    # threads running the blocking S3, SQS and Mongo calls of all requests
+    io_workers: int = 32
+    # S3 compatible endpoint (e.g. a local stand-in), AWS when None
+    s3_endpoint_url: Optional[str] = None
+    # presigned upload sessions
+    upload_session_expires: int = 3600
+    # seconds between the sweeps aborting the uploads of expired sessions,
+    # and how long after expiring a session being completed is left alone
+    upload_session_sweep_every: int = 600
+    upload_session_grace: int = 900
+    presigned_multipart_bytes: int = 100 * 1024 * 1024
+    max_upload_bytes: int = 2 * 1024 * 1024 * 1024
+    # output of /combine_inferencedAudio
+    combine_sample_rate: int = 48000
+    combine_limiter_threshold: float = 0.9
+    # /download_youtube: threads downloading videos, lifetime of cached
+    # searches and age after which an unfinished download is started again
+    youtube_workers: int = 4
+    youtube_search_ttl: int = 24 * 3600
+    youtube_claim_timeout: int = 900
 
 
 settings = APIServerSettings()
+io_executor = ThreadPoolExecutor(max_workers=settings.io_workers)
+youtube_executor = ThreadPoolExecutor(max_workers=settings.youtube_workers)
+# video id -> task downloading it, shared by the requests of this process
+youtube_tasks = {}
 
 
 class DownloadRequest(BaseModel):
@@ -63,6 +114,72 @@ class SeparateResponse(BaseModel):
     message_id: str
     user_id: str
     vc: bool
+    preset: Optional[SeparationPreset] = None
+
+
+class SeparateForm(BaseModel):
+    artist: str
+    user_id: str
+    preset: Optional[SeparationPreset] = None
+
+
+class UserArtistForm(BaseModel):
+    user_id: str
+    artist: str
+
+
+class UploadFileRequest(BaseModel):
+    filename: str
+    size: int
+
+
+class UploadSessionRequest(BaseModel):
+    user_id: str
+    artist: str
+    kind: Literal["separate", "vc_training", "vc_inference"]
+    files: List[UploadFileRequest]
+    # only for kind "separate", like the query parameter and form field of /separate
+    vc: bool = False
+    preset: Optional[SeparationPreset] = None
+
+
+class UploadTarget(BaseModel):
+    filename: str
+    size: int
+    key: str
+    # presigned POST {"url", "fields"} of a small file
+    post: Optional[dict] = None
+    # multipart upload of a large file: PUT part n (part_size bytes) to part_urls[n - 1]
+    upload_id: Optional[str] = None
+    part_size: Optional[int] = None
+    part_urls: Optional[List[str]] = None
+
+
+class UploadSessionResponse(BaseModel):
+    session_id: str
+    expires_in: int
+    files: List[UploadTarget]
+
+
+class CompletedPart(BaseModel):
+    PartNumber: int
+    ETag: str
+
+
+class CompletedFile(BaseModel):
+    key: str
+    parts: List[CompletedPart] = []
+
+
+class CompleteUploadRequest(BaseModel):
+    # the ETags returned by the part uploads of multipart files
+    files: List[CompletedFile] = []
+
+
+class UploadCompleteResponse(BaseModel):
+    session_id: str
+    message_id: str
+    remote_paths: List[str]
 
 
 class VCInferenceResponse(BaseModel):
@@ -77,13 +194,7 @@ class VCTrainingResponse(BaseModel):
 class DownloadResponse(BaseModel):
     vocal: Optional[str]
     instrum: Optional[str]
-    status: Literal["Processing", "Completed"]
-
-
-class SeparationTask(BaseModel):
-    user_id: str
-    artist: str
-    Origin_file_url: str
+    status: Literal["Processing", "Preview", "Completed"]
 
 
 class CheckDB(BaseModel):
@@ -97,88 +208,185 @@ class CheckTrain(BaseModel):
     artist: str
 
 
+class SongStatus(BaseModel):
+    job_key: str
+    artist: str
+    name: Optional[str] = None
+    vocal: Optional[str] = None
+    instrum: Optional[str] = None
+    status: Literal["Processing", "Preview", "Completed"]
+    vc_instrum: Optional[str] = None
+    vc_vocal: Optional[str] = None
+
+
 class combineAudio(BaseModel):
     url1: str
     url2: str
     user_id: str
+    vocal_gain: float = 1.0
+    instrum_gain: float = 1.0
 
 
-def get_s3_client(settings: APIServerSettings):
-    return boto3.client(
-        "s3",
-        aws_access_key_id=settings.aws_access_key,
-        aws_secret_access_key=settings.aws_secret_access_key,
-        region_name=settings.region_name,
-    )
+class JobResponse(BaseModel):
+    job_id: str
+    kind: str
+    status: Literal["Processing", "Completed", "Failed"]
+    url: Optional[str] = None
+    error: Optional[str] = None
 
 
-def get_sqs_client(settings: APIServerSettings):
-    return boto3.resource(
-        "sqs",
-        aws_access_key_id=settings.aws_access_key,
-        aws_secret_access_key=settings.aws_secret_access_key,
-        region_name=settings.region_name,
-    )
+def jobs_collection():
+    return music_db.collection(settings, "jobs")
 
 
-def save_info_to_separationTask(save_data: SeparationTask, settings: APIServerSettings):
-    mongo = MongoClient(settings.mongodb_uri)
-    db = mongo["music_tools"]
-    collection = db["main"]
-
-    document = {
-        "user_id": save_data.user_id,
-        "artist": save_data.artist,
-        "Origin_file_url": save_data.Origin_file_url,
-        "vocal_url": None,
-        "instrum_url": None,
-        "trained": False,
-        "vc_vocal_url": None,
-        "vc_instrum_url": None,
-        "vc_combined_url": None,
+def save_job(kind: str, user_id: str):
+    job = {
+        "job_id": uuid.uuid4().hex,
+        "kind": kind,
+        "user_id": user_id,
+        "status": "Processing",
+        "url": None,
+        "error": None,
+        "created_at": datetime.now(timezone.utc),
     }
+    jobs_collection().insert_one(job)
+    return job
 
-    result = collection.insert_one(document)
 
-    return result.inserted_id
+def update_job(job_id: str, **fields):
+    jobs_collection().update_one({"job_id": job_id}, {"$set": fields})
 
 
-def check_db_for_download(requests: CheckDB):
-    try:
-        mongo = MongoClient(settings.mongodb_uri)
-        db = mongo["music_tools"]
-        collection = db["main"]
-        filename = os.path.splitext(requests.filename)[0]
-        query_result = collection.find_one(
-            {
-                "user_id": requests.user_id,
-                "artist": requests.artist,
-                "vocal_url": f"https://{settings.bucket_name}.s3.{settings.region_name}.amazonaws.com/public/{requests.user_id}/vocal/{filename}_vocals.wav",
-                "instrum_url": f"https://{settings.bucket_name}.s3.{settings.region_name}.amazonaws.com/public/{requests.user_id}/instrument/{filename}_instrum.wav",
-            }
+def youtube_videos_collection():
+    return music_db.collection(settings, "youtube_videos")
+
+
+def youtube_searches_collection():
+    return music_db.collection(settings, "youtube_searches")
+
+
+def youtube_downloads_collection():
+    return music_db.collection(settings, "youtube_downloads")
+
+
+def public_url(remote_path: str):
+    return f"https://{settings.bucket_name}.s3.{settings.region_name}.amazonaws.com/{urllib.parse.quote(remote_path)}"
+
+
+def upload_sessions_collection():
+    return music_db.collection(settings, "upload_sessions")
+
+
+def save_upload_session(session: dict):
+    upload_sessions_collection().insert_one(session)
+
+
+def claim_upload_session(session_id: str):
+    """
+    Marks an open, unexpired session as completing and returns it, None
+    when another request already claimed it
+    """
+    return upload_sessions_collection().find_one_and_update(
+        {"session_id": session_id, "status": "open", "expires_at": {"$gt": datetime.now(timezone.utc)}},
+        {"$set": {"status": "completing"}},
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def release_upload_session(session_id: str):
+    upload_sessions_collection().update_one({"session_id": session_id}, {"$set": {"status": "open"}})
+
+
+def finish_upload_session(session_id: str, message_id: str):
+    upload_sessions_collection().update_one(
+        {"session_id": session_id}, {"$set": {"status": "completed", "message_id": message_id}}
+    )
+
+
+def expire_upload_sessions():
+    """
+    Marks the sessions that expired without being completed as expired and
+    aborts their multipart uploads, whose parts S3 would otherwise keep
+    """
+    s3 = clients.s3_client(settings)
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=settings.upload_session_grace)
+    while True:
+        # one replica gets each session
+        session = upload_sessions_collection().find_one_and_update(
+            {"status": {"$in": ["open", "completing"]}, "expires_at": {"$lt": cutoff}},
+            {"$set": {"status": "expired"}},
         )
+        if session is None:
+            return
+        for file in session["files"]:
+            if file["upload_id"] is not None:
+                upload_sessions.abort_file(s3, settings.bucket_name, file["key"], file["upload_id"])
+
+
+async def sweep_upload_sessions():
+    while True:
+        try:
+            await run_io(expire_upload_sessions)
+        except Exception as e:
+            print(f"Error expiring upload sessions: {e}")
+        await asyncio.sleep(settings.upload_session_sweep_every)
+
+
+async def run_io(function, *args, **kwargs):
+    """
+    Runs a blocking S3, SQS or Mongo call on io_executor, off the event loop
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_executor, partial(function, *args, **kwargs))
+
+
+async def read_form(request: Request, form_model, file_key, file_fields: List[str]):
+    """
+    Streams the multipart body of request to S3 (multipart_upload.stream_form)
+    and validates its text fields with form_model. The objects of a rejected
+    request are deleted again. Returns the form and {field: [StreamedFile]}.
+    """
+    s3 = clients.s3_client(settings)
+    fields, files = await multipart_upload.stream_form(request, s3, settings.bucket_name, file_key, io_executor)
+    uploaded = {field: [file for file in files if file.field == field] for field in file_fields}
+    unexpected = [file for file in files if file.field not in uploaded]
+    try:
+        form = form_model(**fields)
+        missing = [field for field, field_files in uploaded.items() if not field_files]
+        if missing:
+            raise HTTPException(status_code=422, detail=f"Missing file field {missing[0]}")
+    except ValidationError as e:
+        await multipart_upload.discard(files, s3, settings.bucket_name, io_executor)
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False))
+    except HTTPException:
+        await multipart_upload.discard(files, s3, settings.bucket_name, io_executor)
+        raise
+    await multipart_upload.discard(unexpected, s3, settings.bucket_name, io_executor)
+    return form, uploaded
+
+
+def song_status(song: dict):
+    # documents written before previews existed have no status
+    default = "Completed" if song.get("vocal_url") or song.get("vc_instrum_url") else "Processing"
+    return song.get("separation_status", default)
 
-        if query_result is None:
-            return "No download URI found", "No download URI found"
 
-        urls = [
-            query_result.get("vocal_url", "No download vocal URI found"),
-            query_result.get("instrum_url", "No download instrum URI found"),
-        ]
-        return urls
+def check_db_for_download(requests: CheckDB):
+    try:
+        song = music_db.find_song(settings, requests.user_id, requests.artist, requests.filename)
+        if song is None or song.get("vocal_url") is None:
+            return "No download URI found", "No download URI found", "Processing"
+
+        # the preview stems are published first and replaced by the final ones
+        return song["vocal_url"], song["instrum_url"], song_status(song)
     except PyMongoError as e:
         print(f"MongoDB error: {e}")
-        return "Error querying MongoDB", "Error querying MongoDB"
+        return "Error querying MongoDB", "Error querying MongoDB", "Processing"
 
 
 def check_db_for_trained(user_id: str, artist: str):
     try:
-        mongo = MongoClient(settings.mongodb_uri)
-        db = mongo["music_tools"]
-        collection = db["main"]
-        query_result = collection.find_one({"user_id": user_id, "artist": artist, "trained": True})
-
-        if query_result is None:
+        if not music_db.is_trained(settings, user_id, artist):
             return str("not trained yet")
 
         return str("Train Completed")
@@ -189,202 +397,365 @@ def check_db_for_trained(user_id: str, artist: str):
 
 def check_db_for_inference(user_id: str, artist: str, filename: str):
     try:
-        filename = os.path.splitext(filename)[0]
-        mongo = MongoClient(settings.mongodb_uri)
-        db = mongo["music_tools"]
-        collection = db["main"]
-        query_result = collection.find_one(
-            {
-                "user_id": user_id,
-                "artist": artist,
-                "trained": True,
-                "vc_vocal_url": f"https://{settings.bucket_name}.s3.{settings.region_name}.amazonaws.com/public/{user_id}/vc_vocal/{filename}_output.wav",
-            }
-        )
-
-        if query_result is None:
+        song = music_db.find_song(settings, user_id, artist, filename, vc=True, fields={"_id": 0, "vc_vocal_url": 1})
+        if song is None or song.get("vc_vocal_url") is None:
             return str("No download VC URI found")
 
-        return query_result["vc_vocal_url"]
+        return song["vc_vocal_url"]
     except PyMongoError as e:
         print(f"MongoDB error: {e}")
         return "Error querying MongoDB", "Error querying MongoDB"
 
 
-@app.post("/separate", response_model=SeparateResponse)
-def request_to_inference(
-    artist: str = Form(...), user_id: str = Form(...), audio: UploadFile = File(...), vc: bool = False
-):
-    s3 = get_s3_client(settings)
-    sqs = get_sqs_client(settings)
-
-    if vc:
-        remote_path = f"{user_id}/vc_inference/{audio.filename}"
-        Origin_file_url = (
-            f"https://s3musicproject.s3.{settings.region_name}.amazonaws.com/{user_id}/vc_inference/{audio.filename}"
-        )
+async def enqueue_separation(user_id: str, artist: str, remote_path: str, vc: bool, preset: Optional[str]):
+    sqs = clients.sqs_client(settings)
+    Origin_file_url = f"https://s3musicproject.s3.{settings.region_name}.amazonaws.com/{remote_path}"
+    await run_io(music_db.save_song, settings, user_id, artist, remote_path, Origin_file_url, vc)
 
-    else:
-        remote_path = f"{user_id}/originFile/{audio.filename}"
-        Origin_file_url = (
-            f"https://s3musicproject.s3.{settings.region_name}.amazonaws.com/{user_id}/originFile/{audio.filename}"
-        )
-
-    s3.upload_fileobj(audio.file, settings.bucket_name, remote_path)
-
-    save_data = SeparationTask(user_id=user_id, Origin_file_url=Origin_file_url, artist=artist)
-    save_info_to_separationTask(save_data=save_data, settings=settings)
-
-    queue = sqs.get_queue_by_name(QueueName="music.fifo")
-    response = queue.send_message(
+    response = await run_io(
+        sqs.send_message,
+        QueueUrl=await run_io(clients.queue_url, settings, "music.fifo"),
         MessageGroupId=user_id,
         MessageDeduplicationId=artist,
-        MessageBody=json.dumps({"path": remote_path, "user_id": user_id, "artist": artist, "vc": vc}),
+        MessageBody=json.dumps({"path": remote_path, "user_id": user_id, "artist": artist, "vc": vc, "preset": preset}),
     )
+    return response["MessageId"]
 
-    return SeparateResponse(user_id=user_id, remote_path=remote_path, vc=vc, message_id=response["MessageId"])
-
-
-@app.post("/download", response_model=DownloadResponse)
-def download_separated_audio_files(request: DownloadRequest):
-    s3 = get_s3_client(settings)
-    try:
-        requests = CheckDB(user_id=request.user_id, filename=request.filename, artist=request.artist)
-        urls = check_db_for_download(requests)
-
-        if urls[0].startswith("No"):
-            return DownloadResponse(vocal=urls[0], instrum=urls[1], status="Processing")
-        else:
-            return DownloadResponse(vocal=urls[0], instrum=urls[1], status="Completed")
-
-    except Exception as e:
-        print(f"error: {e}")
-
-
-@app.post("/vc_training", response_model=VCTrainingResponse)
-def request_vc_training(user_id: str = Form(...), artist: str = Form(...), files: List[UploadFile] = File(...)):
-
-    s3 = get_s3_client(settings)
-    sqs = get_sqs_client(settings)
 
-    for file in files:
-        file_basename = os.path.basename(file.filename)
-        file_name = f"{user_id}/{artist}/TrainingDatasets/{file_basename}"
-        s3.upload_fileobj(file.file, "s3musicproject", file_name)
-
-    queue = sqs.get_queue_by_name(QueueName="rvc_training.fifo")
-    response = queue.send_message(
+async def enqueue_vc_training(user_id: str, artist: str):
+    sqs = clients.sqs_client(settings)
+    response = await run_io(
+        sqs.send_message,
+        QueueUrl=await run_io(clients.queue_url, settings, "rvc_training.fifo"),
         MessageGroupId=user_id,
         MessageDeduplicationId=str(uuid.uuid4()),
         MessageBody=json.dumps({"user_id": user_id, "artist": artist}),
     )
+    return response["MessageId"]
 
-    return VCTrainingResponse(message_id=response["MessageId"])
-
-
-@app.post("/vc_inference", response_model=VCInferenceResponse)
-def request_vc_inference(user_id: str = Form(...), artist: str = Form(...), audio: UploadFile = File(...)):
-
-    s3 = get_s3_client(settings)
-    sqs = get_sqs_client(settings)
-    remote_path = f"{user_id}/{artist}/rvc_inference/{audio.filename}"
-    s3.upload_fileobj(audio.file, settings.bucket_name, remote_path)
 
-    queue = sqs.get_queue_by_name(QueueName="rvc_inference.fifo")
-    response = queue.send_message(
+async def enqueue_vc_inference(user_id: str, artist: str, filename: str):
+    sqs = clients.sqs_client(settings)
+    response = await run_io(
+        sqs.send_message,
+        QueueUrl=await run_io(clients.queue_url, settings, "rvc_inference.fifo"),
         MessageGroupId=user_id,
         MessageDeduplicationId=str(uuid.uuid4()),
-        MessageBody=json.dumps({"filename": audio.filename, "user_id": user_id, "artist": artist}),
+        MessageBody=json.dumps({"filename": filename, "user_id": user_id, "artist": artist}),
     )
+    return response["MessageId"]
 
-    return VCInferenceResponse(remote_path=remote_path, message_id=response["MessageId"])
 
+@app.post(
+    "/separate",
+    response_model=SeparateResponse,
+    openapi_extra=multipart_upload.form_openapi({"artist": True, "user_id": True, "preset": False}, {"audio": False}),
+)
+async def request_to_inference(request: Request, vc: bool = False):
+    def file_key(fields, filename):
+        return upload_sessions.upload_key("separate", fields["user_id"], fields.get("artist"), filename, vc)
 
-@app.post("/vc_train_check")
-def request_train_check(request: CheckTrain):
-    try:
-        status = check_db_for_trained(request.user_id, request.artist)
-        return status
+    form, files = await read_form(request, SeparateForm, file_key, ["audio"])
+    remote_path = files["audio"][0].key
+    message_id = await enqueue_separation(form.user_id, form.artist, remote_path, vc, form.preset)
 
-    except Exception as e:
-        print(f"error: {e}")
+    return SeparateResponse(
+        user_id=form.user_id, remote_path=remote_path, vc=vc, preset=form.preset, message_id=message_id
+    )
 
 
-@app.post("/vc_inference_check")
-def request_inference_check(request: CheckDB):
+@app.post("/download", response_model=DownloadResponse)
+async def download_separated_audio_files(request: DownloadRequest):
     try:
-        return check_db_for_inference(request.user_id, request.artist, request.filename)
+        requests = CheckDB(user_id=request.user_id, filename=request.filename, artist=request.artist)
+        vocal, instrum, status = await run_io(check_db_for_download, requests)
+        return DownloadResponse(vocal=vocal, instrum=instrum, status=status)
 
     except Exception as e:
         print(f"error: {e}")
 
 
-@app.post("/combine_inferencedAudio")
-def request_combine_audios(request: combineAudio):
-    s3 = get_s3_client(settings)
+@app.post(
+    "/vc_training",
+    response_model=VCTrainingResponse,
+    openapi_extra=multipart_upload.form_openapi({"user_id": True, "artist": True}, {"files": True}),
+)
+async def request_vc_training(request: Request):
+    def file_key(fields, filename):
+        return upload_sessions.upload_key("vc_training", fields["user_id"], fields["artist"], filename)
 
-    with tempfile.TemporaryDirectory() as temp_dir:
-        with open(request.url1, "rb", transport_params={"client": s3}) as f:
-            vocal, sr = librosa.load(f, sr=48000)
-        with open(request.url2, "rb", transport_params={"client": s3}) as a:
-            inst, sr = librosa.load(a, sr=48000)
+    form, files = await read_form(request, UserArtistForm, file_key, ["files"])
+    message_id = await enqueue_vc_training(form.user_id, form.artist)
 
-        if len(vocal) > len(inst):
-            inst = np.pad(inst, (0, len(vocal) - len(inst)), "constant")
-        else:
-            vocal = np.pad(vocal, (0, len(inst) - len(vocal)), "constant")
+    return VCTrainingResponse(message_id=message_id)
 
-        x = vocal + inst
-        output_filename = os.path.join(temp_dir, "VCcombined.wav")
-        sf.write(output_filename, x, sr)
 
-        audio_path = os.path.join(temp_dir, output_filename)
-        remote_path = f"public/{request.user_id}/vc_combined/VCcombined_ouput.wav"
+@app.post(
+    "/vc_inference",
+    response_model=VCInferenceResponse,
+    openapi_extra=multipart_upload.form_openapi({"user_id": True, "artist": True}, {"audio": False}),
+)
+async def request_vc_inference(request: Request):
+    def file_key(fields, filename):
+        return upload_sessions.upload_key("vc_inference", fields["user_id"], fields["artist"], filename)
+
+    form, files = await read_form(request, UserArtistForm, file_key, ["audio"])
+    audio = files["audio"][0]
+    message_id = await enqueue_vc_inference(form.user_id, form.artist, os.path.basename(audio.filename))
+
+    return VCInferenceResponse(remote_path=audio.key, message_id=message_id)
+
+
+@app.post("/upload_sessions", response_model=UploadSessionResponse)
+async def create_upload_session(request: UploadSessionRequest):
+    """
+    Presigned targets the client uploads the files of a job to directly,
+    the job is queued by /upload_sessions/{session_id}/complete
+    """
+    if request.kind != "vc_training" and len(request.files) != 1:
+        raise HTTPException(status_code=422, detail=f"A {request.kind} upload takes exactly one file")
+    for file in request.files:
+        if not 0 < file.size <= settings.max_upload_bytes:
+            detail = f"{file.filename} must be 1 to {settings.max_upload_bytes} bytes"
+            raise HTTPException(status_code=413, detail=detail)
+
+    s3 = clients.s3_client(settings)
+    session_id = uuid.uuid4().hex
+    targets = []
+    for file in request.files:
+        key = upload_sessions.upload_key(request.kind, request.user_id, request.artist, file.filename, request.vc)
+        target = await run_io(
+            upload_sessions.presign_file,
+            s3,
+            settings.bucket_name,
+            key,
+            file.size,
+            settings.upload_session_expires,
+            settings.presigned_multipart_bytes,
+        )
+        targets.append(UploadTarget(filename=os.path.basename(file.filename), size=file.size, **target))
+
+    session = {
+        "session_id": session_id,
+        "status": "open",
+        "expires_at": datetime.now(timezone.utc) + timedelta(seconds=settings.upload_session_expires),
+        "request": request.model_dump(),
+        "files": [target.model_dump(exclude={"post", "part_urls"}) for target in targets],
+    }
+    await run_io(save_upload_session, session)
+    return UploadSessionResponse(session_id=session_id, expires_in=settings.upload_session_expires, files=targets)
+
+
+@app.post("/upload_sessions/{session_id}/complete", response_model=UploadCompleteResponse)
+async def complete_upload_session(session_id: str, request: CompleteUploadRequest):
+    """
+    Completes the multipart uploads of the session, checks that every file
+    is in the bucket with its announced size and queues the job exactly like
+    /separate, /vc_training or /vc_inference. A session is queued once.
+    """
+    session = await run_io(claim_upload_session, session_id)
+    if session is None:
+        raise HTTPException(status_code=409, detail="Unknown, expired or already completed upload session")
+
+    s3 = clients.s3_client(settings)
+    parts = {file.key: [part.model_dump() for part in file.parts] for file in request.files}
+    try:
+        for file in session["files"]:
+            size = await run_io(upload_sessions.uploaded_size, s3, settings.bucket_name, file["key"])
+            # a retry after a failed enqueue finds the multipart uploads already completed
+            if file["upload_id"] is not None and size != file["size"]:
+                if not parts.get(file["key"]):
+                    raise HTTPException(status_code=422, detail=f"Missing the parts of {file['key']}")
+                await run_io(
+                    upload_sessions.complete_file,
+                    s3,
+                    settings.bucket_name,
+                    file["key"],
+                    file["upload_id"],
+                    parts[file["key"]],
+                )
+                size = await run_io(upload_sessions.uploaded_size, s3, settings.bucket_name, file["key"])
+            if size != file["size"]:
+                raise HTTPException(status_code=422, detail=f"{file['key']} is not uploaded completely")
+    except Exception as e:
+        # the client can fix the upload and complete again
+        await run_io(release_upload_session, session_id)
+        if isinstance(e, HTTPException):
+            raise
+        raise HTTPException(status_code=422, detail=f"Upload could not be completed: {e}")
+
+    job = session["request"]
+    files = session["files"]
+    try:
+        if job["kind"] == "separate":
+            message_id = await enqueue_separation(
+                job["user_id"], job["artist"], files[0]["key"], job["vc"], job["preset"]
+            )
+        elif job["kind"] == "vc_training":
+            message_id = await enqueue_vc_training(job["user_id"], job["artist"])
+        else:
+            message_id = await enqueue_vc_inference(job["user_id"], job["artist"], files[0]["filename"])
+        await run_io(finish_upload_session, session_id, message_id)
+    except Exception as e:
+        # the files are in place, completing again retries the queueing
+        await run_io(release_upload_session, session_id)
+        raise HTTPException(status_code=503, detail=f"Upload could not be queued: {e}")
+
+    remote_paths = [file["key"] for file in files]
+    return UploadCompleteResponse(session_id=session_id, message_id=message_id, remote_paths=remote_paths)
+
+
+@app.get("/download_status", response_model=List[SongStatus])
+async def download_status(user_id: str, artist: Optional[str] = None):
+    """
+    Status of all separated songs of a user (of one artist when given), newest first
+    """
+    songs = await run_io(music_db.song_statuses, settings, user_id, artist)
+    return [
+        SongStatus(
+            job_key=song["job_key"],
+            artist=song["artist"],
+            name=song.get("name"),
+            vocal=song.get("vocal_url"),
+            instrum=song.get("instrum_url"),
+            status=song_status(song),
+            vc_instrum=song.get("vc_instrum_url"),
+            vc_vocal=song.get("vc_vocal_url"),
+        )
+        for song in songs
+    ]
 
-        s3.upload_file(audio_path, settings.bucket_name, remote_path)
 
-        vc_combined_url = f"https://{settings.bucket_name}.s3.{settings.region_name}.amazonaws.com/public/{request.user_id}/vc_combined/VCcombined_ouput.wav"
+@app.post("/vc_train_check")
+async def request_train_check(request: CheckTrain):
+    try:
+        status = await run_io(check_db_for_trained, request.user_id, request.artist)
+        return status
 
-        return vc_combined_url
+    except Exception as e:
+        print(f"error: {e}")
 
 
-@app.get("/download_youtube")
-def youtube_download(input: str, user_id: str):
-    s3 = get_s3_client(settings)
+@app.post("/vc_inference_check")
+async def request_inference_check(request: CheckDB):
+    try:
+        return await run_io(check_db_for_inference, request.user_id, request.artist, request.filename)
 
-    def convert_webm_to_wav(input_file, output_file):
-        command = ["ffmpeg", "-y", "-i", input_file, "-acodec", "pcm_s16le", "-ar", "48000", output_file]
-        subprocess.run(command, check=True)
-        os.remove(input_file)
+    except Exception as e:
+        print(f"error: {e}")
 
-    def encode_if_korean(text):
-        if any("\uAC00" <= char <= "\uD7A3" for char in text):
-            return urllib.parse.quote(text)
-        else:
-            return text
 
+async def combine_audios(job_id: str, request: combineAudio, remote_path: str):
     try:
-        with tempfile.TemporaryDirectory() as temp_dir:
-            if input.startswith("http"):
-                url = input
-            else:
-                input = input.replace(" ", "_")
-                s = Search(input)
-                video_url = str(s.results[0]).replace(">", "").split("videoId=")[-1]
-                url = f"https://www.youtube.com/watch?v={video_url}"
-            yt = YouTube(url)
-            download = yt.streams.filter(only_audio=True).order_by("abr").desc().first().download(temp_dir)
-            output = f"{temp_dir}/{input}.wav"
-            convert_webm_to_wav(download, output)
-            remote_path = f"public/{user_id}/youtube/{input}.wav"
-            with open(output, "rb") as data:
-                s3.upload_fileobj(data, settings.bucket_name, remote_path)
-            encoded_text = encode_if_korean(input)
-
-        return f"https://{settings.bucket_name}.s3.{settings.region_name}.amazonaws.com/public/{user_id}/youtube/{encoded_text}.wav"
-
+        await stream_mixer.mix_to_s3(
+            [request.url1, request.url2],
+            [request.vocal_gain, request.instrum_gain],
+            clients.s3_client(settings),
+            settings.bucket_name,
+            remote_path,
+            io_executor,
+            sr=settings.combine_sample_rate,
+            limiter_threshold=settings.combine_limiter_threshold,
+        )
+    except Exception as e:
+        print(f"error: {e}")
+        await run_io(update_job, job_id, status="Failed", error=str(e))
+        return
+    await run_io(update_job, job_id, status="Completed", url=public_url(remote_path))
+
+
+@app.post("/combine_inferencedAudio", response_model=JobResponse)
+async def request_combine_audios(request: combineAudio, background_tasks: BackgroundTasks):
+    """
+    Mixes url1 (vocal) and url2 (instrumental) after the response, poll
+    /jobs/{job_id} for the url of the result
+    """
+    job = await run_io(save_job, "vc_combine", request.user_id)
+    remote_path = f"public/{request.user_id}/vc_combined/VCcombined_{job['job_id']}.wav"
+    background_tasks.add_task(combine_audios, job["job_id"], request, remote_path)
+    return job
+
+
+@app.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: str):
+    job = await run_io(jobs_collection().find_one, {"job_id": job_id}, {"_id": 0})
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return job
+
+
+async def ingest_video(video_id: str):
+    """
+    Key of the audio of video_id, downloaded at most once: the process that
+    claims the video downloads it, the others wait for its record
+    """
+    videos = youtube_videos_collection()
+    loop = asyncio.get_running_loop()
+    while True:
+        if await run_io(youtube_ingest.claim_video, videos, video_id, settings.youtube_claim_timeout):
+            try:
+                key, title = await loop.run_in_executor(
+                    youtube_executor,
+                    youtube_ingest.download_audio,
+                    video_id,
+                    clients.s3_client(settings),
+                    settings.bucket_name,
+                )
+            except Exception as e:
+                await run_io(youtube_ingest.fail_video, videos, video_id, str(e))
+                raise
+            await run_io(youtube_ingest.finish_video, videos, video_id, key, title)
+            return key
+        video = await run_io(videos.find_one, {"_id": video_id}, {"status": 1, "key": 1})
+        if video is not None and video["status"] == "Completed":
+            return video["key"]
+        # a failed download is claimed again on the next round
+        await asyncio.sleep(2)
+
+
+def video_task(video_id: str):
+    task = youtube_tasks.get(video_id)
+    if task is None:
+        task = asyncio.ensure_future(ingest_video(video_id))
+        youtube_tasks[video_id] = task
+        task.add_done_callback(lambda _: youtube_tasks.pop(video_id, None))
+    return task
+
+
+async def youtube_download_job(job_id: str, input: str, user_id: str):
+    try:
+        loop = asyncio.get_running_loop()
+        video_id = await loop.run_in_executor(
+            youtube_executor,
+            youtube_ingest.find_video_id,
+            input,
+            youtube_searches_collection(),
+            settings.youtube_search_ttl,
+        )
+        key = await video_task(video_id)
+        await run_io(
+            youtube_downloads_collection().update_one,
+            {"user_id": user_id, "video_id": video_id},
+            {"$set": {"input": input, "updated_at": datetime.now(timezone.utc)}},
+            upsert=True,
+        )
     except Exception as e:
         print(f"error: {e}")
+        await run_io(update_job, job_id, status="Failed", error=str(e))
+        return
+    await run_io(update_job, job_id, status="Completed", url=public_url(key))
+
+
+@app.get("/download_youtube", response_model=JobResponse)
+async def youtube_download(input: str, user_id: str, background_tasks: BackgroundTasks):
+    """
+    Fetches the audio of a YouTube URL or search query after the response,
+    poll /jobs/{job_id} for its url. Every video is downloaded once and
+    shared by all users that ask for it.
+    """
+    job = await run_io(save_job, "youtube_download", user_id)
+    background_tasks.add_task(youtube_download_job, job["job_id"], input, user_id)
+    return job
 
 
 @app.get("/")
@@ -0,0 +1,178 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import uuid
+from time import perf_counter
+
+import httpx
+import numpy as np
+
+BOUNDARY = "load-test-boundary"
+BLOCK_SIZE = 256 * 1024
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+
+def form_parts(fields: dict, filename: str):
+    """
+    Head and tail of a multipart body with the text fields and one audio file
+    """
+    head = b"".join(
+        f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        for name, value in fields.items()
+    )
+    head += (
+        f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="audio"; filename="{filename}"\r\n'
+        "Content-Type: audio/wav\r\n\r\n"
+    ).encode()
+    return head, f"\r\n--{BOUNDARY}--\r\n".encode()
+
+
+async def stream_body(head: bytes, tail: bytes, size: int):
+    """
+    Streams a file of size random bytes between head and tail, so the load
+    test holds one block per upload instead of the files
+    """
+    yield head
+    block = os.urandom(BLOCK_SIZE)
+    sent = 0
+    while sent < size:
+        n = min(BLOCK_SIZE, size - sent)
+        yield block[:n]
+        sent += n
+    yield tail
+
+
+async def upload(client, args, filename: str):
+    """
+    One streamed upload to /separate, returns its seconds or None on failure
+    """
+    head, tail = form_parts({"user_id": args.user_id, "artist": args.artist}, filename)
+    size = int(args.size_mb * 2**20)
+    headers = {
+        "Content-Type": f"multipart/form-data; boundary={BOUNDARY}",
+        "Content-Length": str(len(head) + size + len(tail)),
+    }
+    start = perf_counter()
+    try:
+        response = await client.post("/separate", content=stream_body(head, tail, size), headers=headers)
+    except httpx.HTTPError as e:
+        print(f"upload {filename} failed: {e!r}", file=sys.stderr)
+        return None
+    if response.status_code != 200:
+        print(f"upload {filename} failed: {response.status_code} {response.text[:200]}", file=sys.stderr)
+        return None
+    return perf_counter() - start
+
+
+async def uploader(client, args, run: str, worker: int, seconds: list, failures: list):
+    for i in range(args.rounds):
+        result = await upload(client, args, f"{run}_{worker}_{i}.wav")
+        if result is None:
+            failures.append(worker)
+        else:
+            seconds.append(result)
+
+
+async def poller(client, args, filename: str, stop: asyncio.Event, latencies: list, errors: list):
+    """
+    Polls /download like the web client does while a song is processing
+    """
+    body = {"user_id": args.user_id, "artist": args.artist, "filename": filename}
+    while not stop.is_set():
+        start = perf_counter()
+        try:
+            response = await client.post("/download", json=body)
+            if response.status_code == 200:
+                latencies.append(perf_counter() - start)
+            else:
+                errors.append(response.status_code)
+        except httpx.HTTPError as e:
+            errors.append(repr(e))
+        await asyncio.sleep(args.poll_interval)
+
+
+async def run_level(args, concurrency: int):
+    """
+    concurrency uploaders sending args.rounds files each, while args.pollers
+    clients poll /download
+    """
+    run = uuid.uuid4().hex[:8]
+    limits = httpx.Limits(max_connections=concurrency + args.pollers)
+    seconds, failures, latencies, errors = [], [], [], []
+    stop = asyncio.Event()
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        pollers = [
+            asyncio.create_task(poller(client, args, f"{run}_{i}_0.wav", stop, latencies, errors))
+            for i in range(args.pollers)
+        ]
+        start = perf_counter()
+        await asyncio.gather(*(uploader(client, args, run, worker, seconds, failures) for worker in range(concurrency)))
+        wall = perf_counter() - start
+        stop.set()
+        await asyncio.gather(*pollers)
+
+    return {
+        "concurrency": concurrency,
+        "uploads": len(seconds),
+        "failed_uploads": len(failures),
+        "upload_p50_seconds": percentile(seconds, 50),
+        "upload_p99_seconds": percentile(seconds, 99),
+        "throughput_mb_s": len(seconds) * args.size_mb / wall,
+        "download_requests": len(latencies),
+        "download_errors": len(errors),
+        "download_p50_ms": None if not latencies else percentile(latencies, 50) * 1000,
+        "download_p99_ms": None if not latencies else percentile(latencies, 99) * 1000,
+    }
+
+
+async def load_test(args):
+    results = []
+    for concurrency in args.concurrency:
+        result = await run_level(args, concurrency)
+        print(json.dumps(result), file=sys.stderr)
+        results.append(result)
+
+    # the most concurrent uploads the server took without failures and with a responsive /download
+    healthy = [
+        result["concurrency"]
+        for result in results
+        if not result["failed_uploads"]
+        and not result["download_errors"]
+        and result["download_p99_ms"] is not None
+        and result["download_p99_ms"] <= args.max_p99_ms
+    ]
+    return {"size_mb": args.size_mb, "capacity": max(healthy, default=0), "levels": results}
+
+
+def main():
+    m = argparse.ArgumentParser(
+        description="Load test of the API server: concurrent streamed uploads to /separate while polling /download. "
+        "Every upload queues a separation, run it against a staging deployment."
+    )
+    m.add_argument("--url", type=str, default="http://localhost:5000")
+    m.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 32], help="Concurrent uploads per level")
+    m.add_argument("--rounds", type=int, default=2, help="Uploads of every uploader per level")
+    m.add_argument("--size_mb", type=float, default=20, help="Size of every uploaded file")
+    m.add_argument("--pollers", type=int, default=4, help="Clients polling /download")
+    m.add_argument("--poll_interval", type=float, default=0.1, help="Seconds between the polls of a client")
+    m.add_argument("--max_p99_ms", type=float, default=500, help="Slowest /download p99 counted as capacity")
+    m.add_argument("--user_id", type=str, default="load-test")
+    m.add_argument("--artist", type=str, default="load-test")
+    m.add_argument("--timeout", type=float, default=600)
+    m.add_argument("--output", type=str, default=None, help="Also write the JSON results here")
+    args = m.parse_args()
+
+    output = json.dumps(asyncio.run(load_test(args)), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+import asyncio
+import uuid
+from functools import partial
+
+from fastapi import HTTPException
+
+try:
+    from python_multipart.multipart import MultipartParser
+    from python_multipart.multipart import parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser
+    from multipart.multipart import parse_options_header
+
+# S3 parts must be at least 5 MiB, except the last one
+PART_SIZE = 8 * 1024 * 1024
+STAGING_PREFIX = "uploads/staging"
+
+
+class S3MultipartWriter:
+    """
+    Writes a stream into an S3 object as the parts of a multipart upload.
+    A part is uploaded on the executor while the next one is received, with
+    at most one part in flight, so an upload holds about 2 * part_size in
+    memory. Objects smaller than a part are written with one put_object.
+    """
+
+    def __init__(self, s3, bucket: str, key: str, executor, part_size: int = PART_SIZE):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.executor = executor
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.size = 0
+        self.upload_id = None
+        self.parts = []
+        self.pending = None
+
+    async def _run(self, function, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(function, **kwargs))
+
+    async def write(self, data: bytes):
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.part_size:
+            await self._flush()
+
+    async def _flush(self):
+        if self.upload_id is None:
+            response = await self._run(self.s3.create_multipart_upload, Bucket=self.bucket, Key=self.key)
+            self.upload_id = response["UploadId"]
+        body = bytes(self.buffer[: self.part_size])
+        del self.buffer[: self.part_size]
+        if self.pending is not None:
+            await self.pending
+        self.pending = asyncio.ensure_future(self._upload_part(len(self.parts) + 1, body))
+
+    async def _upload_part(self, number: int, body: bytes):
+        response = await self._run(
+            self.s3.upload_part, Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=body
+        )
+        self.parts.append({"PartNumber": number, "ETag": response["ETag"]})
+
+    async def complete(self):
+        if self.upload_id is None:
+            await self._run(self.s3.put_object, Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+            return
+        if self.buffer:
+            await self._flush()
+        await self.pending
+        await self._run(
+            self.s3.complete_multipart_upload,
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": sorted(self.parts, key=lambda part: part["PartNumber"])},
+        )
+
+    async def abort(self):
+        if self.pending is not None:
+            try:
+                await self.pending
+            except Exception:
+                pass
+        if self.upload_id is not None:
+            await self._run(self.s3.abort_multipart_upload, Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+class StreamedFile:
+    def __init__(self, field: str, filename: str, key: str, size: int = 0):
+        self.field = field
+        self.filename = filename
+        self.key = key
+        self.size = size
+
+
+async def stream_form(request, s3, bucket: str, file_key, executor):
+    """
+    Parses the multipart/form-data body of request while it arrives and
+    writes every file part straight to S3, nothing is spooled to disk.
+
+    file_key(fields, filename) gives the key of a file from the text fields
+    received before it. When it raises KeyError because a field it needs
+    comes after the file, the file goes to a staging key and is copied to
+    its key (server side) once the whole form is read.
+
+    Returns the text fields {name: value} and the files as StreamedFile.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data body")
+
+    events = []
+    parser = MultipartParser(
+        params[b"boundary"],
+        {
+            "on_part_begin": lambda: events.append(("part_begin", None)),
+            "on_header_field": lambda data, start, end: events.append(("header_field", data[start:end])),
+            "on_header_value": lambda data, start, end: events.append(("header_value", data[start:end])),
+            "on_header_end": lambda: events.append(("header_end", None)),
+            "on_headers_finished": lambda: events.append(("headers_finished", None)),
+            "on_part_data": lambda data, start, end: events.append(("part_data", data[start:end])),
+            "on_part_end": lambda: events.append(("part_end", None)),
+        },
+    )
+
+    fields = {}
+    files = []
+    staged = []
+    header_field = header_value = b""
+    headers = {}
+    value = None
+    writer = None
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            for event, data in events:
+                if event == "part_begin":
+                    headers = {}
+                    header_field = header_value = b""
+                elif event == "header_field":
+                    header_field += data
+                elif event == "header_value":
+                    header_value += data
+                elif event == "header_end":
+                    headers[header_field.lower()] = header_value
+                    header_field = header_value = b""
+                elif event == "headers_finished":
+                    _, options = parse_options_header(headers.get(b"content-disposition", b""))
+                    name = options.get(b"name", b"").decode()
+                    if b"filename" in options:
+                        filename = options[b"filename"].decode()
+                        try:
+                            key = file_key(fields, filename)
+                        except KeyError:
+                            key = f"{STAGING_PREFIX}/{uuid.uuid4().hex}"
+                            staged.append(len(files))
+                        files.append(StreamedFile(name, filename, key))
+                        writer = S3MultipartWriter(s3, bucket, key, executor)
+                    else:
+                        value = bytearray()
+                elif event == "part_data":
+                    if writer is not None:
+                        await writer.write(data)
+                    else:
+                        value += data
+                elif event == "part_end":
+                    if writer is not None:
+                        await writer.complete()
+                        files[-1].size = writer.size
+                        writer = None
+                    else:
+                        fields[name] = value.decode()
+            events.clear()
+        parser.finalize()
+    except BaseException:
+        if writer is not None:
+            await writer.abort()
+        await discard(files, s3, bucket, executor)
+        raise
+
+    for index in staged:
+        file = files[index]
+        staging_key = file.key
+        try:
+            file.key = file_key(fields, file.filename)
+        except KeyError as e:
+            await discard(files, s3, bucket, executor)
+            raise HTTPException(status_code=422, detail=f"Missing form field {e}")
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(executor, partial(s3.copy, {"Bucket": bucket, "Key": staging_key}, bucket, file.key))
+        await loop.run_in_executor(executor, partial(s3.delete_object, Bucket=bucket, Key=staging_key))
+    return fields, files
+
+
+async def discard(files, s3, bucket: str, executor):
+    """
+    Deletes the objects of files, for requests rejected after their upload
+    """
+    loop = asyncio.get_running_loop()
+    for file in files:
+        await loop.run_in_executor(executor, partial(s3.delete_object, Bucket=bucket, Key=file.key))
+
+
+def form_openapi(fields: dict, files: dict):
+    """
+    requestBody of a streamed multipart form for the OpenAPI schema, since
+    the endpoints read it themselves. fields - {name: required}, files -
+    {name: multiple}
+    """
+    properties = {name: {"type": "string"} for name in fields}
+    for name, multiple in files.items():
+        schema = {"type": "string", "format": "binary"}
+        properties[name] = {"type": "array", "items": schema} if multiple else schema
+    required = [name for name, is_required in fields.items() if is_required] + list(files)
+    schema = {"type": "object", "properties": properties, "required": required}
+    return {"requestBody": {"required": True, "content": {"multipart/form-data": {"schema": schema}}}}
@@ -0,0 +1,192 @@
+import asyncio
+import math
+import struct
+from functools import lru_cache
+from math import gcd
+from urllib.parse import unquote
+from urllib.parse import urlparse
+
+import numpy as np
+import soundfile as sf
+from multipart_upload import S3MultipartWriter
+from scipy import signal
+from scipy.signal import resample_poly
+from smart_open import open
+
+# frames of output mixed per step
+BLOCK_FRAMES = 1 << 16
+
+
+@lru_cache(maxsize=16)
+def polyphase_filter(up: int, down: int):
+    """
+    The anti-aliasing filter resample_poly designs by default for up/down,
+    designed once per ratio
+    """
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    return signal.firwin(2 * half_len + 1, 1.0 / max_rate, window=("kaiser", 5.0))
+
+
+class StreamResampler:
+    """
+    resample_poly from sr to target_sr for a stream of (frames, channels)
+    blocks, with the same output as resampling the whole signal at once.
+
+    Blocks are resampled with pad frames of context on both sides. Their
+    starts stay multiples of down, so the output samples of every block
+    fall on the output grid of the whole signal.
+    """
+
+    def __init__(self, sr: int, target_sr: int, channels: int):
+        g = gcd(sr, target_sr)
+        self.up, self.down = target_sr // g, sr // g
+        self.h = polyphase_filter(self.up, self.down)
+        context = math.ceil((len(self.h) - 1) / 2 / self.up) + 1
+        self.pad = self.down * math.ceil(context / self.down)
+        # zeros before the signal, like resample_poly's zero extension
+        self.buffer = np.zeros((self.pad, channels), dtype=np.float32)
+        self.frames_in = 0
+        self.frames_out = 0
+
+    def output_frames(self, frames: int):
+        return math.ceil(frames * self.up / self.down)
+
+    def process(self, x, final: bool = False):
+        self.frames_in += len(x)
+        self.buffer = np.concatenate([self.buffer, x])
+        if final:
+            remaining = len(self.buffer) - self.pad
+            padding = self.pad + (-remaining) % self.down
+            self.buffer = np.concatenate([self.buffer, np.zeros((padding, x.shape[1]), dtype=np.float32)])
+        n = (len(self.buffer) - 2 * self.pad) // self.down * self.down
+        if n <= 0:
+            return np.zeros((0, x.shape[1]), dtype=np.float32)
+        segment = self.buffer[: n + 2 * self.pad]
+        y = resample_poly(segment, self.up, self.down, axis=0, window=self.h)
+        first = self.pad * self.up // self.down
+        y = y[first : first + n * self.up // self.down]
+        self.buffer = self.buffer[n:]
+        if final:
+            y = y[: self.output_frames(self.frames_in) - self.frames_out]
+        self.frames_out += len(y)
+        return y.astype(np.float32)
+
+
+class BlockSource:
+    """
+    Decodes an audio file block by block at target_sr, resampling only
+    when the file has another rate
+    """
+
+    def __init__(self, file, target_sr: int, read_frames: int = BLOCK_FRAMES):
+        self.file = file
+        self.sound = sf.SoundFile(file)
+        self.channels = self.sound.channels
+        self.read_frames = read_frames
+        self.resampler = None
+        self.frames = self.sound.frames
+        if self.sound.samplerate != target_sr:
+            self.resampler = StreamResampler(self.sound.samplerate, target_sr, self.channels)
+            self.frames = self.resampler.output_frames(self.sound.frames)
+        self.pending = np.zeros((0, self.channels), dtype=np.float32)
+        self.exhausted = False
+
+    def read(self, frames: int):
+        """
+        The next frames frames, zero padded after the end of the file
+        """
+        while len(self.pending) < frames and not self.exhausted:
+            block = self.sound.read(self.read_frames, dtype="float32", always_2d=True)
+            self.exhausted = len(block) < self.read_frames
+            if self.resampler is not None:
+                block = self.resampler.process(block, final=self.exhausted)
+            self.pending = np.concatenate([self.pending, block])
+        block, self.pending = self.pending[:frames], self.pending[frames:]
+        if len(block) < frames:
+            block = np.concatenate([block, np.zeros((frames - len(block), self.channels), dtype=np.float32)])
+        return block
+
+    def close(self):
+        self.sound.close()
+        self.file.close()
+
+
+def soft_limit(x, threshold: float):
+    """
+    Leaves |x| <= threshold alone and bends larger peaks smoothly below 1
+    """
+    magnitude = np.abs(x)
+    over = magnitude > threshold
+    if not over.any():
+        return x
+    knee = 1.0 - threshold
+    limited = threshold + knee * np.tanh((magnitude[over] - threshold) / knee)
+    x = x.copy()
+    x[over] = np.sign(x[over]) * limited
+    return x
+
+
+def wav_header(frames: int, channels: int, sr: int):
+    """
+    Header of a 16 bit PCM WAV file of frames frames, written before the
+    samples so the file can be streamed
+    """
+    block_align = channels * 2
+    data_size = frames * block_align
+    return (
+        struct.pack("<4sI4s", b"RIFF", 36 + data_size, b"WAVE")
+        + struct.pack("<4sIHHIIHH", b"fmt ", 16, 1, channels, sr, sr * block_align, block_align, 16)
+        + struct.pack("<4sI", b"data", data_size)
+    )
+
+
+def open_url(url: str, s3, bucket: str):
+    """
+    Objects of bucket are read through the S3 client with ranged GETs,
+    other URLs over HTTP
+    """
+    parsed = urlparse(url)
+    if parsed.netloc.startswith(f"{bucket}.s3."):
+        return open(f"s3://{bucket}/{unquote(parsed.path.lstrip('/'))}", "rb", transport_params={"client": s3})
+    return open(url, "rb")
+
+
+async def mix_to_s3(urls, gains, s3, bucket: str, key: str, executor, sr: int = 48000, limiter_threshold: float = 0.9):
+    """
+    Mixes the audio files at urls with gains into a 16 bit WAV at sr and
+    streams it into a multipart upload to key. Sources are decoded, mixed
+    and encoded block by block on executor, so memory stays O(block) for
+    any length. The shorter sources are padded with silence.
+    """
+    loop = asyncio.get_running_loop()
+
+    def open_sources():
+        return [BlockSource(open_url(url, s3, bucket), sr) for url in urls]
+
+    sources = await loop.run_in_executor(executor, open_sources)
+    try:
+        channels = max(source.channels for source in sources)
+        frames = max(source.frames for source in sources)
+
+        def mix_block(n):
+            mixed = np.zeros((n, channels), dtype=np.float32)
+            for source, gain in zip(sources, gains):
+                # mono sources go to every channel
+                mixed += gain * source.read(n)
+            mixed = soft_limit(mixed, limiter_threshold)
+            return (np.clip(mixed, -1.0, 1.0) * 32767).astype("<i2").tobytes()
+
+        writer = S3MultipartWriter(s3, bucket, key, executor)
+        try:
+            await writer.write(wav_header(frames, channels, sr))
+            for start in range(0, frames, BLOCK_FRAMES):
+                block = await loop.run_in_executor(executor, mix_block, min(BLOCK_FRAMES, frames - start))
+                await writer.write(block)
+            await writer.complete()
+        except BaseException:
+            await writer.abort()
+            raise
+    finally:
+        for source in sources:
+            source.close()
@@ -0,0 +1,83 @@
+import math
+import os
+
+from botocore.exceptions import ClientError
+
+# S3 allows at most 10000 parts, all but the last at least 5 MiB
+MIN_PART_SIZE = 8 * 1024 * 1024
+MAX_PARTS = 10000
+
+
+def upload_key(kind: str, user_id: str, artist: str, filename: str, vc: bool = False):
+    """
+    Key of an uploaded file, the same for streamed and presigned uploads
+    """
+    filename = os.path.basename(filename)
+    if kind == "separate":
+        return f"{user_id}/{'vc_inference' if vc else 'originFile'}/{filename}"
+    if kind == "vc_training":
+        return f"{user_id}/{artist}/TrainingDatasets/{filename}"
+    return f"{user_id}/{artist}/rvc_inference/{filename}"
+
+
+def part_size(size: int):
+    return max(MIN_PART_SIZE, math.ceil(size / MAX_PARTS))
+
+
+def presign_file(s3, bucket: str, key: str, size: int, expires_in: int, multipart_bytes: int):
+    """
+    Upload target of one file of size bytes: a presigned POST that only
+    accepts exactly size bytes, or for files of multipart_bytes and more a
+    multipart upload with one presigned URL per part.
+    """
+    if size < multipart_bytes:
+        post = s3.generate_presigned_post(
+            bucket, key, Conditions=[["content-length-range", size, size]], ExpiresIn=expires_in
+        )
+        return {"key": key, "post": post}
+
+    upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+    size_of_part = part_size(size)
+    part_urls = [
+        s3.generate_presigned_url(
+            "upload_part",
+            Params={"Bucket": bucket, "Key": key, "UploadId": upload_id, "PartNumber": number},
+            ExpiresIn=expires_in,
+        )
+        for number in range(1, math.ceil(size / size_of_part) + 1)
+    ]
+    return {"key": key, "upload_id": upload_id, "part_size": size_of_part, "part_urls": part_urls}
+
+
+def complete_file(s3, bucket: str, key: str, upload_id: str, parts: list):
+    """
+    Completes the multipart upload of a file, parts - [{"PartNumber", "ETag"}]
+    """
+    s3.complete_multipart_upload(
+        Bucket=bucket,
+        Key=key,
+        UploadId=upload_id,
+        MultipartUpload={"Parts": sorted(parts, key=lambda part: part["PartNumber"])},
+    )
+
+
+def abort_file(s3, bucket: str, key: str, upload_id: str):
+    """
+    Aborts the multipart upload of a file and frees its parts, a no-op when
+    it was already completed or aborted
+    """
+    try:
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "NoSuchUpload":
+            print(f"Error aborting the upload of {key}: {e}")
+
+
+def uploaded_size(s3, bucket: str, key: str):
+    """
+    Size of the object at key, None when it was not uploaded
+    """
+    try:
+        return s3.head_object(Bucket=bucket, Key=key)["ContentLength"]
+    except ClientError:
+        return None
@@ -0,0 +1,112 @@
+import hashlib
+import os
+import subprocess
+import tempfile
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+from botocore.exceptions import ClientError
+from pymongo.errors import DuplicateKeyError
+from pytube import Search
+from pytube import YouTube
+from pytube import extract
+
+# the audio of every video is stored once, under the sha256 of its WAV
+AUDIO_PREFIX = "public/youtube/audio"
+
+
+def normalize_query(query: str):
+    return " ".join(query.lower().split())
+
+
+def find_video_id(input: str, searches, ttl: int):
+    """
+    Video id of a YouTube URL, or of the first search result of a query.
+    Search results are cached in searches for ttl seconds.
+    """
+    if input.startswith("http"):
+        return extract.video_id(input)
+
+    query = normalize_query(input)
+    now = datetime.now(timezone.utc)
+    cached = searches.find_one({"query": query, "expires_at": {"$gt": now}}, {"_id": 0, "video_id": 1})
+    if cached is not None:
+        return cached["video_id"]
+
+    results = Search(input.replace(" ", "_")).results
+    if not results:
+        raise LookupError(f"No YouTube results for {input}")
+    video_id = results[0].video_id
+    searches.update_one(
+        {"query": query},
+        {"$set": {"video_id": video_id, "expires_at": now + timedelta(seconds=ttl)}},
+        upsert=True,
+    )
+    return video_id
+
+
+def claim_video(videos, video_id: str, stale_after: int):
+    """
+    True when the caller has to download video_id: it was never requested,
+    its last download failed, or the download claimed stale_after seconds
+    ago never finished. Only one caller gets the claim.
+    """
+    now = datetime.now(timezone.utc)
+    try:
+        videos.insert_one({"_id": video_id, "status": "Processing", "claimed_at": now})
+        return True
+    except DuplicateKeyError:
+        pass
+    claimed = videos.find_one_and_update(
+        {
+            "_id": video_id,
+            "$or": [
+                {"status": "Failed"},
+                {"status": "Processing", "claimed_at": {"$lt": now - timedelta(seconds=stale_after)}},
+            ],
+        },
+        {"$set": {"status": "Processing", "claimed_at": now}},
+    )
+    return claimed is not None
+
+
+def convert_webm_to_wav(input_file, output_file):
+    command = ["ffmpeg", "-y", "-i", input_file, "-acodec", "pcm_s16le", "-ar", "48000", output_file]
+    subprocess.run(command, check=True)
+    os.remove(input_file)
+
+
+def file_sha256(path: str):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def download_audio(video_id: str, s3, bucket: str):
+    """
+    Downloads the audio of video_id as a 48 kHz WAV into the content
+    addressed store, skipping the upload when the same audio is already
+    there. Returns the key and the title of the video.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        yt = YouTube(f"https://www.youtube.com/watch?v={video_id}")
+        download = yt.streams.filter(only_audio=True).order_by("abr").desc().first().download(temp_dir)
+        output = os.path.join(temp_dir, "audio.wav")
+        convert_webm_to_wav(download, output)
+        key = f"{AUDIO_PREFIX}/{file_sha256(output)}.wav"
+        try:
+            s3.head_object(Bucket=bucket, Key=key)
+        except ClientError:
+            s3.upload_file(output, bucket, key)
+        return key, yt.title
+
+
+def finish_video(videos, video_id: str, key: str, title: str):
+    videos.update_one({"_id": video_id}, {"$set": {"status": "Completed", "key": key, "title": title}})
+
+
+def fail_video(videos, video_id: str, error: str):
+    videos.update_one({"_id": video_id}, {"$set": {"status": "Failed", "error": error}})
@@ -0,0 +1,85 @@
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+from pymongo import MongoClient
+
+_lock = threading.Lock()
+_clients = {}
+
+
+def _shared(name: str, factory):
+    """
+    One client per name and process. The pid is part of the key so a forked
+    process builds its own instead of sharing sockets with its parent.
+    """
+    key = (name, os.getpid())
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = factory()
+    return client
+
+
+def aws_config(settings):
+    return Config(
+        region_name=settings.region_name,
+        max_pool_connections=settings.aws_max_pool_connections,
+        tcp_keepalive=True,
+        retries={"max_attempts": 5, "mode": "standard"},
+    )
+
+
+def aws_session(settings):
+    # boto3 sessions are not thread safe, clients are: the session only builds them, under the lock
+    return boto3.session.Session(
+        aws_access_key_id=settings.aws_access_key,
+        aws_secret_access_key=settings.aws_secret_access_key,
+        region_name=settings.region_name,
+    )
+
+
+def s3_client(settings):
+    """
+    S3 client shared by all threads of the process, of s3_endpoint_url
+    (an S3 compatible stand-in) when it is set
+    """
+    return _shared(
+        "s3",
+        lambda: aws_session(settings).client("s3", config=aws_config(settings), endpoint_url=settings.s3_endpoint_url),
+    )
+
+
+def sqs_client(settings):
+    """
+    SQS client shared by all threads of the process
+    """
+    return _shared("sqs", lambda: aws_session(settings).client("sqs", config=aws_config(settings)))
+
+
+def queue_url(settings, queue_name: str):
+    """
+    URL of queue_name, looked up once per process
+    """
+    sqs = sqs_client(settings)
+    return _shared(f"queue_url:{queue_name}", lambda: sqs.get_queue_url(QueueName=queue_name)["QueueUrl"])
+
+
+def mongo_client(settings):
+    """
+    MongoClient shared by all threads of the process. It keeps a pool of
+    up to mongo_max_pool_size connections and monitors the topology once
+    instead of on every query.
+    """
+    return _shared(
+        "mongo",
+        lambda: MongoClient(
+            settings.mongodb_uri,
+            maxPoolSize=settings.mongo_max_pool_size,
+            minPoolSize=settings.mongo_min_pool_size,
+            maxIdleTimeMS=settings.mongo_max_idle_time_ms,
+        ),
+    )
@@ -0,0 +1,164 @@
+import os
+from datetime import datetime
+from datetime import timezone
+from urllib.parse import unquote
+from urllib.parse import urlparse
+
+import clients
+from pymongo import ASCENDING
+from pymongo import DESCENDING
+from pymongo import IndexModel
+from pymongo.errors import DuplicateKeyError
+
+DATABASE = "music_tools"
+
+# fields of a song returned by the status queries
+STATUS_FIELDS = {
+    "_id": 0,
+    "job_key": 1,
+    "artist": 1,
+    "name": 1,
+    "vocal_url": 1,
+    "instrum_url": 1,
+    "separation_status": 1,
+    "vc_instrum_url": 1,
+    "vc_vocal_url": 1,
+}
+
+INDEXES = {
+    # one document per song, found by its job key
+    "main": [
+        IndexModel([("job_key", ASCENDING)], unique=True, partialFilterExpression={"job_key": {"$type": "string"}}),
+        IndexModel([("user_id", ASCENDING), ("_id", DESCENDING)]),
+        IndexModel([("user_id", ASCENDING), ("artist", ASCENDING), ("_id", DESCENDING)]),
+    ],
+    "artists": [IndexModel([("user_id", ASCENDING), ("artist", ASCENDING)], unique=True)],
+    "jobs": [IndexModel([("job_id", ASCENDING)], unique=True)],
+    # expired sessions are removed a day after they can no longer be completed
+    "upload_sessions": [
+        IndexModel([("session_id", ASCENDING)], unique=True),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=24 * 3600),
+    ],
+    "youtube_searches": [
+        IndexModel([("query", ASCENDING)], unique=True),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+    ],
+    "youtube_downloads": [IndexModel([("user_id", ASCENDING), ("video_id", ASCENDING)], unique=True)],
+}
+
+
+def collection(settings, name: str):
+    return clients.mongo_client(settings)[DATABASE][name]
+
+
+def ensure_indexes(settings):
+    """
+    Creates the indexes of INDEXES, a no-op for the ones that exist
+    """
+    for name, indexes in INDEXES.items():
+        collection(settings, name).create_indexes(indexes)
+
+
+def song_name(filename: str):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def job_key(user_id: str, artist: str, filename: str, vc: bool = False):
+    """
+    Key of the song document of an uploaded file, the API server and the
+    workers derive it from the same user, artist and file name. A song
+    uploaded for voice conversion has its own document.
+    """
+    return f"{user_id}/{artist}/{'vc/' if vc else ''}{song_name(filename)}"
+
+
+def save_song(settings, user_id: str, artist: str, filename: str, origin_file_url: str, vc: bool = False):
+    """
+    Creates the document of an uploaded song, or resets the separation
+    results of a song uploaded again
+    """
+    reset = {"vc_instrum_url": None} if vc else {"vocal_url": None, "instrum_url": None}
+    collection(settings, "main").update_one(
+        {"job_key": job_key(user_id, artist, filename, vc)},
+        {
+            "$set": {
+                "Origin_file_url": origin_file_url,
+                "separation_status": "Processing",
+                "updated_at": datetime.now(timezone.utc),
+                **reset,
+            },
+            "$setOnInsert": {"user_id": user_id, "artist": artist, "name": song_name(filename)},
+        },
+        upsert=True,
+    )
+
+
+def update_song(settings, user_id: str, artist: str, filename: str, vc: bool = False, **fields):
+    collection(settings, "main").update_one(
+        {"job_key": job_key(user_id, artist, filename, vc)},
+        {
+            "$set": {**fields, "updated_at": datetime.now(timezone.utc)},
+            "$setOnInsert": {"user_id": user_id, "artist": artist, "name": song_name(filename)},
+        },
+        upsert=True,
+    )
+
+
+def find_song(settings, user_id: str, artist: str, filename: str, vc: bool = False, fields: dict = STATUS_FIELDS):
+    return collection(settings, "main").find_one({"job_key": job_key(user_id, artist, filename, vc)}, fields)
+
+
+def song_statuses(settings, user_id: str, artist: str = None, limit: int = 1000):
+    """
+    The songs of a user (of one artist when given), newest first, in one query
+    """
+    query = {"user_id": user_id} if artist is None else {"user_id": user_id, "artist": artist}
+    songs = collection(settings, "main").find(query, STATUS_FIELDS).sort("_id", DESCENDING).limit(limit)
+    return list(songs)
+
+
+def set_trained(settings, user_id: str, artist: str):
+    collection(settings, "artists").update_one(
+        {"user_id": user_id, "artist": artist},
+        {"$set": {"trained": True, "updated_at": datetime.now(timezone.utc)}},
+        upsert=True,
+    )
+
+
+def is_trained(settings, user_id: str, artist: str):
+    document = collection(settings, "artists").find_one(
+        {"user_id": user_id, "artist": artist, "trained": True}, {"_id": 1}
+    )
+    return document is not None
+
+
+def backfill_job_keys(settings):
+    """
+    Adds the job key to the song documents written before it existed and
+    moves their trained flags to the artists collection. Run once after
+    upgrading; of several documents of the same song only the newest gets
+    the key.
+    """
+    songs = collection(settings, "main")
+    documents = songs.find(
+        {"job_key": {"$exists": False}}, {"user_id": 1, "artist": 1, "Origin_file_url": 1, "trained": 1}
+    ).sort("_id", DESCENDING)
+    for document in documents:
+        if document.get("trained"):
+            set_trained(settings, document["user_id"], document["artist"])
+        path = unquote(urlparse(document.get("Origin_file_url") or "").path)
+        if not path:
+            continue
+        vc = "/vc_inference/" in path
+        try:
+            songs.update_one(
+                {"_id": document["_id"]},
+                {
+                    "$set": {
+                        "job_key": job_key(document["user_id"], document["artist"], path, vc),
+                        "name": song_name(path),
+                    }
+                },
+            )
+        except DuplicateKeyError:
+            pass
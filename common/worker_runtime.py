@@ -0,0 +1,232 @@
+import json
+import signal
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+def print_timing(message_body, timing, error):
+    status = "failed" if error is not None else "done"
+    queued = "" if timing["queued"] is None else f", queued {timing['queued']:.1f}s"
+    print(f"Job {status} in {timing['run']:.1f}s{queued}")
+
+
+class WorkerRuntime:
+    """
+    SQS poll loop shared by the workers.
+
+    Receives up to batch_size messages at a time and runs
+    handler(message_body) on at most concurrency of them at once. A message
+    is deleted when its handler returns and left on the queue when it
+    raises, it then comes back after its visibility timeout. While a
+    handler runs, a heartbeat keeps extending the visibility of its message
+    by visibility_timeout, so a job longer than the timeout is never handed
+    to a second worker.
+
+    SIGTERM and SIGINT stop receiving, run() returns once the running jobs
+    are done. on_job_start(message_body) and
+    on_job_done(message_body, timing, error) are called around every job,
+    timing is {"queued": seconds since the message was sent, "run": seconds}.
+    """
+
+    def __init__(
+        self,
+        sqs,
+        queue_url: str,
+        handler,
+        batch_size: int = 1,
+        concurrency: int = 1,
+        visibility_timeout: int = 60,
+        wait_time: int = 20,
+        on_job_start=None,
+        on_job_done=print_timing,
+    ):
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.handler = handler
+        # SQS returns at most 10 messages per receive
+        self.batch_size = max(1, min(batch_size, 10))
+        self.concurrency = max(1, concurrency)
+        self.visibility_timeout = visibility_timeout
+        self.wait_time = wait_time
+        self.on_job_start = on_job_start
+        self.on_job_done = on_job_done
+        # receipt handle -> start time of the running jobs
+        self.running = {}
+        self.condition = threading.Condition()
+        self.stopping = threading.Event()
+        self.closed = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        self.stats = {"done": 0, "failed": 0, "seconds": 0.0}
+
+    def stop(self, *args):
+        if not self.stopping.is_set():
+            print(f"Stopping, draining {len(self.running)} running jobs")
+        self.stopping.set()
+        with self.condition:
+            self.condition.notify_all()
+
+    def run(self):
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+        threading.Thread(target=self.heartbeat, daemon=True).start()
+        try:
+            while not self.stopping.is_set():
+                with self.condition:
+                    while len(self.running) >= self.concurrency and not self.stopping.is_set():
+                        self.condition.wait()
+                    free = self.concurrency - len(self.running)
+                if self.stopping.is_set():
+                    break
+                for message in self.receive(min(free, self.batch_size)):
+                    self.start(message)
+        finally:
+            self.stopping.set()
+            self.executor.shutdown(wait=True)
+            self.closed.set()
+        print(f"Worker stopped: {self.stats}")
+
+    def receive(self, count: int):
+        try:
+            response = self.sqs.receive_message(
+                QueueUrl=self.queue_url,
+                MaxNumberOfMessages=count,
+                WaitTimeSeconds=self.wait_time,
+                VisibilityTimeout=self.visibility_timeout,
+                AttributeNames=["SentTimestamp"],
+            )
+        except Exception as e:
+            print(f"Error receiving messages: {e}")
+            self.stopping.wait(5)
+            return []
+        return response.get("Messages", [])
+
+    def start(self, message):
+        with self.condition:
+            self.running[message["ReceiptHandle"]] = time.time()
+        self.executor.submit(self.process, message)
+
+    def process(self, message):
+        receipt_handle = message["ReceiptHandle"]
+        started = self.running[receipt_handle]
+        sent = message.get("Attributes", {}).get("SentTimestamp")
+        timing = {"queued": started - int(sent) / 1000 if sent else None}
+        message_body = None
+        error = None
+        try:
+            message_body = json.loads(message["Body"])
+            if self.on_job_start is not None:
+                self.on_job_start(message_body)
+            self.handler(message_body)
+            self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=receipt_handle)
+        except Exception as e:
+            error = e
+            print(f"Error processing message: {e}")
+        finally:
+            timing["run"] = time.time() - started
+            with self.condition:
+                del self.running[receipt_handle]
+                self.stats["failed" if error is not None else "done"] += 1
+                self.stats["seconds"] += timing["run"]
+                self.condition.notify_all()
+        if self.on_job_done is not None:
+            try:
+                self.on_job_done(message_body, timing, error)
+            except Exception as e:
+                print(f"Error in on_job_done: {e}")
+
+    def heartbeat(self):
+        # extends well before the visibility runs out
+        interval = max(1.0, self.visibility_timeout / 3)
+        while not self.closed.wait(interval):
+            with self.condition:
+                receipt_handles = list(self.running)
+            for receipt_handle in receipt_handles:
+                try:
+                    self.sqs.change_message_visibility(
+                        QueueUrl=self.queue_url,
+                        ReceiptHandle=receipt_handle,
+                        VisibilityTimeout=self.visibility_timeout,
+                    )
+                except Exception as e:
+                    print(f"Error extending message visibility: {e}")
+
+
+class LocalQueue:
+    """
+    In-memory stand-in for the SQS client calls WorkerRuntime makes, to run
+    and test a worker without AWS. Messages become visible again when their
+    visibility timeout runs out, like on SQS.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.messages = []
+
+    def get_queue_url(self, QueueName: str):
+        return {"QueueUrl": QueueName}
+
+    def send_message(self, QueueUrl: str, MessageBody: str, **kwargs):
+        message = {
+            "MessageId": uuid.uuid4().hex,
+            "Body": MessageBody,
+            "sent": time.time(),
+            "visible_at": 0.0,
+            "receipt_handle": None,
+            "receive_count": 0,
+        }
+        with self.condition:
+            self.messages.append(message)
+            self.condition.notify_all()
+        return {"MessageId": message["MessageId"]}
+
+    def receive_message(
+        self,
+        QueueUrl: str,
+        MaxNumberOfMessages: int = 1,
+        WaitTimeSeconds: int = 0,
+        VisibilityTimeout: int = 30,
+        **kwargs,
+    ):
+        deadline = time.time() + WaitTimeSeconds
+        with self.condition:
+            while True:
+                now = time.time()
+                visible = [message for message in self.messages if message["visible_at"] <= now]
+                if visible or now >= deadline:
+                    break
+                # hidden messages reappear without a notification
+                self.condition.wait(min(deadline - now, 0.1))
+            received = []
+            for message in visible[:MaxNumberOfMessages]:
+                message["visible_at"] = now + VisibilityTimeout
+                message["receipt_handle"] = uuid.uuid4().hex
+                message["receive_count"] += 1
+                received.append(
+                    {
+                        "MessageId": message["MessageId"],
+                        "ReceiptHandle": message["receipt_handle"],
+                        "Body": message["Body"],
+                        "Attributes": {
+                            "SentTimestamp": str(int(message["sent"] * 1000)),
+                            "ApproximateReceiveCount": str(message["receive_count"]),
+                        },
+                    }
+                )
+        return {"Messages": received} if received else {}
+
+    def _find(self, receipt_handle: str):
+        for message in self.messages:
+            if message["receipt_handle"] == receipt_handle:
+                return message
+        raise ValueError(f"Receipt handle {receipt_handle} is no longer valid")
+
+    def delete_message(self, QueueUrl: str, ReceiptHandle: str):
+        with self.condition:
+            self.messages.remove(self._find(ReceiptHandle))
+
+    def change_message_visibility(self, QueueUrl: str, ReceiptHandle: str, VisibilityTimeout: int):
+        with self.condition:
+            self._find(ReceiptHandle)["visible_at"] = time.time() + VisibilityTimeout
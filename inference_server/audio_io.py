@@ -0,0 +1,140 @@
+import shutil
+import struct
+import subprocess
+from functools import lru_cache
+from math import gcd
+
+import numpy as np
+import soundfile as sf
+from scipy import signal
+from scipy.signal import resample_poly
+
+SAMPLE_RATE = 44100
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# sample formats np.memmap can read as they are stored
+MEMMAP_DTYPES = {
+    (WAVE_FORMAT_PCM, 16): np.dtype("<i2"),
+    (WAVE_FORMAT_PCM, 32): np.dtype("<i4"),
+    (WAVE_FORMAT_IEEE_FLOAT, 32): np.dtype("<f4"),
+}
+
+
+@lru_cache(maxsize=16)
+def polyphase_filter(up, down):
+    """
+    The anti-aliasing filter resample_poly designs by default for up/down,
+    designed once per ratio (147/160 for 48 kHz -> 44.1 kHz).
+    resample_poly scales filters it is given by up itself.
+    """
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    return signal.firwin(2 * half_len + 1, 1.0 / max_rate, window=("kaiser", 5.0))
+
+
+def resample(audio, sr, target_sr=SAMPLE_RATE, axis=0):
+    """
+    Polyphase resampling of audio from sr to target_sr along axis
+    """
+    if sr == target_sr:
+        return audio
+    g = gcd(sr, target_sr)
+    up, down = target_sr // g, sr // g
+    return resample_poly(audio, up, down, axis=axis, window=polyphase_filter(up, down)).astype(np.float32)
+
+
+def wav_memmap(path):
+    """
+    (frames, channels) memmap over the samples of an uncompressed WAV file
+    and its sample rate, None when the file is not a WAV np.memmap can read
+    """
+    with open(path, "rb") as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+            return None
+        fmt = None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                return None
+            chunk_id, size = struct.unpack("<4sI", chunk)
+            if chunk_id == b"fmt ":
+                body = f.read(size)
+                format_tag, channels, sr = struct.unpack("<HHI", body[:8])
+                bits = struct.unpack("<H", body[14:16])[0]
+                if format_tag == WAVE_FORMAT_EXTENSIBLE and len(body) >= 26:
+                    format_tag = struct.unpack("<H", body[24:26])[0]
+                fmt = (format_tag, bits, channels, sr)
+                f.seek(size % 2, 1)
+            elif chunk_id == b"data":
+                if fmt is None:
+                    return None
+                offset = f.tell()
+                break
+            else:
+                f.seek(size + size % 2, 1)
+
+    format_tag, bits, channels, sr = fmt
+    dtype = MEMMAP_DTYPES.get((format_tag, bits))
+    if dtype is None:
+        return None
+    frames = size // (dtype.itemsize * channels)
+    if frames == 0:
+        return None
+    audio = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(frames, channels))
+    return audio, sr
+
+
+def to_float32(audio):
+    """
+    Integer PCM scaled to [-1, 1) like soundfile does, float data as it is
+    """
+    if audio.dtype == np.int16:
+        return audio.astype(np.float32) / 2**15
+    if audio.dtype == np.int32:
+        return audio.astype(np.float32) / 2**31
+    return np.asarray(audio, dtype=np.float32)
+
+
+def ffmpeg_decode(path, sr=SAMPLE_RATE, channels=2):
+    """
+    Decodes any format ffmpeg reads into (frames, channels) float32 at sr
+    """
+    if shutil.which("ffmpeg") is None:
+        raise RuntimeError("ffmpeg is not installed, can't decode {}".format(path))
+    command = ["ffmpeg", "-v", "error", "-i", path, "-f", "f32le", "-ac", str(channels), "-ar", str(sr), "-"]
+    output = subprocess.run(command, check=True, capture_output=True).stdout
+    return np.frombuffer(output, dtype=np.float32).reshape(-1, channels)
+
+
+def read_audio(path):
+    """
+    (frames, channels) samples of path at their own sample rate: a memmap for
+    uncompressed WAV, soundfile for the other formats it knows, else ffmpeg
+    (which then already returns SAMPLE_RATE)
+    """
+    mapped = wav_memmap(path)
+    if mapped is not None:
+        return mapped
+    try:
+        audio, sr = sf.read(path, dtype="float32", always_2d=True)
+        return audio, sr
+    except RuntimeError:
+        return ffmpeg_decode(path), SAMPLE_RATE
+
+
+def load_audio(path, sr=SAMPLE_RATE):
+    """
+    Replacement of librosa.load(path, mono=False, sr=sr): float32 audio as
+    (channels, frames), or (frames,) for mono input, and sr. The file is
+    decoded once and resampled at most once.
+    """
+    audio, file_sr = read_audio(path)
+    audio = resample(to_float32(audio).T, file_sr, sr, axis=1)
+    audio = np.ascontiguousarray(audio)
+    if audio.shape[0] == 1:
+        audio = audio[0]
+    return audio, sr
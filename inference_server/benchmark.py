@@ -0,0 +1,371 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from datetime import date
+from time import time
+
+import numpy as np
+import soundfile as sf
+from presets import PRESETS_FILE
+from presets import apply_preset
+from presets import load_presets
+
+SAMPLE_RATE = 44100
+
+
+def read_status(field):
+    """
+    Bytes of a memory field (VmRSS, VmHWM) of /proc/self/status
+    """
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def write_noise_file(path, seconds, sr=SAMPLE_RATE, block_seconds=10, seed=0):
+    """
+    Writes a stereo test file block by block, so the benchmark itself stays small
+    """
+    rng = np.random.default_rng(seed)
+    with sf.SoundFile(path, "w", samplerate=sr, channels=2, subtype="PCM_16") as f:
+        written = 0
+        total = int(seconds * sr)
+        while written < total:
+            n = min(block_seconds * sr, total - written)
+            t = (written + np.arange(n)) / sr
+            tone = 0.2 * np.sin(2 * np.pi * 220 * t) * (1 + np.sin(2 * np.pi * 0.5 * t)) / 2
+            block = tone[:, None] + 0.05 * rng.standard_normal((n, 2))
+            f.write(block.astype(np.float32))
+            written += n
+
+
+def synthetic_stems(seconds, sr=SAMPLE_RATE, seed=0):
+    """
+    Reproducible stereo (L, 2) stems: a vibrato voice with harmonics and
+    syllables, kick/snare/hat drums, a bass line and sustained chords
+    """
+    rng = np.random.default_rng(seed)
+    n = int(seconds * sr)
+    t = np.arange(n) / sr
+    beat = 60 / 120
+    notes = np.array([0, 3, 5, 7, 10, 7, 5, 3])
+
+    step = (t // (2 * beat)).astype(int)
+    f0 = 220 * 2 ** (notes[step % len(notes)] / 12) * (1 + 0.01 * np.sin(2 * np.pi * 5.5 * t))
+    phase = 2 * np.pi * np.cumsum(f0) / sr
+    voice = sum(np.sin(k * phase) / k for k in range(1, 8))
+    syllables = np.clip(np.sin(np.pi * t / beat), 0, None) ** 0.5
+    vocals = 0.15 * voice * syllables
+    vocals = np.stack([vocals, 0.9 * vocals], axis=1)
+
+    pos = t % beat
+    kick = np.sin(2 * np.pi * 60 * pos * (1 + 2 * np.exp(-pos * 30))) * np.exp(-pos * 12)
+    snare_pos = (t + beat) % (2 * beat)
+    snare = rng.standard_normal(n) * np.exp(-snare_pos * 25) * (snare_pos < beat)
+    hat_pos = t % (beat / 2)
+    hat = np.diff(rng.standard_normal(n + 1)) * np.exp(-hat_pos * 80)
+    drums = 0.4 * kick + 0.15 * snare + 0.05 * hat
+    drums = np.stack([drums, drums], axis=1)
+
+    bass_f = 55 * 2 ** (notes[(t // (4 * beat)).astype(int) % len(notes)] / 12)
+    bass = 0.25 * np.tanh(2 * np.sin(2 * np.pi * np.cumsum(bass_f) / sr))
+    bass = np.stack([bass, bass], axis=1)
+
+    chord = sum(np.sin(2 * np.pi * 330 * 2 ** (i / 12) * t + rng.uniform(0, 2 * np.pi)) for i in (0, 4, 7))
+    other = 0.05 * chord * (1 + 0.3 * np.sin(2 * np.pi * 0.25 * t))
+    other = np.stack([other, np.roll(other, sr // 100)], axis=1)
+
+    stems = {"vocals": vocals, "drums": drums, "bass": bass, "other": other}
+    # leave headroom, the mixture must not clip
+    gain = 0.8 / np.abs(sum(stems.values())).max()
+    return {name: (gain * stem).astype(np.float32) for name, stem in stems.items()}
+
+
+def sdr(reference, estimate):
+    """
+    Global SDR in dB of the Music Demixing Challenge
+    """
+    reference = reference.astype(np.float64)
+    error = reference - estimate[: len(reference)].astype(np.float64)
+    return float(10 * np.log10((np.sum(reference**2) + 1e-8) / (np.sum(error**2) + 1e-8)))
+
+
+def reset_peak_rss():
+    """
+    Resets VmHWM to the current RSS, False where the kernel does not allow it
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def load_options(path, overrides):
+    with open(path) as f:
+        options = json.load(f)
+    options.update(overrides)
+    return options
+
+
+def run_memory_probe(args):
+    """
+    Child process of the memory benchmark: separates one file and prints its peak RSS
+    """
+    import inference
+
+    options = load_options(args.options, {"streaming": args.mode == "streaming"})
+    model = inference.EnsembleDemucsMDXMusicSeparationModel(options)
+    models_rss = read_status("VmRSS")
+    with tempfile.TemporaryDirectory() as output_folder:
+        inference.predict_with_model(args.input, output_folder, options, model=model)
+    peak_rss = read_status("VmHWM")
+    print(
+        json.dumps(
+            {
+                "models_rss_mb": models_rss / 2**20,
+                "peak_rss_mb": peak_rss / 2**20,
+                "separation_mb": (peak_rss - models_rss) / 2**20,
+            }
+        )
+    )
+
+
+def memory_benchmark(args):
+    """
+    Peak RSS of the streaming and the full separation for growing input
+    durations. The streaming peak should stay flat, the full one grows with
+    the song.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for minutes in args.durations:
+            path = os.path.join(temp_dir, "noise_{}min.wav".format(minutes))
+            write_noise_file(path, minutes * 60)
+            for mode in args.modes:
+                output = subprocess.run(
+                    [
+                        sys.executable,
+                        os.path.abspath(__file__),
+                        "memory-probe",
+                        "--input",
+                        path,
+                        "--mode",
+                        mode,
+                        "--options",
+                        args.options,
+                    ],
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                ).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                result.update({"minutes": minutes, "mode": mode})
+                print(json.dumps(result), file=sys.stderr)
+                results.append(result)
+    print(json.dumps(results, indent=2))
+
+
+def record_measurements(path, results):
+    """
+    Stores the real-time factor and SDR of every benchmarked preset as its
+    "measured" entry in the presets file
+    """
+    presets = load_presets(path)
+    measured = {}
+    for result in results:
+        measured.setdefault(result["preset"], []).append(
+            {
+                "seconds": result["seconds"],
+                "device": result["device"],
+                "rtf": round(result["rtf"], 4),
+                "sdr": {stem: round(value, 2) for stem, value in result["sdr"].items()},
+                "options": result["options"],
+                "date": date.today().isoformat(),
+            }
+        )
+    for name, entries in measured.items():
+        presets["presets"][name]["measured"] = entries
+    with open(path, "w") as f:
+        json.dump(presets, f, indent=2)
+        f.write("\n")
+
+
+def separation_benchmark(args):
+    """
+    Separates synthetic mixtures of known stems with every preset and
+    reports the real-time factor, seconds per stage, peak memory and the SDR
+    of each output stem against its reference, as JSON
+    """
+    import inference
+    import torch
+
+    presets = load_presets(args.presets_file)
+    names = args.presets or list(presets["presets"])
+    overrides = json.loads(args.set) if args.set else {}
+
+    model = None
+    results = []
+    for seconds in args.durations:
+        stems = synthetic_stems(seconds, seed=args.seed)
+        mixture = sum(stems.values())
+        references = dict(stems, instrum=stems["drums"] + stems["bass"] + stems["other"])
+
+        for name in names:
+            options = apply_preset(load_options(args.options, {"streaming": "false"}), name, presets)
+            options.update(overrides)
+
+            start_time = time()
+            if model is None:
+                model = inference.EnsembleDemucsMDXMusicSeparationModel(options)
+            else:
+                model.reconfigure(options)
+            load_seconds = time() - start_time
+
+            model.timings = {}
+            peak_reset = reset_peak_rss()
+            cuda = torch.device(model.device).type == "cuda"
+            if cuda:
+                torch.cuda.reset_peak_memory_stats(model.device)
+            start_time = time()
+            separated, _ = model.separate_music_file(mixture, SAMPLE_RATE)
+            separation_seconds = time() - start_time
+
+            result = {
+                "preset": name,
+                "options": dict(presets["presets"][name]["options"], **overrides),
+                "seconds": seconds,
+                "device": model.device,
+                "load_seconds": load_seconds,
+                "separation_seconds": separation_seconds,
+                "rtf": separation_seconds / seconds,
+                "stages": model.timings,
+                "peak_rss_mb": read_status("VmHWM") / 2**20,
+                "peak_rss_reset": peak_reset,
+                "sdr": {stem: sdr(references[stem], separated[stem]) for stem in separated if stem in references},
+            }
+            if cuda:
+                result["peak_cuda_mb"] = torch.cuda.max_memory_allocated(model.device) / 2**20
+            print(json.dumps(result), file=sys.stderr)
+            results.append(result)
+
+    if args.record:
+        record_measurements(args.presets_file, results)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+def measure(func, repeat):
+    """
+    Best seconds over repeat calls of func, the peak RSS growth of one call
+    and its result
+    """
+    seconds = []
+    for _ in range(repeat):
+        reset_peak_rss()
+        base = read_status("VmRSS")
+        start_time = time()
+        result = func()
+        seconds.append(time() - start_time)
+        peak = read_status("VmHWM") - base
+    return min(seconds), peak, result
+
+
+def crossover_benchmark(args):
+    """
+    The ensemble crossover of inference.ensemble_vocals against the previous
+    two lr_filter calls on a stereo track of args.minutes
+    """
+    from crossover import Crossover
+    from inference import lr_filter
+
+    rng = np.random.default_rng(args.seed)
+    n = int(args.minutes * 60 * SAMPLE_RATE)
+    mixed = (0.1 * rng.standard_normal((n, 2))).astype(np.float32)
+    vocals3 = (0.1 * rng.standard_normal((n, 2))).astype(np.float32)
+    crossover = Crossover(args.cutoff)
+
+    def legacy():
+        return lr_filter(mixed, args.cutoff, "lowpass") * 1.01055 + lr_filter(vocals3, args.cutoff, "highpass")
+
+    def fir():
+        return crossover.merge(mixed * 1.01055, vocals3)
+
+    legacy_seconds, legacy_peak, expected = measure(legacy, args.repeat)
+    fir_seconds, fir_peak, result = measure(fir, args.repeat)
+    error = result - expected
+    # filter edges differ (odd extension vs zero padding), compare away from them
+    inner = slice(SAMPLE_RATE, -SAMPLE_RATE)
+    reconstruction = crossover.lowpass(mixed) + crossover.highpass(mixed) - mixed
+    print(
+        json.dumps(
+            {
+                "minutes": args.minutes,
+                "cutoff": args.cutoff,
+                "legacy_seconds": legacy_seconds,
+                "fir_seconds": fir_seconds,
+                "speedup": legacy_seconds / fir_seconds,
+                "legacy_peak_mb": legacy_peak / 2**20,
+                "fir_peak_mb": fir_peak / 2**20,
+                "difference_db": float(
+                    10 * np.log10(np.sum(error[inner] ** 2) / np.sum(expected[inner].astype(np.float64) ** 2))
+                ),
+                "reconstruction_max_error": float(np.abs(reconstruction).max()),
+            },
+            indent=2,
+        )
+    )
+
+
+def main():
+    m = argparse.ArgumentParser(description="Separation benchmarks")
+    commands = m.add_subparsers(dest="command", required=True)
+
+    memory = commands.add_parser("memory", help="Peak memory of streaming vs full separation")
+    memory.add_argument("--durations", type=float, nargs="+", default=[5, 20, 60], help="Input minutes")
+    memory.add_argument("--modes", nargs="+", default=["streaming", "full"], choices=["streaming", "full"])
+    memory.add_argument("--options", type=str, default="options.json")
+    memory.set_defaults(func=memory_benchmark)
+
+    separation = commands.add_parser("separation", help="Speed, memory and SDR of presets on synthetic mixtures")
+    separation.add_argument("--durations", type=float, nargs="+", default=[30, 120, 300], help="Input seconds")
+    separation.add_argument("--presets", nargs="+", default=None, help="Presets to run, all by default")
+    separation.add_argument("--presets_file", type=str, default=PRESETS_FILE)
+    separation.add_argument(
+        "--record", action="store_true", help="Write the measured RTF and SDR into the presets file"
+    )
+    separation.add_argument("--set", type=str, default=None, help="JSON options applied on top of every preset")
+    separation.add_argument("--options", type=str, default="options.json")
+    separation.add_argument("--seed", type=int, default=0)
+    separation.add_argument("--output", type=str, default=None, help="Also write the JSON results here")
+    separation.set_defaults(func=separation_benchmark)
+
+    crossover = commands.add_parser("crossover", help="FIR ensemble crossover vs the lr_filter pair")
+    crossover.add_argument("--minutes", type=float, default=10)
+    crossover.add_argument("--cutoff", type=float, default=10000)
+    crossover.add_argument("--repeat", type=int, default=3)
+    crossover.add_argument("--seed", type=int, default=0)
+    crossover.set_defaults(func=crossover_benchmark)
+
+    probe = commands.add_parser("memory-probe")
+    probe.add_argument("--input", type=str, required=True)
+    probe.add_argument("--mode", type=str, required=True, choices=["streaming", "full"])
+    probe.add_argument("--options", type=str, default="options.json")
+    probe.set_defaults(func=run_memory_probe)
+
+    args = m.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+import os
+from time import time
+
+import numpy as np
+import soundfile as sf
+import torch
+from audio_io import load_audio
+from chunking import run_chunk_plans
+from inference import MDXOnnxEngine
+from inference import get_bigshifts
+from inference import get_shifts
+from inference import match_array_shapes
+from inference import mdxv3_chunk_plan
+from inference import mdxv3_sources
+from inference import resolve_batch_size
+from inference import vitlarge_chunk_plan
+from inference import vitlarge_sources
+from inference import vocft_chunk_plan
+from intermediate_cache import intermediate_cache
+from intermediate_cache import vocal_models
+from result_cache import audio_hash
+from streaming import stem_arrays
+
+
+class ChunkScheduler:
+    """
+    Separates several songs at once.
+
+    For every vocal model the windows of all songs are packed back to back
+    into full batches (chunking.plan_batches), so a backlog of short songs
+    keeps the device as busy as one long song. Outputs are scattered back
+    into one ChunkPlan accumulator per song. Songs are planned in order, so
+    the first ones finish early in the last model pass: each song is
+    finalized (ensemble, Demucs) and handed to on_song_done as soon as its
+    last window is done, while the windows of the others keep running.
+    BigShifts passes are always fused here.
+    """
+
+    def __init__(self, model):
+        """
+        model - EnsembleDemucsMDXMusicSeparationModel, already configured
+        """
+        self.model = model
+
+    def separate(self, songs, on_song_done):
+        """
+        songs - {name: (L, 2) mixture at 44.1 kHz}
+        on_song_done - function (name, separated_music_arrays, output_sample_rates)
+        """
+        model = self.model
+        options = model.options
+        stages = vocal_models(options)
+        outputs = {name: {} for name in songs}
+
+        cache = intermediate_cache(options)
+        hashes = {}
+        if cache is not None:
+            for name, mix in songs.items():
+                hashes[name] = audio_hash(mix)
+                for stage in stages:
+                    output = cache.load(hashes[name], stage, options)
+                    if output is not None:
+                        print("Using cached {} vocals of {}".format(stage, name))
+                        outputs[name][stage] = output
+
+        def finish(name, stage, output):
+            outputs[name][stage] = output
+            if cache is not None:
+                cache.save(hashes[name], stage, options, output)
+            if len(outputs[name]) == len(stages):
+                on_song_done(name, *self._finish_song(songs[name], outputs.pop(name)))
+
+        for name in list(songs):
+            if len(outputs[name]) == len(stages):
+                on_song_done(name, *self._finish_song(songs[name], outputs.pop(name)))
+
+        for stage in stages:
+            plans = {
+                name: self._plan(stage, songs[name]) for name in songs if name in outputs and stage not in outputs[name]
+            }
+            if not plans:
+                continue
+            print("Processing vocals of {} songs with {}...".format(len(plans), stage))
+            owners = {id(plan): name for name, plan in plans.items()}
+
+            def on_done(plan, stage=stage):
+                name = owners[id(plan)]
+                finish(name, stage, self._output(stage, plan, songs[name]))
+
+            start_time = time()
+            self._run(stage, list(plans.values()), on_done)
+            model._add_time(stage, start_time)
+
+    def _finish_song(self, mix, outputs):
+        """
+        model.finish_separation in fp32 like the single song path, also when
+        it is called from the autocast block of the last vocal model
+        """
+        with torch.cuda.amp.autocast(enabled=False):
+            return self.model.finish_separation(mix, 44100, outputs)
+
+    def _plan(self, stage, mix):
+        model = self.model
+        options = model.options
+        tensor = torch.tensor(np.array(mix.T, dtype=np.float32)).to(model.device)
+        if stage == "InstVoc":
+            shifts = get_shifts(mix.T, get_bigshifts(options))
+            return mdxv3_chunk_plan(model.model_mdxv3, tensor, options, shifts=shifts)
+        if stage == "VitLarge":
+            shifts = get_shifts(mix.T, get_bigshifts(options))
+            return vitlarge_chunk_plan(model.model_vl, tensor, options, shifts=shifts)
+        shifts = get_shifts(mix.T, max(1, options["BigShifts"] // 5))
+        return vocft_chunk_plan(model.mdx_models1[0], tensor, model.overlap_MDX, shifts=shifts, signs=(1, -1))
+
+    def _run(self, stage, plans, on_done):
+        model = self.model
+        options = model.options
+        if stage == "VOCFT":
+            engine = MDXOnnxEngine(model.mdx_models1[0], model.infer_session1, model.device)
+            with torch.no_grad():
+                run_chunk_plans(engine, plans, max(1, int(options.get("batch_size_VOCFT", 4))), on_done)
+            return
+
+        network = model.model_mdxv3 if stage == "InstVoc" else model.model_vl
+        key = "batch_size_InstVoc" if stage == "InstVoc" else "batch_size_VitLarge"
+        with torch.cuda.amp.autocast():
+            with torch.no_grad():
+                batch_size = resolve_batch_size(options, key, network, plans[0].windows(0, 0, 1)[0], model.device)
+                run_chunk_plans(network, plans, batch_size, on_done)
+
+    def _output(self, stage, plan, mix):
+        """
+        Raw vocals of a finished plan, scaled like the single song path
+        """
+        model = self.model
+        if stage == "InstVoc":
+            vocals = mdxv3_sources(model.model_mdxv3, plan)["Vocals"] * 1.0005168
+        elif stage == "VitLarge":
+            vocals = vitlarge_sources(model.model_vl, plan)["vocals"] * 1.002
+        else:
+            vocals = plan.result.cpu().numpy() * 1.021
+        # frees the device copy of the song and its accumulator
+        plan.mix = plan.result = None
+        return match_array_shapes(vocals, mix.T)
+
+
+def predict_batch(input_audios, output_folder, options, model, on_file_done=None):
+    """
+    Separates the files input_audios together with ChunkScheduler and writes
+    the same {name}_{stem}.wav files as predict_with_model. Every file is
+    written as soon as it is finished, on_file_done(input_audio, {stem: path})
+    is called right after. output_folder None writes every file next to its
+    input.
+    """
+    model.reconfigure(options)
+    if output_folder is not None and not os.path.isdir(output_folder):
+        os.mkdir(output_folder)
+
+    songs = {}
+    for input_audio in input_audios:
+        audio, sr = load_audio(input_audio, sr=44100)
+        if len(audio.shape) == 1:
+            audio = np.stack([audio, audio], axis=0)
+        songs[input_audio] = audio.T
+
+    def on_song_done(input_audio, result, sample_rates):
+        name = os.path.splitext(os.path.basename(input_audio))[0]
+        folder = os.path.dirname(os.path.abspath(input_audio)) if output_folder is None else output_folder
+        paths = {}
+        for stem, array in stem_arrays(result, model.instruments, options).items():
+            path = folder + "/" + name + "_{}.wav".format(stem)
+            sf.write(path, array, 44100, subtype=options["output_format"])
+            print("File created: {}".format(path))
+            paths[stem] = path
+        if on_file_done is not None:
+            on_file_done(input_audio, paths)
+
+    ChunkScheduler(model).separate(songs, on_song_done)
@@ -0,0 +1,178 @@
+import torch
+import torch.nn as nn
+
+
+def overlap_add(result, chunks, start, step):
+    """
+    Adds a batch of consecutive chunks into result with a single fold.
+    chunks[k] covers result[..., start + k * step : start + k * step + C]
+    """
+    n, C = chunks.shape[0], chunks.shape[-1]
+    lead = chunks.shape[1:-1]
+    span = (n - 1) * step + C
+    cols = chunks.to(result.dtype).reshape(n, -1, C).permute(1, 2, 0).reshape(1, -1, n)
+    folded = nn.functional.fold(cols, output_size=(1, span), kernel_size=(1, C), stride=(1, step))
+    result[..., start : start + span] += folded.reshape(*lead, span)
+
+
+class ChunkPlan:
+    """
+    Windows one mixture has to go through a model.
+
+    Every pass (a BigShifts shift) rolls the mixture by its shift and places
+    it into a zero padded frame, which is cut into n_chunks windows of
+    chunk_size samples every step samples. With several signs each window is
+    run once per polarity, the copies sit next to each other in the same
+    batch and are combined as mean(sign * output). Outputs are weighted by
+    window, divided by norm at their frame position and added into one
+    accumulator in the coordinates of the original mixture, so the shifts
+    are undone and all passes are averaged without keeping a full length
+    result per pass.
+    """
+
+    def __init__(
+        self,
+        mix,
+        chunk_size,
+        step,
+        pad_left,
+        n_chunks,
+        out_shape,
+        shifts=(0,),
+        signs=(1,),
+        window=None,
+        norm=1.0,
+    ):
+        """
+        mix - (channels, L) tensor on the device of the model
+        out_shape - shape of one output window without its time axis, e.g. (S, 2)
+        window - None or a function k -> (chunk_size,) weights of window k
+        norm - number or tensor over the padded frame the outputs are divided by
+        """
+        self.mix = mix
+        self.chunk_size = chunk_size
+        self.step = step
+        self.pad_left = pad_left
+        self.n_chunks = n_chunks
+        self.frame_length = (n_chunks - 1) * step + chunk_size
+        self.passes = list(shifts)
+        self.signs = list(signs)
+        self.window = window
+        if torch.is_tensor(norm):
+            self.inv_norm = torch.where(norm > 0, 1.0 / norm, torch.zeros_like(norm))
+        else:
+            self.inv_norm = 1.0 / norm
+        self.result = torch.zeros(*out_shape, mix.shape[-1], dtype=torch.float32, device=mix.device)
+        self.remaining = n_chunks * len(self.passes)
+        self._frames = {}
+
+    def frame(self, p):
+        if p not in self._frames:
+            shift = self.passes[p]
+            L = self.mix.shape[-1]
+            mix = torch.roll(self.mix, shift, dims=-1) if shift else self.mix
+            self._frames[p] = nn.functional.pad(mix, (self.pad_left, self.frame_length - self.pad_left - L))
+        return self._frames[p]
+
+    def windows(self, p, start, end):
+        """
+        Windows start..end-1 of pass p, each repeated once per sign
+        """
+        windows = self.frame(p).unfold(-1, self.chunk_size, self.step)[:, start:end].transpose(0, 1)
+        if len(self.signs) == 1:
+            return windows * self.signs[0] if self.signs[0] != 1 else windows
+        windows = torch.stack([windows * sign for sign in self.signs], 1)
+        return windows.reshape(-1, *windows.shape[2:])
+
+    def accumulate(self, p, start, x):
+        """
+        Adds model outputs x of windows start, start + 1, ... of pass p
+        """
+        shift = self.passes[p]
+        if len(self.signs) > 1:
+            x = x.reshape(-1, len(self.signs), *x.shape[1:])
+            x = sum(sign * x[:, j].to(torch.float32) for j, sign in enumerate(self.signs))
+        elif self.signs[0] != 1:
+            x = self.signs[0] * x
+        n = x.shape[0]
+        if self.window is not None:
+            weights = torch.stack([self.window(k) for k in range(start, start + n)])
+            x = x * weights.reshape(n, *([1] * (x.dim() - 2)), -1)
+
+        t0 = start * self.step
+        span = (n - 1) * self.step + self.chunk_size
+        segment = torch.zeros(*x.shape[1:-1], span, dtype=torch.float32, device=x.device)
+        overlap_add(segment, x, 0, self.step)
+        if torch.is_tensor(self.inv_norm):
+            segment *= self.inv_norm[t0 : t0 + span]
+        else:
+            segment *= self.inv_norm
+        segment /= len(self.passes) * len(self.signs)
+
+        # keep the part inside the mixture and undo the shift, wrapping at most once
+        L = self.mix.shape[-1]
+        begin = max(t0, self.pad_left)
+        end = min(t0 + span, self.pad_left + L)
+        if begin < end:
+            segment = segment[..., begin - t0 : end - t0]
+            q = (begin - self.pad_left - shift) % L
+            first = min(end - begin, L - q)
+            self.result[..., q : q + first] += segment[..., :first]
+            if first < end - begin:
+                self.result[..., : end - begin - first] += segment[..., first:]
+
+        if start + n == self.n_chunks:
+            self._frames.pop(p, None)
+        self.remaining -= n
+
+    @property
+    def done(self):
+        return self.remaining == 0
+
+
+def plan_batches(plans, batch_size):
+    """
+    Yields batches as lists of (plan, pass, first window, last window + 1)
+    runs. Windows of all passes of all plans are packed back to back, so
+    batches are full until the last one. A window takes one batch slot per
+    sign of its plan, the polarities of a window are never split.
+    """
+    batch = []
+    free = batch_size
+    for plan in plans:
+        slots = len(plan.signs)
+        for p in range(len(plan.passes)):
+            k = 0
+            while k < plan.n_chunks:
+                if batch and free < slots:
+                    yield batch
+                    batch = []
+                    free = batch_size
+                n = min(max(free // slots, 1), plan.n_chunks - k)
+                batch.append((plan, p, k, k + n))
+                k += n
+                free -= n * slots
+                if free <= 0:
+                    yield batch
+                    batch = []
+                    free = batch_size
+    if batch:
+        yield batch
+
+
+def run_chunk_plans(model, plans, batch_size, on_done=None):
+    """
+    Runs the windows of plans through model in batches of batch_size and
+    accumulates the outputs into plan.result. on_done(plan) is called as
+    soon as the last window of a plan is accumulated.
+    """
+    for batch in plan_batches(plans, batch_size):
+        x = torch.cat([plan.windows(p, start, end) for plan, p, start, end in batch])
+        x = model(x)
+        offset = 0
+        for plan, p, start, end in batch:
+            rows = (end - start) * len(plan.signs)
+            plan.accumulate(p, start, x[offset : offset + rows])
+            offset += rows
+            if on_done is not None and plan.done:
+                on_done(plan)
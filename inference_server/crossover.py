@@ -0,0 +1,73 @@
+from functools import lru_cache
+
+import numpy as np
+from scipy import fft
+from scipy import signal
+
+
+class Crossover:
+    """
+    Zero-phase two band crossover with a linear phase FIR lowpass h and the
+    highpass delta - h, so low + high gives back the input exactly.
+
+    h follows the magnitude of the Linkwitz-Riley filter lr_filter applies
+    (a Butterworth of order // 2 run forwards and backwards), so the bands
+    match the previous crossover. The filter and its spectrum are designed
+    once, signals are filtered block by block with overlap-add FFT
+    convolution, memory beyond the output stays O(block_size * blocks_per_step).
+    """
+
+    def __init__(self, cutoff, sr=44100, order=6, numtaps=1023, block_size=1 << 13, blocks_per_step=128):
+        # squared magnitude of the digital Butterworth, including the bilinear warping
+        freq = np.linspace(0.0, 1.0, 4097)
+        warped = np.tan(0.5 * np.pi * freq[:-1]) / np.tan(np.pi * cutoff / sr)
+        gain = np.append(1.0 / (1.0 + warped**order), 0.0)
+        self.h = signal.firwin2(numtaps, freq, gain).astype(np.float32)
+        self.delay = (numtaps - 1) // 2
+        self.block_size = block_size
+        self.blocks_per_step = blocks_per_step
+        self.nfft = fft.next_fast_len(block_size + numtaps - 1, real=True)
+        self.spectrum = fft.rfft(self.h, self.nfft)
+
+    def lowpass(self, x):
+        """
+        x - (L, channels) array, filtered along the time axis.
+        blocks_per_step blocks go through one batched FFT at a time.
+        """
+        x = np.asarray(x, dtype=np.float32)
+        L, B, N = x.shape[0], self.block_size, len(self.h)
+        n_blocks = -(-L // B)
+        lead = x.shape[1:]
+        y = np.zeros((n_blocks * B + N - 1,) + lead, dtype=np.float32)
+        spectrum = self.spectrum.reshape((1, -1) + (1,) * len(lead))
+        for first in range(0, n_blocks, self.blocks_per_step):
+            n = min(self.blocks_per_step, n_blocks - first)
+            blocks = x[first * B : (first + n) * B]
+            if len(blocks) < n * B:
+                blocks = np.concatenate([blocks, np.zeros((n * B - len(blocks),) + lead, dtype=np.float32)])
+            blocks = blocks.reshape((n, B) + lead)
+            out = fft.irfft(fft.rfft(blocks, self.nfft, axis=1) * spectrum, self.nfft, axis=1)
+            segment = y[first * B : (first + n) * B + N - 1]
+            segment[: n * B] += out[:, :B].reshape((n * B,) + lead)
+            # the tail of every block overlaps the start of the next one
+            for k in range(n):
+                segment[(k + 1) * B : (k + 1) * B + N - 1] += out[k, B : B + N - 1]
+        # drop the delay of the linear phase filter
+        return y[self.delay : self.delay + L]
+
+    def highpass(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        return x - self.lowpass(x)
+
+    def merge(self, low, high):
+        """
+        lowpass(low) + highpass(high) with a single filter pass, since
+        lowpass(low) + high - lowpass(high) = high + lowpass(low - high)
+        """
+        high = np.asarray(high, dtype=np.float32)
+        return high + self.lowpass(np.asarray(low, dtype=np.float32) - high)
+
+
+@lru_cache(maxsize=8)
+def get_crossover(cutoff, sr=44100):
+    return Crossover(cutoff, sr)
@@ -2,16 +2,15 @@ import warnings
 
 warnings.filterwarnings("ignore")
 import argparse
-import gc
 import hashlib
 import math
 import os
 import pathlib
 import sys
 import warnings
+from functools import lru_cache
 from time import time
 
-import librosa
 import numpy as np
 import onnxruntime as ort
 import soundfile as sf
@@ -22,10 +21,19 @@ from demucs import pretrained
 from demucs.apply import apply_model
 from demucs.states import load_model
 from ml_collections import ConfigDict
+from audio_io import load_audio
+from chunking import ChunkPlan, run_chunk_plans
+from crossover import get_crossover
+from intermediate_cache import intermediate_cache, vocal_models
+from model_residency import ModelResidency
 from modules.segm_models import Segm_Models_Net
 from modules.tfc_tdf_v3 import STFT, TFC_TDF_net
+from onnx_cores import load_core
+from presets import apply_preset
+from result_cache import audio_hash
 from scipy import signal
 from scipy.signal import resample_poly
+from streaming import StreamingSeparator, should_stream
 from tqdm import tqdm
 
 
@@ -117,11 +125,131 @@ def get_models(name, device, load=True, vocals_model_type=0):
     return [model_vocals]
 
 
-def demix_base_mdxv3(model, mix, device, options):
-    # N = 1
+# Share of the free device memory chunk batches may use when no budget is given
+MEMORY_BUDGET_FRACTION = 0.5
+MAX_BATCH_SIZE = 32
+
+
+def available_memory(device):
+    """
+    Free bytes on the accelerator, or available RAM for the CPU
+    """
+    device = torch.device(device)
+    if device.type == "cuda":
+        return torch.cuda.mem_get_info(device)[0]
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def _peak_rss():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    raise OSError("VmHWM is not reported")
+
+
+def estimate_chunk_memory(model, chunk, device):
+    """
+    Bytes one chunk needs for a forward pass of model, measured once per
+    chunk shape and cached on the model.
+    On CUDA it is the allocator peak, on CPU the growth of the peak RSS
+    (falling back to the sum of all layer outputs, which is an upper bound).
+    """
+    cache = model.__dict__.setdefault("_chunk_memory", {})
+    key = (tuple(chunk.shape), str(device))
+    if key in cache:
+        return cache[key]
+
+    device = torch.device(device)
+    batch = chunk.unsqueeze(0).to(device)
+    with torch.cuda.amp.autocast():
+        with torch.no_grad():
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+                torch.cuda.reset_peak_memory_stats(device)
+                base = torch.cuda.memory_allocated(device)
+                model(batch)
+                torch.cuda.synchronize(device)
+                size = torch.cuda.max_memory_allocated(device) - base
+            else:
+                try:
+                    with open("/proc/self/clear_refs", "w") as f:
+                        f.write("5")
+                    base = _peak_rss()
+                    model(batch)
+                    size = _peak_rss() - base
+                except OSError:
+                    size = 0
+                if size <= 0:
+                    sizes = []
+
+                    def hook(module, inputs, output):
+                        if torch.is_tensor(output):
+                            sizes.append(output.numel() * output.element_size())
+
+                    handles = [
+                        m.register_forward_hook(hook)
+                        for m in model.modules()
+                        if len(list(m.children())) == 0
+                    ]
+                    try:
+                        model(batch)
+                    finally:
+                        for handle in handles:
+                            handle.remove()
+                    size = sum(sizes)
+
+    # input chunk and the output accumulated from it
+    size += 2 * batch.numel() * batch.element_size()
+    cache[key] = size
+    return size
+
+
+def plan_batch_size(model, chunk, device, memory_budget=None, max_batch_size=MAX_BATCH_SIZE):
+    """
+    Largest number of chunks per forward pass that fits memory_budget bytes
+    (by default a share of the memory currently free on device)
+    """
+    if memory_budget is None:
+        memory_budget = available_memory(device) * MEMORY_BUDGET_FRACTION
+    chunk_memory = estimate_chunk_memory(model, chunk, device)
+    return int(max(1, min(max_batch_size, memory_budget // max(chunk_memory, 1))))
+
+
+def resolve_batch_size(options, key, model, chunk, device):
+    """
+    options[key] is either a fixed batch size or "auto" to plan it from
+    options["memory_budget_mb"] / the free memory of the device
+    """
+    batch_size = options.get(key, "auto")
+    if batch_size == "auto":
+        memory_budget = options.get("memory_budget_mb")
+        if memory_budget:
+            memory_budget = float(memory_budget) * 1024 * 1024
+        return plan_batch_size(model, chunk, device, memory_budget)
+    return max(1, int(batch_size))
+
+
+def get_bigshifts(options):
+    if options["BigShifts"] <= 0:
+        return 1
+    return options["BigShifts"]
+
+
+def get_shifts(mix, bigshifts):
+    shift_in_samples = mix.shape[1] // bigshifts
+    return [x * shift_in_samples for x in range(bigshifts)]
+
+
+def mdxv3_chunk_plan(model, mix, options, shifts=(0,), signs=(1,)):
     N = options["overlap_InstVoc"]
-    mix = np.array(mix, dtype=np.float32)
-    mix = torch.tensor(mix, dtype=torch.float32)
 
     try:
         S = model.num_target_instruments
@@ -129,51 +257,63 @@ def demix_base_mdxv3(model, mix, device, options):
         S = model.module.num_target_instruments
 
     mdx_window_size = model.config.inference.dim_t * 2
-    batch_size = 1
     C = model.config.audio.hop_length * (mdx_window_size - 1)
     H = C // N
     L = mix.shape[1]
     pad_size = H - (L - C) % H
+    n_chunks = (L + pad_size + C - 2 * H) // H + 1
+
+    return ChunkPlan(
+        mix,
+        C,
+        H,
+        C - H,
+        n_chunks,
+        (S, 2) if S > 1 else (2,),
+        shifts=shifts,
+        signs=signs,
+        norm=N,
+    )
 
-    mix = torch.cat([torch.zeros(2, C - H), mix, torch.zeros(2, pad_size + C - H)], 1)
-    mix = mix.to(device)
-    chunks = mix.unfold(1, C, H).transpose(0, 1)
-    batches = [chunks[i : i + batch_size] for i in range(0, len(chunks), batch_size)]
-
-    X = torch.zeros(S, *mix.shape).to(device) if S > 1 else torch.zeros_like(mix)
 
+def run_mdxv3_plan(model, plan, device, options):
+    batch_size = resolve_batch_size(
+        options, "batch_size_InstVoc", model, plan.windows(0, 0, 1)[0], device
+    )
     with torch.cuda.amp.autocast():
         with torch.no_grad():
-            cnt = 0
-            for batch in batches:
-                x = model(batch)
-                for w in x:
-                    X[..., cnt * H : cnt * H + C] += w
-                    cnt += 1
+            run_chunk_plans(model, [plan], batch_size)
+
+    return mdxv3_sources(model, plan)
 
-    estimated_sources = X[..., C - H : -(pad_size + C - H)] / N
 
-    if S > 1:
+def mdxv3_sources(model, plan):
+    estimated_sources = plan.result.cpu().numpy()
+    if estimated_sources.ndim == 3:
         return {
-            k: v
-            for k, v in zip(
-                model.config.training.instruments, estimated_sources.cpu().numpy()
-            )
+            k: v for k, v in zip(model.config.training.instruments, estimated_sources)
         }
     else:
-        est_s = estimated_sources.cpu().numpy()
-        return est_s
+        return estimated_sources
+
+
+def demix_base_mdxv3(model, mix, device, options):
+    mix = torch.tensor(np.array(mix, dtype=np.float32)).to(device)
+    plan = mdxv3_chunk_plan(model, mix, options)
+    return run_mdxv3_plan(model, plan, device, options)
 
 
 def demix_full_mdx23c(mix, device, model, options):
     # bigshifts = 7
-    if options["BigShifts"] <= 0:
-        bigshifts = 1
-    else:
-        bigshifts = options["BigShifts"]
+    bigshifts = get_bigshifts(options)
+    shifts = get_shifts(mix, bigshifts)
 
-    shift_in_samples = mix.shape[1] // bigshifts
-    shifts = [x * shift_in_samples for x in range(bigshifts)]
+    if options.get("fuse_BigShifts", True):
+        # chunks of all shifted copies share the model batches and one accumulator
+        mix = torch.tensor(np.array(mix, dtype=np.float32)).to(device)
+        plan = mdxv3_chunk_plan(model, mix, options, shifts=shifts)
+        sources = run_mdxv3_plan(model, plan, device, options)["Vocals"]
+        return sources * 1.0005168  # volume compensation
 
     results = []
 
@@ -191,165 +331,242 @@ def demix_full_mdx23c(mix, device, model, options):
     return sources
 
 
-def demix_wrapper(mix, device, models, infer_session, overlap=0.2, bigshifts=1):
-    if bigshifts <= 0:
-        bigshifts = 1
-    shift_in_samples = mix.shape[1] // bigshifts
-    shifts = [x * shift_in_samples for x in range(bigshifts)]
-    results = []
+class MDXOnnxEngine:
+    """
+    Runs the MDX-Net ONNX model (UVR-MDX-NET-Voc_FT) on batches of chunks.
+    Spectrograms stay on the device of the STFT model: with CUDA they are
+    handed to onnxruntime through I/O binding, on CPU as zero-copy arrays.
+    """
 
-    for shift in tqdm(shifts, position=0):
-        shifted_mix = np.concatenate((mix[:, -shift:], mix[:, :-shift]), axis=-1)
-        sources = (
-            demix(shifted_mix, device, models, infer_session, overlap) * 1.021
-        )  # volume compensation
-        restored_sources = np.concatenate(
-            (sources[..., shift:], sources[..., :shift]), axis=-1
+    def __init__(self, model, infer_session, device):
+        self.model = model
+        self.infer_session = infer_session
+        self.device = torch.device(device)
+        self.input_name = infer_session.get_inputs()[0].name
+        self.output_name = infer_session.get_outputs()[0].name
+        batch_dim = infer_session.get_inputs()[0].shape[0]
+        # models exported with a fixed batch dimension get their batches split
+        self.max_batch_size = batch_dim if isinstance(batch_dim, int) else None
+        self.use_io_binding = (
+            self.device.type == "cuda"
+            and "CUDAExecutionProvider" in infer_session.get_providers()
         )
-        results.append(restored_sources)
 
-    sources = np.mean(results, axis=0)
+    def run(self, spec):
+        if self.max_batch_size is not None and len(spec) > self.max_batch_size:
+            return torch.cat([self.run(part) for part in spec.split(self.max_batch_size)])
+        spec = spec.contiguous()
+        if not self.use_io_binding:
+            res = self.infer_session.run(
+                [self.output_name], {self.input_name: spec.cpu().numpy()}
+            )[0]
+            return torch.from_numpy(res).to(self.device)
+
+        out = torch.empty_like(spec)
+        device_id = self.device.index or 0
+        binding = self.infer_session.io_binding()
+        binding.bind_input(
+            self.input_name,
+            "cuda",
+            device_id,
+            np.float32,
+            tuple(spec.shape),
+            spec.data_ptr(),
+        )
+        binding.bind_output(
+            self.output_name,
+            "cuda",
+            device_id,
+            np.float32,
+            tuple(out.shape),
+            out.data_ptr(),
+        )
+        torch.cuda.synchronize(self.device)
+        self.infer_session.run_with_iobinding(binding)
+        return out
 
-    return sources
+    def __call__(self, x):
+        spec = self.model.stft(x)
+        spec[:, :, :3, :] = 0
+        return self.model.istft(self.run(spec))
 
 
-def demix(mix, device, models, infer_session, overlap=0.2):
-    start_time = time()
-    sources = []
-    n_sample = mix.shape[1]
-    n_fft = models[0].n_fft
-    n_bins = n_fft // 2 + 1
-    trim = n_fft // 2
-    hop = models[0].hop
-    dim_f = models[0].dim_f
-    dim_t = models[0].dim_t * 2
-    chunk_size = models[0].chunk_size
-    org_mix = mix
-    tar_waves_ = []
-    mdx_batch_size = 1
-    overlap = overlap
+@lru_cache(maxsize=32)
+def hanning_window(length, chunk_size, device):
+    """
+    np.hanning(length) zero padded to chunk_size
+    """
+    window = torch.zeros(chunk_size, dtype=torch.float32)
+    window[:length] = torch.from_numpy(np.hanning(length))
+    return window.to(device)
+
+
+def vocft_chunk_plan(model, mix, overlap, shifts=(0,), signs=(1,)):
+    chunk_size = model.chunk_size
+    trim = model.n_fft // 2
     gen_size = chunk_size - 2 * trim
-    pad = gen_size + trim - ((mix.shape[-1]) % gen_size)
+    L = mix.shape[-1]
+    pad = gen_size + trim - (L % gen_size)
+    frame_length = trim + L + pad
+    step = int((1 - overlap) * chunk_size)
+    n_chunks = (frame_length + step - 1) // step
 
-    mixture = np.concatenate(
-        (
-            np.zeros((2, trim), dtype="float32"),
+    if overlap == 0:
+        return ChunkPlan(
             mix,
-            np.zeros((2, pad), dtype="float32"),
-        ),
-        1,
+            chunk_size,
+            step,
+            trim,
+            n_chunks,
+            (2,),
+            shifts=shifts,
+            signs=signs,
+            norm=window_counter(n_chunks, chunk_size, step, mix.device),
+        )
+
+    # the last chunks are cut by the end of the frame and get a shorter window
+    device = str(mix.device)
+
+    def window(k):
+        length = min(chunk_size, frame_length - k * step)
+        return hanning_window(length, chunk_size, device)
+
+    divider = torch.zeros(
+        (n_chunks - 1) * step + chunk_size, dtype=torch.float32, device=mix.device
+    )
+    for k in range(n_chunks):
+        divider[k * step : k * step + chunk_size] += window(k)
+
+    return ChunkPlan(
+        mix,
+        chunk_size,
+        step,
+        trim,
+        n_chunks,
+        (2,),
+        shifts=shifts,
+        signs=signs,
+        window=window,
+        norm=divider,
     )
 
-    step = int((1 - overlap) * chunk_size)
-    result = np.zeros((1, 2, mixture.shape[-1]), dtype=np.float32)
-    divider = np.zeros((1, 2, mixture.shape[-1]), dtype=np.float32)
-    total = 0
-    total_chunks = (mixture.shape[-1] + step - 1) // step
-
-    for i in range(0, mixture.shape[-1], step):
-        total += 1
-        start = i
-        end = min(i + chunk_size, mixture.shape[-1])
-        chunk_size_actual = end - start
-
-        if overlap == 0:
-            window = None
-        else:
-            window = np.hanning(chunk_size_actual)
-            window = np.tile(window[None, None, :], (1, 2, 1))
-
-        mix_part_ = mixture[:, start:end]
-        if end != i + chunk_size:
-            pad_size = (i + chunk_size) - end
-            mix_part_ = np.concatenate(
-                (mix_part_, np.zeros((2, pad_size), dtype="float32")), axis=-1
-            )
 
-        mix_part = torch.tensor([mix_part_], dtype=torch.float32).to(device)
-        mix_waves = mix_part.split(mdx_batch_size)
+def run_vocft_plan(engine, plan, batch_size):
+    with torch.no_grad():
+        run_chunk_plans(engine, [plan], max(1, int(batch_size)))
+    return plan.result.cpu().numpy()
 
-        with torch.no_grad():
-            for mix_wave in mix_waves:
-                _ort = infer_session
-                stft_res = models[0].stft(mix_wave)
-                stft_res[:, :, :3, :] *= 0
-                res = _ort.run(None, {"input": stft_res.cpu().numpy()})[0]
-                ten = torch.tensor(res)
-                tar_waves = models[0].istft(ten.to(device))
-                tar_waves = tar_waves.cpu().detach().numpy()
-
-                if window is not None:
-                    tar_waves[..., :chunk_size_actual] *= window
-                    divider[..., start:end] += window
-                else:
-                    divider[..., start:end] += 1
-                result[..., start:end] += tar_waves[..., : end - start]
-
-    tar_waves = result / divider
-    tar_waves_.append(tar_waves)
-    tar_waves_ = np.vstack(tar_waves_)[:, :, trim:-trim]
-    tar_waves = np.concatenate(tar_waves_, axis=-1)[:, : mix.shape[-1]]
-    source = tar_waves[:, 0:None]
-
-    return source
+
+def demix_wrapper(
+    mix,
+    device,
+    models,
+    infer_session,
+    overlap=0.2,
+    bigshifts=1,
+    batch_size=1,
+    signs=(1,),
+):
+    """
+    signs=(1, -1) returns 0.5 * demix(mix) + 0.5 * -demix(-mix), with both
+    polarities of a chunk in the same onnxruntime call
+    """
+    if bigshifts <= 0:
+        bigshifts = 1
+    shifts = get_shifts(mix, bigshifts)
+    engine = MDXOnnxEngine(models[0], infer_session, device)
+    mix = torch.tensor(np.array(mix, dtype=np.float32)).to(device)
+    plan = vocft_chunk_plan(models[0], mix, overlap, shifts=shifts, signs=signs)
+    sources = run_vocft_plan(engine, plan, batch_size)
+    return sources * 1.021  # volume compensation
 
 
-def demix_vitlarge(model, mix, device, options):
+def demix(mix, device, models, infer_session, overlap=0.2, batch_size=1):
+    engine = MDXOnnxEngine(models[0], infer_session, device)
+    mix = torch.tensor(np.array(mix, dtype=np.float32)).to(device)
+    plan = vocft_chunk_plan(models[0], mix, overlap)
+    return run_vocft_plan(engine, plan, batch_size)
+
+
+def window_counter(n_chunks, chunk_size, step, device):
+    """
+    Number of windows covering every position of the padded frame
+    """
+    t = torch.arange((n_chunks - 1) * step + chunk_size, device=device)
+    last = torch.clamp(torch.div(t, step, rounding_mode="floor"), max=n_chunks - 1)
+    first = torch.clamp(
+        torch.div(t - chunk_size + step, step, rounding_mode="floor"), min=0
+    )
+    return (last - first + 1).to(torch.float32)
+
+
+def vitlarge_chunk_plan(model, mix, options, shifts=(0,), signs=(1,)):
     C = model.config.audio.hop_length * (2 * model.config.inference.dim_t - 1)
     N = options["overlap_VitLarge"]
-    step = C // N
+    step = int(C // N)
+    L = mix.shape[1]
+
+    if model.config.training.target_instrument is not None:
+        out_shape = (1,) + tuple(mix.shape[:-1])
+    else:
+        out_shape = (len(model.config.training.instruments),) + tuple(mix.shape[:-1])
+
+    # every window starting inside the mix, the last ones zero padded to C
+    n_chunks = (L + step - 1) // step
+    return ChunkPlan(
+        mix,
+        C,
+        step,
+        0,
+        n_chunks,
+        out_shape,
+        shifts=shifts,
+        signs=signs,
+        norm=window_counter(n_chunks, C, step, mix.device),
+    )
 
+
+def run_vitlarge_plan(model, plan, device, options):
     with torch.cuda.amp.autocast():
         with torch.no_grad():
-            if model.config.training.target_instrument is not None:
-                req_shape = (1,) + tuple(mix.shape)
-            else:
-                req_shape = (len(model.config.training.instruments),) + tuple(mix.shape)
+            batch_size = resolve_batch_size(
+                options, "batch_size_VitLarge", model, plan.windows(0, 0, 1)[0], device
+            )
+            run_chunk_plans(model, [plan], batch_size)
+    return vitlarge_sources(model, plan)
 
-            mix = mix.to(device)
-            result = torch.zeros(req_shape, dtype=torch.float32).to(device)
-            counter = torch.zeros(req_shape, dtype=torch.float32).to(device)
-            i = 0
-            while i < mix.shape[1]:
-                # print('i:', i, 'C:', C)
-                i = int(i)
-                part = mix[:, i : i + C]
-                length = part.shape[-1]
-                if length < C:
-                    part = nn.functional.pad(
-                        input=part, pad=(0, C - length, 0, 0), mode="constant", value=0
-                    )
-                x = model(part.unsqueeze(0))[0]
-                result[..., i : i + length] += x[..., :length]
-                counter[..., i : i + length] += 1.0
-                i += step
-            estimated_sources = result / counter
 
+def vitlarge_sources(model, plan):
+    estimated_sources = plan.result.cpu().numpy()
     if model.config.training.target_instrument is None:
         return {
             k: v
-            for k, v in zip(
-                model.config.training.instruments, estimated_sources.cpu().numpy()
-            )
+            for k, v in zip(model.config.training.instruments, estimated_sources)
         }
     else:
         return {
             k: v
             for k, v in zip(
-                [model.config.training.target_instrument],
-                estimated_sources.cpu().numpy(),
+                [model.config.training.target_instrument], estimated_sources
             )
         }
 
 
+def demix_vitlarge(model, mix, device, options):
+    plan = vitlarge_chunk_plan(model, mix.to(device), options)
+    return run_vitlarge_plan(model, plan, device, options)
+
+
 def demix_full_vitlarge(mix, device, model, options):
     # bigshifts = 7
-    if options["BigShifts"] <= 0:
-        bigshifts = 1
-    else:
-        bigshifts = options["BigShifts"]
-    shift_in_samples = mix.shape[1] // bigshifts
-    shifts = [x * shift_in_samples for x in range(bigshifts)]
+    bigshifts = get_bigshifts(options)
+    shifts = get_shifts(mix, bigshifts)
+
+    if options.get("fuse_BigShifts", True):
+        # chunks of all shifted copies share the model batches and one accumulator
+        plan = vitlarge_chunk_plan(model, mix.to(device), options, shifts=shifts)
+        sources = run_vitlarge_plan(model, plan, device, options)
+        return sources["vocals"] * 1.002, sources["other"]  # volume compensation
 
     results1 = []
     results2 = []
@@ -374,6 +591,53 @@ def demix_full_vitlarge(mix, device, model, options):
     return sources1, sources2
 
 
+def apply_model_polarity_pair(model, audio, shifts=0, overlap=0.25):
+    """
+    0.5 * apply_model(audio) + 0.5 * -apply_model(-audio) of a (1, channels, length)
+    audio, both polarities run as one batch of two
+    """
+    out = apply_model(
+        model, torch.cat([audio, -audio]), shifts=shifts, overlap=overlap
+    )
+    return (0.5 * (out[0] - out[1])).cpu().numpy()
+
+
+"""
+['drums', 'bass', 'other', 'vocals']
+['drums', 'bass', 'other', 'vocals']
+['drums', 'bass', 'other', 'vocals', 'guitar', 'piano']
+['drums', 'bass', 'other', 'vocals']
+"""
+DEMUCS_MODELS = ["htdemucs_ft", "htdemucs", "htdemucs_6s", "hdemucs_mmi"]
+MDXV3_CHECKPOINT = "MDX23C-8KFFT-InstVoc_HQ.ckpt"
+VITLARGE_CHECKPOINT = "model_vocals_segm_models_sdr_9.77.ckpt"
+
+
+def demucs_residency_options(options):
+    """
+    demucs_memory_budget_mb - memory the Demucs models may take on the device,
+    the least recently used ones are evicted to demucs_evict_to ("cpu" or "disk")
+    """
+    memory_budget = options.get("demucs_memory_budget_mb")
+    if memory_budget:
+        memory_budget = float(memory_budget) * 1024 * 1024
+    return {
+        "memory_budget": memory_budget or None,
+        "evict_to": options.get("demucs_evict_to", "cpu"),
+    }
+
+
+def select_device(options):
+    if torch.cuda.is_available():
+        device = "cuda:0"
+    else:
+        device = "cpu"
+    if "cpu" in options:
+        if options["cpu"]:
+            device = "cpu"
+    return device
+
+
 class EnsembleDemucsMDXMusicSeparationModel:
     """
     Doesn't do any separation just passes the input back as output
@@ -383,94 +647,76 @@ class EnsembleDemucsMDXMusicSeparationModel:
         """
         options - user options
         """
-        self.options = options
-        self.vocals_only = options["vocals_only"]
+        self.model_folder = os.path.dirname(os.path.realpath(__file__)) + "/models/"
+        self.device = select_device(options)
+        self.demucs = None
+        self.infer_session1 = None
+        # seconds spent per stage, summed over the songs separated so far
+        self.timings = {}
+        self._apply_options(options)
 
-        if torch.cuda.is_available():
-            device = "cuda:0"
-        else:
-            device = "cpu"
-        if "cpu" in options:
-            if options["cpu"]:
-                device = "cpu"
-        # print('Use device: {}'.format(device))
-        self.single_onnx = False
-        if "single_onnx" in options:
-            if options["single_onnx"]:
-                self.single_onnx = True
-                # print('Use single vocal ONNX')
-        self.overlap_demucs = float(options["overlap_demucs"])
-        self.overlap_MDX = float(options["overlap_VOCFT"])
-        if self.overlap_demucs > 0.99:
-            self.overlap_demucs = 0.99
-        if self.overlap_demucs < 0.0:
-            self.overlap_demucs = 0.0
-        if self.overlap_MDX > 0.99:
-            self.overlap_MDX = 0.99
-        if self.overlap_MDX < 0.0:
-            self.overlap_MDX = 0.0
-        model_folder = os.path.dirname(os.path.realpath(__file__)) + "/models/"
+        # MDXv3 init
+        print("Loading InstVoc into memory")
+        self.model_mdxv3 = self._load_mdxv3()
+
+        # VitLarge init
+        print("Loading VitLarge into memory")
+        self.model_vl = self._load_vitlarge()
+
+        self._load_optional_models()
+
+    def reconfigure(self, options):
         """
-        
-        remote_url = 'https://dl.fbaipublicfiles.com/demucs/hybrid_transformer/04573f0d-f3cf25b2.th'
-        model_path = model_folder + '04573f0d-f3cf25b2.th'
-        if not os.path.isfile(model_path):
-            torch.hub.download_url_to_file(remote_url, model_folder + '04573f0d-f3cf25b2.th')
-        model_vocals = load_model(model_path)
-        model_vocals.to(device)
-        self.model_vocals_only = model_vocals
+        Applies new user options to an already constructed model.
+        Models which are resident stay loaded, only the ones the new options
+        need for the first time are read from disk.
         """
-
-        if options["vocals_only"] is False:
-            self.models = []
+        device = select_device(options)
+        if device != self.device:
+            print("Moving models to {}".format(device))
+            self.device = device
+            self.model_mdxv3 = self.model_mdxv3.to(device)
+            self.model_vl = self.model_vl.to(device)
+            # ONNX sessions and STFT windows are bound to a device
+            self.infer_session1 = None
+        self._apply_options(options)
+        if self.demucs is not None:
+            self.demucs.configure(device, **demucs_residency_options(options))
+        self._load_optional_models()
+
+    def _apply_options(self, options):
+        self.options = options
+        self.vocals_only = options["vocals_only"]
+        self.single_onnx = bool(options.get("single_onnx", False))
+        self.overlap_demucs = min(max(float(options["overlap_demucs"]), 0.0), 0.99)
+        self.overlap_MDX = min(max(float(options["overlap_VOCFT"]), 0.0), 0.99)
+
+    def _load_optional_models(self):
+        if self.vocals_only is False and self.demucs is None:
+            self.demucs = ModelResidency(
+                pretrained.get_model,
+                self.device,
+                **demucs_residency_options(self.options),
+            )
+            for name in DEMUCS_MODELS:
+                self.demucs.get(name)
             self.weights_vocals = np.array([10, 1, 8, 9])
             self.weights_bass = np.array([19, 4, 5, 8])
             self.weights_drums = np.array([18, 2, 4, 9])
             self.weights_other = np.array([14, 2, 5, 10])
 
-            model1 = pretrained.get_model("htdemucs_ft")
-            model1.to(device)
-            self.models.append(model1)
-
-            model2 = pretrained.get_model("htdemucs")
-            model2.to(device)
-            self.models.append(model2)
-
-            model3 = pretrained.get_model("htdemucs_6s")
-            model3.to(device)
-            self.models.append(model3)
-
-            model4 = pretrained.get_model("hdemucs_mmi")
-            model4.to(device)
-            self.models.append(model4)
-
-            if 0:
-                for model in self.models:
-                    pass
-                    # print(model.sources)
-            """
-            ['drums', 'bass', 'other', 'vocals']
-            ['drums', 'bass', 'other', 'vocals']
-            ['drums', 'bass', 'other', 'vocals', 'guitar', 'piano']
-            ['drums', 'bass', 'other', 'vocals']
-            """
-
-        if device == "cpu":
-            chunk_size = 200000000
-            providers = ["CPUExecutionProvider"]
-        else:
-            chunk_size = 1000000
-            providers = ["CUDAExecutionProvider"]
-        if "chunk_size" in options:
-            chunk_size = int(options["chunk_size"])
+        # VOCFT init
+        if self.options["use_VOCFT"] is True and self.infer_session1 is None:
+            print("Loading VOCFT into memory")
+            self.mdx_models1, self.infer_session1 = self._load_vocft()
 
-        # MDXv3 init
-        print("Loading InstVoc into memory")
+    def _load_mdxv3(self):
+        model_folder = self.model_folder
         remote_url_mdxv3 = "https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/MDX23C-8KFFT-InstVoc_HQ.ckpt"
         remote_url_conf_mdxv3 = "https://raw.githubusercontent.com/TRvlvr/application_data/main/mdx_model_data/mdx_c_configs/model_2_stem_full_band_8k.yaml"
-        if not os.path.isfile(model_folder + "MDX23C-8KFFT-InstVoc_HQ.ckpt"):
+        if not os.path.isfile(model_folder + MDXV3_CHECKPOINT):
             torch.hub.download_url_to_file(
-                remote_url_mdxv3, model_folder + "MDX23C-8KFFT-InstVoc_HQ.ckpt"
+                remote_url_mdxv3, model_folder + MDXV3_CHECKPOINT
             )
         if not os.path.isfile(model_folder + "model_2_stem_full_band_8k.yaml"):
             torch.hub.download_url_to_file(
@@ -480,22 +726,26 @@ class EnsembleDemucsMDXMusicSeparationModel:
         with open(model_folder + "model_2_stem_full_band_8k.yaml") as f:
             config_mdxv3 = ConfigDict(yaml.load(f, Loader=yaml.FullLoader))
 
-        self.model_mdxv3 = TFC_TDF_net(config_mdxv3)
-        self.model_mdxv3.load_state_dict(
-            torch.load(model_folder + "MDX23C-8KFFT-InstVoc_HQ.ckpt")
+        model_mdxv3 = TFC_TDF_net(config_mdxv3)
+        model_mdxv3.load_state_dict(
+            torch.load(model_folder + MDXV3_CHECKPOINT, map_location="cpu")
         )
-        self.device = torch.device(device)
-        self.model_mdxv3 = self.model_mdxv3.to(device)
-        self.model_mdxv3.eval()
+        model_mdxv3 = model_mdxv3.to(self.device)
+        model_mdxv3.eval()
+        if self.device == "cpu":
+            model_mdxv3 = load_core(
+                model_mdxv3, model_folder + MDXV3_CHECKPOINT, self.options
+            )
+        return model_mdxv3
 
-        # VitLarge init
-        print("Loading VitLarge into memory")
+    def _load_vitlarge(self):
+        model_folder = self.model_folder
         remote_url_vitlarge = "https://github.com/ZFTurbo/Music-Source-Separation-Training/releases/download/v1.0.0/model_vocals_segm_models_sdr_9.77.ckpt"
         remote_url_vl_conf = "https://github.com/ZFTurbo/Music-Source-Separation-Training/releases/download/v1.0.0/config_vocals_segm_models.yaml"
-        if not os.path.isfile(model_folder + "model_vocals_segm_models_sdr_9.77.ckpt"):
+        if not os.path.isfile(model_folder + VITLARGE_CHECKPOINT):
             torch.hub.download_url_to_file(
                 remote_url_vitlarge,
-                model_folder + "model_vocals_segm_models_sdr_9.77.ckpt",
+                model_folder + VITLARGE_CHECKPOINT,
             )
         if not os.path.isfile(model_folder + "config_vocals_segm_models.yaml"):
             torch.hub.download_url_to_file(
@@ -505,35 +755,43 @@ class EnsembleDemucsMDXMusicSeparationModel:
         with open(model_folder + "config_vocals_segm_models.yaml") as f:
             config_vl = ConfigDict(yaml.load(f, Loader=yaml.FullLoader))
 
-        self.model_vl = Segm_Models_Net(config_vl)
-        self.model_vl.load_state_dict(
-            torch.load(model_folder + "model_vocals_segm_models_sdr_9.77.ckpt")
-        )
-        self.device = torch.device(device)
-        self.model_vl = self.model_vl.to(device)
-        self.model_vl.eval()
-
-        # VOCFT init
-        if options["use_VOCFT"] is True:
-            print("Loading VOCFT into memory")
-            self.chunk_size = chunk_size
-            self.mdx_models1 = get_models(
-                "tdf_extra", load=False, device=device, vocals_model_type=2
-            )
-            model_path_onnx1 = model_folder + "UVR-MDX-NET-Voc_FT.onnx"
-            remote_url_onnx1 = "https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/UVR-MDX-NET-Voc_FT.onnx"
-            if not os.path.isfile(model_path_onnx1):
-                torch.hub.download_url_to_file(remote_url_onnx1, model_path_onnx1)
-            # print('Model path: {}'.format(model_path_onnx1))
-            # print('Device: {} Chunk size: {}'.format(device, chunk_size))
-            self.infer_session1 = ort.InferenceSession(
-                model_path_onnx1,
-                providers=providers,
-                provider_options=[{"device_id": 0}],
+        model_vl = Segm_Models_Net(config_vl)
+        model_vl.load_state_dict(
+            torch.load(
+                model_folder + VITLARGE_CHECKPOINT,
+                map_location="cpu",
             )
+        )
+        model_vl = model_vl.to(self.device)
+        model_vl.eval()
+        if self.device == "cpu":
+            model_vl = load_core(model_vl, model_folder + VITLARGE_CHECKPOINT, self.options)
+        return model_vl
+
+    def _load_vocft(self):
+        if self.device == "cpu":
+            chunk_size = 200000000
+            providers = ["CPUExecutionProvider"]
+        else:
+            chunk_size = 1000000
+            providers = ["CUDAExecutionProvider"]
+        if "chunk_size" in self.options:
+            chunk_size = int(self.options["chunk_size"])
+        self.chunk_size = chunk_size
 
-        self.device = device
-        pass
+        mdx_models1 = get_models(
+            "tdf_extra", load=False, device=self.device, vocals_model_type=2
+        )
+        model_path_onnx1 = self.model_folder + "UVR-MDX-NET-Voc_FT.onnx"
+        remote_url_onnx1 = "https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/UVR-MDX-NET-Voc_FT.onnx"
+        if not os.path.isfile(model_path_onnx1):
+            torch.hub.download_url_to_file(remote_url_onnx1, model_path_onnx1)
+        infer_session1 = ort.InferenceSession(
+            model_path_onnx1,
+            providers=providers,
+            provider_options=[{"device_id": 0}],
+        )
+        return mdx_models1, infer_session1
 
     @property
     def instruments(self):
@@ -544,10 +802,99 @@ class EnsembleDemucsMDXMusicSeparationModel:
         else:
             return ["vocals"]
 
+    def chunk_length(self):
+        """
+        Longest window in samples any of the models looks at
+        """
+        lengths = [
+            self.model_mdxv3.config.audio.hop_length
+            * (2 * self.model_mdxv3.config.inference.dim_t - 1),
+            self.model_vl.config.audio.hop_length
+            * (2 * self.model_vl.config.inference.dim_t - 1),
+        ]
+        if self.options["use_VOCFT"] is True:
+            lengths.append(self.mdx_models1[0].chunk_size)
+        return max(lengths)
+
     def raise_aicrowd_error(self, msg):
         """Will be used by the evaluator to provide logs, DO NOT CHANGE"""
         raise NameError(msg)
 
+    def separate_preview(self, mixed_sound_array):
+        """
+        Quick vocals and instrum from MDXv3 alone, without BigShifts and
+        overlap, to publish while the full ensemble is still running
+        """
+        start_time = time()
+        options = dict(self.options, BigShifts=1, overlap_InstVoc=1)
+        vocals = demix_full_mdx23c(
+            mixed_sound_array.T, self.device, self.model_mdxv3, options
+        )
+        vocals = match_array_shapes(vocals, mixed_sound_array.T).T
+        self._add_time("preview", start_time)
+        return {"vocals": vocals, "instrum": mixed_sound_array - vocals}
+
+    def _add_time(self, stage, start_time):
+        self.timings[stage] = self.timings.get(stage, 0.0) + time() - start_time
+
+    def vocal_outputs(self, mixed_sound_array):
+        """
+        Raw vocals of every model of the ensemble as {model: (2, L) array}.
+        With options["intermediate_cache_dir"] set, outputs of audio already
+        separated with the same model options are read from there.
+        """
+        options = self.options
+        cache = intermediate_cache(options)
+        pcm_hash = audio_hash(mixed_sound_array) if cache is not None else None
+        outputs = {}
+        for name in vocal_models(options):
+            start_time = time()
+            output = None
+            if cache is not None:
+                output = cache.load(pcm_hash, name, options)
+            if output is not None:
+                print("Using cached {} vocals".format(name))
+            else:
+                output = self._run_vocal_model(name, mixed_sound_array)
+                if cache is not None:
+                    cache.save(pcm_hash, name, options, output)
+            outputs[name] = output
+            self._add_time(name, start_time)
+        return outputs
+
+    def _run_vocal_model(self, name, mixed_sound_array):
+        options = self.options
+        if name == "VitLarge":
+            print("Processing vocals with VitLarge model...")
+            audio = (
+                torch.from_numpy(mixed_sound_array.T)
+                .type("torch.FloatTensor")
+                .to(self.device)
+            )
+            vocals4, instrum4 = demix_full_vitlarge(
+                audio, self.device, self.model_vl, options
+            )
+            return match_array_shapes(vocals4, mixed_sound_array.T)
+
+        if name == "InstVoc":
+            print("Processing vocals with MDXv3 InstVocHQ model...")
+            sources3 = demix_full_mdx23c(
+                mixed_sound_array.T, self.device, self.model_mdxv3, options
+            )
+            return match_array_shapes(sources3, mixed_sound_array.T)
+
+        print("Processing vocals with UVR-MDX-VOC-FT...")
+        return demix_wrapper(
+            mixed_sound_array.T,
+            self.device,
+            self.mdx_models1,
+            self.infer_session1,
+            overlap=self.overlap_MDX,
+            bigshifts=options["BigShifts"] // 5,
+            batch_size=options.get("batch_size_VOCFT", 4),
+            signs=(1, -1),
+        )
+
     def separate_music_file(
         self,
         mixed_sound_array,
@@ -566,121 +913,32 @@ class EnsembleDemucsMDXMusicSeparationModel:
             output_sample_rates: Dictionary of sample rates separated sequence
         """
 
-        # print('Update percent func: {}'.format(update_percent_func))
+        outputs = self.vocal_outputs(mixed_sound_array)
+        print("Processing vocals: DONE!")
+        return self.finish_separation(mixed_sound_array, sample_rate, outputs)
+
+    def finish_separation(self, mixed_sound_array, sample_rate, outputs):
+        """
+        Everything after the vocal models: the vocals ensemble of outputs
+        ({model: raw vocals}), the instrumental and the Demucs stems.
+        Returns the same as separate_music_file.
+        """
         options = self.options
         separated_music_arrays = {}
         output_sample_rates = {}
-        # print(mixed_sound_array.T.shape)
-        # audio = np.expand_dims(mixed_sound_array.T, axis=0)
-        audio = (
-            torch.from_numpy(mixed_sound_array.T)
-            .type("torch.FloatTensor")
-            .to(self.device)
-        )
-        use_VOCFT = True
         overlap_demucs = self.overlap_demucs
-        overlap_MDX = self.overlap_MDX
         shifts = 0
-        overlap = overlap_demucs
-        vocals_only = True
-        """
-        # Get Demics vocal only
-        print('Processing vocals with Demucs_ft...')
-        model = self.model_vocals_only
-        shifts = 0
-        overlap = overlap_demucs
-        vocals_demucs = 0.5 * apply_model(model, audio, shifts=shifts, overlap=overlap)[0][3].cpu().numpy() \
-                  + 0.5 * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0][3].cpu().numpy()
-        
-        model_vocals = model.cpu()
-        del model_vocals
-        """
-
-        print("Processing vocals with VitLarge model...")
-        vocals4, instrum4 = demix_full_vitlarge(
-            audio, self.device, self.model_vl, self.options
-        )
-        vocals4 = match_array_shapes(vocals4, mixed_sound_array.T)
-        # print('Time: {:.0f} sec'.format(time() - start_time))
-        # sf.write("/content/drive/MyDrive/output/vocals4.wav", vocals4.T, 44100)
-        # sf.write("instrum4.wav", instrum4.T, 44100)
-
-        print("Processing vocals with MDXv3 InstVocHQ model...")
-        sources3 = demix_full_mdx23c(
-            mixed_sound_array.T, self.device, self.model_mdxv3, self.options
-        )
-        vocals3 = match_array_shapes(sources3, mixed_sound_array.T)
-        # print('Time: {:.0f} sec'.format(time() - start_time))
-        # sf.write("vocals3.wav", sources3.T, 44100)
-
-        if options["use_VOCFT"] is True:
-            print("Processing vocals with UVR-MDX-VOC-FT...")
-            overlap = overlap_MDX
-            sources1 = 0.5 * demix_wrapper(
-                mixed_sound_array.T,
-                self.device,
-                self.mdx_models1,
-                self.infer_session1,
-                overlap=overlap,
-                bigshifts=options["BigShifts"] // 5,
-            )
-            sources1 += 0.5 * -demix_wrapper(
-                -mixed_sound_array.T,
-                self.device,
-                self.mdx_models1,
-                self.infer_session1,
-                overlap=overlap,
-                bigshifts=options["BigShifts"] // 5,
-            )
-            vocals_mdxb1 = sources1
-            # sf.write("vocals_mdxb1.wav", vocals_mdxb1.T, 44100)
-
-        print("Processing vocals: DONE!")
 
         # Vocals Weighted Multiband Ensemble :
-        if options["use_VOCFT"] is False:
-            weights = np.array([options["weight_InstVoc"], options["weight_VitLarge"]])
-            # weights = np.array([1, 8, 5])
-            vocals_low = (
-                lr_filter(
-                    (weights[0] * vocals3.T + weights[1] * vocals4.T) / weights.sum(),
-                    10000,
-                    "lowpass",
-                )
-                * 1.01055
-            )
-            vocals_high = lr_filter(vocals3.T, 10000, "highpass")
-            vocals = vocals_low + vocals_high
-
-        if options["use_VOCFT"] is True:
-            weights = np.array(
-                [
-                    options["weight_VOCFT"],
-                    options["weight_InstVoc"],
-                    options["weight_VitLarge"],
-                ]
-            )
-            # weights = np.array([1, 8, 5])
-            vocals_low = (
-                lr_filter(
-                    (
-                        weights[0] * vocals_mdxb1.T
-                        + weights[1] * vocals3.T
-                        + weights[2] * vocals4.T
-                    )
-                    / weights.sum(),
-                    10000,
-                    "lowpass",
-                )
-                * 1.01055
-            )
-            vocals_high = lr_filter(vocals3.T, 10000, "highpass")
-            vocals = vocals_low + vocals_high
+        start_time = time()
+        vocals = ensemble_vocals(outputs, options)
 
         # Generate instrumental
         instrum = mixed_sound_array - vocals
+        self._add_time("ensemble", start_time)
 
         if options["vocals_only"] is False:
+            start_time = time()
             print("Starting Demucs processing...")
             audio = np.expand_dims(instrum.T, axis=0)
             audio = torch.from_numpy(audio).type("torch.FloatTensor").to(self.device)
@@ -689,17 +947,9 @@ class EnsembleDemucsMDXMusicSeparationModel:
             print("Processing with htdemucs_ft...")
             i = 0
             overlap = overlap_demucs
-            model = pretrained.get_model("htdemucs_ft")
-            model.to(self.device)
-            out = (
-                0.5
-                * apply_model(model, audio, shifts=shifts, overlap=overlap)[0]
-                .cpu()
-                .numpy()
-                + 0.5
-                * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0]
-                .cpu()
-                .numpy()
+            model = self.demucs.get("htdemucs_ft")
+            out = apply_model_polarity_pair(
+                model, audio, shifts=shifts, overlap=overlap
             )
 
             out[0] = self.weights_drums[i] * out[0]
@@ -707,23 +957,12 @@ class EnsembleDemucsMDXMusicSeparationModel:
             out[2] = self.weights_other[i] * out[2]
             out[3] = self.weights_vocals[i] * out[3]
             all_outs.append(out)
-            model = model.cpu()
-            del model
-            gc.collect()
             i = 1
             print("Processing with htdemucs...")
             overlap = overlap_demucs
-            model = pretrained.get_model("htdemucs")
-            model.to(self.device)
-            out = (
-                0.5
-                * apply_model(model, audio, shifts=shifts, overlap=overlap)[0]
-                .cpu()
-                .numpy()
-                + 0.5
-                * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0]
-                .cpu()
-                .numpy()
+            model = self.demucs.get("htdemucs")
+            out = apply_model_polarity_pair(
+                model, audio, shifts=shifts, overlap=overlap
             )
 
             out[0] = self.weights_drums[i] * out[0]
@@ -731,14 +970,10 @@ class EnsembleDemucsMDXMusicSeparationModel:
             out[2] = self.weights_other[i] * out[2]
             out[3] = self.weights_vocals[i] * out[3]
             all_outs.append(out)
-            model = model.cpu()
-            del model
-            gc.collect()
             i = 2
             print("Processing with htdemucs_6s...")
             overlap = overlap_demucs
-            model = pretrained.get_model("htdemucs_6s")
-            model.to(self.device)
+            model = self.demucs.get("htdemucs_6s")
             out = (
                 apply_model(model, audio, shifts=shifts, overlap=overlap)[0]
                 .cpu()
@@ -753,22 +988,11 @@ class EnsembleDemucsMDXMusicSeparationModel:
             out[2] = self.weights_other[i] * out[2]
             out[3] = self.weights_vocals[i] * out[3]
             all_outs.append(out)
-            model = model.cpu()
-            del model
-            gc.collect()
             i = 3
             print("Processing with htdemucs_mmi...")
-            model = pretrained.get_model("hdemucs_mmi")
-            model.to(self.device)
-            out = (
-                0.5
-                * apply_model(model, audio, shifts=shifts, overlap=overlap)[0]
-                .cpu()
-                .numpy()
-                + 0.5
-                * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0]
-                .cpu()
-                .numpy()
+            model = self.demucs.get("hdemucs_mmi")
+            out = apply_model_polarity_pair(
+                model, audio, shifts=shifts, overlap=overlap
             )
 
             out[0] = self.weights_drums[i] * out[0]
@@ -776,9 +1000,6 @@ class EnsembleDemucsMDXMusicSeparationModel:
             out[2] = self.weights_other[i] * out[2]
             out[3] = self.weights_vocals[i] * out[3]
             all_outs.append(out)
-            model = model.cpu()
-            del model
-            gc.collect()
             out = np.array(all_outs).sum(axis=0)
             out[0] = out[0] / self.weights_drums.sum()
             out[1] = out[1] / self.weights_bass.sum()
@@ -810,6 +1031,7 @@ class EnsembleDemucsMDXMusicSeparationModel:
             separated_music_arrays["other"] = mixed_sound_array - vocals - bass - drums
             separated_music_arrays["drums"] = mixed_sound_array - vocals - bass - other
             separated_music_arrays["bass"] = mixed_sound_array - vocals - drums - other
+            self._add_time("demucs", start_time)
 
         # vocals
         separated_music_arrays["vocals"] = vocals
@@ -821,7 +1043,91 @@ class EnsembleDemucsMDXMusicSeparationModel:
         return separated_music_arrays, output_sample_rates
 
 
-def predict_with_model(input_audios, output_folder, options):
+def ensemble_vocals(outputs, options):
+    """
+    Weighted multiband ensemble of the raw model vocals: the weighted mean of
+    all models below options["crossover_hz"], MDXv3 alone above it.
+    outputs - {model: (2, L) array} as returned by vocal_outputs
+    Returns (L, 2) vocals
+    """
+    cutoff = options.get("crossover_hz", 10000)
+    models = ["InstVoc", "VitLarge"]
+    if options["use_VOCFT"] is True:
+        models = ["VOCFT"] + models
+    weights = np.array([options["weight_" + name] for name in models])
+    mixed = sum(w * outputs[name].T for w, name in zip(weights, models))
+    crossover = get_crossover(cutoff)
+    return crossover.merge(mixed / weights.sum() * 1.01055, outputs["InstVoc"].T)
+
+
+def remix_vocals(mixed_sound_array, outputs, options):
+    """
+    Vocals and instrum of mixed_sound_array from raw model outputs, the
+    ensemble step of separate_music_file without any inference. Cheap enough
+    to sweep weights or crossovers over outputs from IntermediateCache.
+    """
+    vocals = ensemble_vocals(outputs, options)
+    return {"vocals": vocals, "instrum": mixed_sound_array - vocals}
+
+
+def remix_with_cache(input_audio, output_folder, options):
+    """
+    Rebuilds the vocals and instrum files of input_audio from the model
+    outputs an earlier separation left in options["intermediate_cache_dir"].
+    Returns the written paths, None when outputs are missing.
+    """
+    cache = intermediate_cache(options)
+    if cache is None:
+        print("Error. Remixing needs intermediate_cache_dir")
+        return
+    audio, sr = load_audio(input_audio, sr=44100)
+    if len(audio.shape) == 1:
+        audio = np.stack([audio, audio], axis=0)
+    mixed_sound_array = audio.T
+    outputs = cache.load_outputs(audio_hash(mixed_sound_array), options)
+    if outputs is None:
+        print("Error. No cached model outputs for {}".format(input_audio))
+        return
+    if not os.path.isdir(output_folder):
+        os.mkdir(output_folder)
+
+    paths = []
+    name = os.path.splitext(os.path.basename(input_audio))[0]
+    for stem, array in remix_vocals(mixed_sound_array, outputs, options).items():
+        path = output_folder + "/" + name + "_{}.wav".format(stem)
+        sf.write(path, array, sr, subtype=options["output_format"])
+        print("File created: {}".format(path))
+        paths.append(path)
+    return paths
+
+
+def predict_preview(input_audio, output_folder, options, model):
+    """
+    Writes {name}_vocals.wav and {name}_instrum.wav of the preview separation
+    into output_folder and returns their paths as {stem: path}
+    """
+    model.reconfigure(options)
+    audio, sr = load_audio(input_audio, sr=44100)
+    if len(audio.shape) == 1:
+        audio = np.stack([audio, audio], axis=0)
+    if not os.path.isdir(output_folder):
+        os.mkdir(output_folder)
+
+    paths = {}
+    name = os.path.splitext(os.path.basename(input_audio))[0]
+    for stem, array in model.separate_preview(audio.T).items():
+        path = output_folder + "/" + name + "_{}.wav".format(stem)
+        sf.write(path, array, sr, subtype=options["output_format"])
+        print("Preview created: {}".format(path))
+        paths[stem] = path
+    return paths
+
+
+def predict_with_model(input_audios, output_folder, options, model=None):
+    """
+    model - already constructed EnsembleDemucsMDXMusicSeparationModel to reuse,
+    a new one is built from options when it is None
+    """
     input_audios = [input_audios]
     output_format = options["output_format"]
 
@@ -834,12 +1140,17 @@ def predict_with_model(input_audios, output_folder, options):
     if not os.path.isdir(output_folder):
         os.mkdir(output_folder)
 
-    model = None
-    model = EnsembleDemucsMDXMusicSeparationModel(options)
+    if model is None:
+        model = EnsembleDemucsMDXMusicSeparationModel(options)
+    else:
+        model.reconfigure(options)
 
     for i, input_audio in enumerate(input_audios):
         print("Go for: {}".format(input_audio))
-        audio, sr = librosa.load(input_audio, mono=False, sr=44100)
+        if should_stream(input_audio, options):
+            StreamingSeparator(model, options).separate(input_audio, output_folder)
+            continue
+        audio, sr = load_audio(input_audio, sr=44100)
         if len(audio.shape) == 1:
             audio = np.stack([audio, audio], axis=0)
         print("Input audio: {} Sample rate: {}".format(audio.shape, sr))
@@ -948,6 +1259,21 @@ if __name__ == "__main__":
         required=False,
         default=0.1,
     )
+    m.add_argument(
+        "--demucs_memory_budget_mb",
+        type=float,
+        help="Memory Demucs models may keep on the device, 0 keeps all of them",
+        required=False,
+        default=0,
+    )
+    m.add_argument(
+        "--demucs_evict_to",
+        type=str,
+        choices=["cpu", "disk"],
+        help="Where least recently used Demucs models go when they exceed the budget",
+        required=False,
+        default="cpu",
+    )
     m.add_argument(
         "--overlap_VOCFT",
         type=float,
@@ -965,6 +1291,34 @@ if __name__ == "__main__":
     m.add_argument(
         "--overlap_InstVoc", type=int, help="MDXv3 overlap", required=False, default=1
     )
+    m.add_argument(
+        "--batch_size_InstVoc",
+        type=str,
+        help="MDXv3 chunks per forward pass, 'auto' picks the largest that fits into memory",
+        required=False,
+        default="auto",
+    )
+    m.add_argument(
+        "--batch_size_VitLarge",
+        type=str,
+        help="VitLarge chunks per forward pass, 'auto' picks the largest that fits into memory",
+        required=False,
+        default="auto",
+    )
+    m.add_argument(
+        "--batch_size_VOCFT",
+        type=int,
+        help="VOC-FT chunks per onnxruntime call",
+        required=False,
+        default=4,
+    )
+    m.add_argument(
+        "--memory_budget_mb",
+        type=float,
+        help="Memory budget for chunk batches. By default half of the free device memory",
+        required=False,
+        default=None,
+    )
     m.add_argument(
         "--weight_InstVoc",
         type=float,
@@ -986,6 +1340,32 @@ if __name__ == "__main__":
         required=False,
         default=5,
     )
+    m.add_argument(
+        "--preset",
+        type=str,
+        help="Named preset of presets.json, overrides the model options given here",
+        required=False,
+        default=None,
+    )
+    m.add_argument(
+        "--crossover_hz",
+        type=float,
+        help="Frequency above which only MDXv3 vocals are used",
+        required=False,
+        default=10000,
+    )
+    m.add_argument(
+        "--intermediate_cache_dir",
+        type=str,
+        help="Folder keeping the raw output of every vocal model for remixing",
+        required=False,
+        default=None,
+    )
+    m.add_argument(
+        "--remix_only",
+        action="store_true",
+        help="Only rebuild vocals and instrum from --intermediate_cache_dir with new weights",
+    )
     m.add_argument(
         "--single_onnx",
         action="store_true",
@@ -1003,6 +1383,12 @@ if __name__ == "__main__":
         required=False,
         default=7,
     )
+    m.add_argument(
+        "--fuse_BigShifts",
+        action=argparse.BooleanOptionalAction,
+        help="Run the chunks of all BigShifts passes through shared model batches (--no-fuse_BigShifts to turn off)",
+        default=True,
+    )
     m.add_argument(
         "--vocals_only",
         type=bool,
@@ -1020,8 +1406,22 @@ if __name__ == "__main__":
     m.add_argument(
         "--output_format", type=str, help="Output audio folder", default="FLOAT"
     )
+    m.add_argument(
+        "--streaming",
+        type=str,
+        help="Separate in windows with bounded memory: auto (long inputs only), true or false",
+        default="auto",
+    )
+    m.add_argument(
+        "--stream_window_seconds",
+        type=float,
+        help="Window length of the streaming mode",
+        default=120,
+    )
 
     options = m.parse_args().__dict__
+    if options["preset"] is not None:
+        options = apply_preset(options, options["preset"])
     print("Options: ")
 
     print(f'BigShifts: {options["BigShifts"]}\n')
@@ -1044,6 +1444,14 @@ if __name__ == "__main__":
 
     print(f'output_format: {options["output_format"]}\n')
     ####
-    predict_with_model(options)
+    if options["remix_only"]:
+        for input_audio in options["input_audio"]:
+            remix_with_cache(input_audio, options["output_folder"], options)
+    else:
+        model = EnsembleDemucsMDXMusicSeparationModel(options)
+        for input_audio in options["input_audio"]:
+            predict_with_model(input_audio, options["output_folder"], options, model)
+        for stage, seconds in model.timings.items():
+            print("{}: {:.1f} sec".format(stage, seconds))
     ####
     print("Time: {:.0f} sec".format(time() - start_time))
@@ -1,15 +1,24 @@
-import asyncio
 import json
 import os
+import queue
+import shutil
 import tempfile
+import threading
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
-import boto3
+import clients
 import inference
+import music_db
+import presets
+import result_cache
+from chunk_scheduler import predict_batch
 from dotenv import load_dotenv
 from pydantic import BaseModel
 from pydantic_settings import BaseSettings
-from pymongo import MongoClient
-from pymongo import ReturnDocument
+from streaming import should_stream
+from worker_runtime import WorkerRuntime
 
 load_dotenv()
 
@@ -20,124 +29,351 @@ class InferenceServerSettings(BaseSettings):
     aws_secret_access_key: str
     region_name: str
     mongodb_uri: str
+    # "local", "s3" or "none"
+    result_cache_backend: str = "local"
+    result_cache_dir: str = "/var/cache/separation"
+    result_cache_prefix: str = "separation_cache"
+    result_cache_max_gb: float = 50
+    # publish a quick MDXv3 only separation before the full ensemble runs
+    preview_enabled: bool = True
+    # messages received and separated together, 1 separates one song at a time
+    max_batch_songs: int = 4
+    # downloaded songs waiting for the model
+    prefetch_depth: int = 2
+    # separated songs waiting for their upload before the model stops
+    upload_depth: int = 4
+    upload_workers: int = 2
+    # visibility lease of a message, extended by the worker heartbeat while its song is processed
+    visibility_timeout: int = 200
+    # connection pools shared by the whole process, see clients.py
+    aws_max_pool_connections: int = 50
+    mongo_max_pool_size: int = 10
+    mongo_min_pool_size: int = 0
+    mongo_max_idle_time_ms: int = 300000
+    # S3 compatible endpoint (e.g. a local stand-in), AWS when None
+    s3_endpoint_url: Optional[str] = None
 
 
 class FetchToDB(BaseModel):
     user_id: str
     artist: str
+    # uploaded file of the song, gives its job key (music_db.job_key)
+    filename: str
     vocal_url: str = None
     instrum_url: str = None
     vc_instrum_url: str = None
+    # "Preview" while the preview stems are published, "Completed" after the full ensemble
+    status: str = "Completed"
 
 
 settings = InferenceServerSettings()
 
 
-def get_s3_client(settings: InferenceServerSettings):
-    return boto3.client(
-        "s3",
-        aws_access_key_id=settings.aws_access_key,
-        aws_secret_access_key=settings.aws_secret_access_key,
-        region_name=settings.region_name,
-    )
+def fetch_to_db(save_data: FetchToDB, settings: InferenceServerSettings):
+    if save_data.vc_instrum_url is None:
+        music_db.update_song(
+            settings,
+            save_data.user_id,
+            save_data.artist,
+            save_data.filename,
+            vocal_url=save_data.vocal_url,
+            instrum_url=save_data.instrum_url,
+            separation_status=save_data.status,
+        )
+    else:
+        music_db.update_song(
+            settings,
+            save_data.user_id,
+            save_data.artist,
+            save_data.filename,
+            vc=True,
+            vc_instrum_url=save_data.vc_instrum_url,
+            separation_status=save_data.status,
+        )
+        return print("db update completed")
+
+
+def get_result_cache(settings: InferenceServerSettings):
+    max_bytes = int(settings.result_cache_max_gb * 1024**3)
+    if settings.result_cache_backend == "local":
+        backend = result_cache.LocalDirectoryBackend(settings.result_cache_dir, max_bytes)
+    elif settings.result_cache_backend == "s3":
+        backend = result_cache.S3Backend(
+            clients.s3_client(settings), settings.bucket_name, settings.result_cache_prefix, max_bytes
+        )
+    else:
+        backend = None
+    return result_cache.ResultCache(backend)
+
+
+def s3_url(settings: InferenceServerSettings, remote_path: str):
+    return f"https://{settings.bucket_name}.s3.{settings.region_name}.amazonaws.com/{remote_path}"
+
 
+def load_options():
+    with open("options.json", "r") as file:
+        return json.load(file)
 
-def get_sqs_client(settings: InferenceServerSettings):
-    return boto3.client(
-        "sqs",
-        aws_access_key_id=settings.aws_access_key,
-        aws_secret_access_key=settings.aws_secret_access_key,
-        region_name=settings.region_name,
+
+class SeparationJob(BaseModel):
+    path: str
+    user_id: str
+    artist: str
+    vc: bool
+    preset: Optional[str] = None
+    # working directory of the job, from its download until its upload is done
+    temp_dir: Optional[str] = None
+    local_file_path: Optional[str] = None
+    cache_key: Optional[str] = None
+
+    @property
+    def name(self):
+        return os.path.basename(os.path.splitext(self.path)[0])
+
+    def remote_paths(self):
+        if self.vc:
+            return {"instrum": f"public/{self.user_id}/vc_instrument/{self.name}_VCinstrum.wav"}
+        return {
+            "vocals": f"public/{self.user_id}/vocal/{self.name}_vocals.wav",
+            "instrum": f"public/{self.user_id}/instrument/{self.name}_instrum.wav",
+        }
+
+    def local_paths(self):
+        return {stem: f"{self.temp_dir}/origin_{stem}.wav" for stem in ("vocals", "instrum")}
+
+
+def job_from_message(message_body: dict):
+    return SeparationJob(
+        path=message_body["path"],
+        user_id=message_body["user_id"],
+        artist=message_body["artist"],
+        vc=message_body["vc"],
+        # messages queued before presets existed have none
+        preset=message_body.get("preset"),
     )
 
 
-def fetch_to_db(save_data: FetchToDB, settings: InferenceServerSettings):
-    mongo = MongoClient(settings.mongodb_uri)
-    db = mongo["music_tools"]
-    collection = db["main"]
+def job_options(job: SeparationJob):
+    return presets.apply_preset(load_options(), job.preset)
 
-    if save_data.vc_instrum_url is None:
-        collection.find_one_and_update(
-            {"user_id": save_data.user_id, "artist": save_data.artist},
-            {"$set": {"vocal_url": save_data.vocal_url, "instrum_url": save_data.instrum_url}},
-            return_document=ReturnDocument.AFTER,
+
+def download_job(s3, job: SeparationJob):
+    job.temp_dir = tempfile.mkdtemp(prefix="separation_")
+    job.local_file_path = f"{job.temp_dir}/origin.wav"
+    s3.download_file(settings.bucket_name, job.path, job.local_file_path)
+    job.cache_key = result_cache.cache_key(result_cache.audio_hash_file(job.local_file_path), job_options(job))
+
+
+def remove_job_files(job: SeparationJob):
+    if job.temp_dir is not None:
+        shutil.rmtree(job.temp_dir, ignore_errors=True)
+
+
+def publish_preview(s3, job: SeparationJob, local_paths: dict):
+    """
+    Uploads the preview stems and marks the song as "Preview" in the database,
+    the full separation later points the same document at the final stems
+    """
+    remote_paths = {
+        "vocals": f"public/{job.user_id}/vocal/{job.name}_vocals_preview.wav",
+        "instrum": f"public/{job.user_id}/instrument/{job.name}_instrum_preview.wav",
+    }
+    for stem, remote_path in remote_paths.items():
+        s3.upload_file(local_paths[stem], settings.bucket_name, remote_path)
+
+    save_data = FetchToDB(
+        user_id=job.user_id,
+        artist=job.artist,
+        filename=job.path,
+        vocal_url=s3_url(settings, remote_paths["vocals"]),
+        instrum_url=s3_url(settings, remote_paths["instrum"]),
+        status="Preview",
+    )
+    fetch_to_db(save_data=save_data, settings=settings)
+    print("Preview published")
+
+
+def save_job_to_db(job: SeparationJob):
+    remote_paths = job.remote_paths()
+    if job.vc:
+        save_data = FetchToDB(
+            user_id=job.user_id,
+            vc_instrum_url=s3_url(settings, remote_paths["instrum"]),
+            artist=job.artist,
+            filename=job.path,
         )
     else:
-        collection.find_one_and_update(
-            {"user_id": save_data.user_id, "artist": save_data.artist},
-            {"$set": {"vc_instrum_url": save_data.vc_instrum_url}},
-            return_document=ReturnDocument.AFTER,
+        save_data = FetchToDB(
+            user_id=job.user_id,
+            vocal_url=s3_url(settings, remote_paths["vocals"]),
+            instrum_url=s3_url(settings, remote_paths["instrum"]),
+            artist=job.artist,
+            filename=job.path,
         )
-        return print("db update completed")
+    fetch_to_db(save_data=save_data, settings=settings)
 
 
-def separate_model(path: str, user_id: str, artist: str, vc: bool):
-    s3 = get_s3_client(settings)
-    with tempfile.TemporaryDirectory() as temp_dir:
-        local_file_path = f"{temp_dir}/origin.wav"
-        s3.download_file("s3musicproject", path, local_file_path)
+def publish_job(s3, job: SeparationJob, cache: result_cache.ResultCache):
+    """
+    Uploads the separated stems of job, points the database at them and
+    stores them in the result cache. The song is done once the database
+    points at its stems, a failed cache store only costs a later hit.
+    """
+    local_paths = job.local_paths()
+    for stem, remote_path in job.remote_paths().items():
+        s3.upload_file(local_paths[stem], settings.bucket_name, remote_path)
+    save_job_to_db(job)
+    try:
+        cache.store(job.cache_key, local_paths)
+    except Exception as e:
+        print(f"Error storing cached result {job.cache_key}: {e}")
 
-        with open("options.json", "r") as file:
-            options = json.load(file)
 
-        inference.predict_with_model(input_audios=local_file_path, output_folder=temp_dir, options=options)
-        vocal_local_path = f"{temp_dir}/origin_vocals.wav"
-        instrum_local_path = f"{temp_dir}/origin_instrum.wav"
-        vocal_remote_path = f"public/{user_id}/vocal/{os.path.basename(os.path.splitext(path)[0])}_vocals.wav"
-        instrum_remote_path = f"public/{user_id}/instrument/{os.path.basename(os.path.splitext(path)[0])}_instrum.wav"
-        vc_instrum_remote_path = (
-            f"public/{user_id}/vc_instrument/{os.path.basename(os.path.splitext(path)[0])}_VCinstrum.wav"
-        )
+class SeparationPipeline:
+    """
+    Three stages connected by bounded queues, so network time hides behind
+    the model:
+    - prefetch (WorkerRuntime threads, handle): downloads the songs and
+      publishes result cache hits right away
+    - compute (one thread): separates the downloaded songs, the ones ready
+      together share the model batches (chunk_scheduler)
+    - upload (thread pool): uploads the stems and writes the database
+    handle returns once the upload of its song is done, so the runtime
+    deletes the message only then. A song that fails in any stage raises
+    from handle and its message stays on the queue.
+    """
 
-        if vc:
-            s3.upload_file(instrum_local_path, settings.bucket_name, vc_instrum_remote_path)
-            vc_instrum_url = (
-                f"https://{settings.bucket_name}.s3.{settings.region_name}.amazonaws.com/{vc_instrum_remote_path}"
-            )
-            save_data = FetchToDB(user_id=user_id, vc_instrum_url=vc_instrum_url, artist=artist)
-            fetch_to_db(save_data=save_data, settings=settings)
-
-        else:
-            s3.upload_file(vocal_local_path, settings.bucket_name, vocal_remote_path)
-            s3.upload_file(instrum_local_path, settings.bucket_name, instrum_remote_path)
-
-            vocal_url = f"https://{settings.bucket_name}.s3.{settings.region_name}.amazonaws.com/{vocal_remote_path}"
-            instrum_url = (
-                f"https://{settings.bucket_name}.s3.{settings.region_name}.amazonaws.com/{instrum_remote_path}"
-            )
-
-            save_data = FetchToDB(user_id=user_id, vocal_url=vocal_url, instrum_url=instrum_url, artist=artist)
-            fetch_to_db(save_data=save_data, settings=settings)
-
-        print("Sepatation Completed")
-
-
-async def poll_sqs_messages():
-    sqs = get_sqs_client(settings)
-    queue_url = sqs.get_queue_url(QueueName="music.fifo")["QueueUrl"]
-    while True:
-        response = sqs.receive_message(
-            QueueUrl=queue_url,
-            MaxNumberOfMessages=1,
-            WaitTimeSeconds=5,
-            VisibilityTimeout=200,
-        )
-        messages = response.get("Messages", [])
-        print(messages)
-        for message in messages:
+    def __init__(self, model, cache: result_cache.ResultCache):
+        self.model = model
+        self.cache = cache
+        self.s3 = clients.s3_client(settings)
+        self.downloaded = queue.Queue(maxsize=settings.prefetch_depth)
+        self.upload_slots = threading.BoundedSemaphore(settings.upload_depth)
+        self.uploads = ThreadPoolExecutor(max_workers=settings.upload_workers)
+        # temp_dir of a job -> future of its preview upload / of its whole separation
+        self.previews = {}
+        self.results = {}
+
+    def concurrency(self):
+        """
+        Songs in flight when every stage is full
+        """
+        return settings.prefetch_depth + settings.max_batch_songs + settings.upload_depth
+
+    def handle(self, message_body: dict):
+        job = job_from_message(message_body)
+        try:
+            download_job(self.s3, job)
+            if self.cache.publish(job.cache_key, job.remote_paths(), self.s3, settings.bucket_name):
+                print(f"Separation cache hit: {self.cache.stats()}")
+                save_job_to_db(job)
+                remove_job_files(job)
+                return
+        except Exception:
+            remove_job_files(job)
+            raise
+        result = self.results[job.temp_dir] = Future()
+        # blocks while prefetch_depth songs are waiting for the model
+        self.downloaded.put(job)
+        result.result()
+
+    def start(self):
+        threading.Thread(target=self.compute, daemon=True).start()
+
+    def compute(self):
+        while True:
+            jobs = [self.downloaded.get()]
+            # songs downloaded in the meantime are separated together
+            while len(jobs) < settings.max_batch_songs:
+                try:
+                    jobs.append(self.downloaded.get_nowait())
+                except queue.Empty:
+                    break
+            self.separate(jobs)
+
+    def separate(self, jobs: list):
+        groups = {}
+        for job in jobs:
             try:
-                message_body = json.loads(message["Body"])
-                path = message_body["path"]
-                user_id = message_body["user_id"]
-                artist = message_body["artist"]
-                vc = message_body["vc"]
-                separate_model(path, user_id, artist, vc)
-
-                sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=message["ReceiptHandle"])
+                options = job_options(job)
+                streamed = should_stream(job.local_file_path, options)
+                # the preview separates the whole song at once, streamed songs skip it to keep memory O(window)
+                if settings.preview_enabled and not job.vc and not streamed:
+                    local_paths = inference.predict_preview(
+                        job.local_file_path, f"{job.temp_dir}/preview", options, self.model
+                    )
+                    self.previews[job.temp_dir] = self.uploads.submit(publish_preview, self.s3, job, local_paths)
+                # long songs stream through the single song path
+                if len(jobs) == 1 or streamed:
+                    inference.predict_with_model(job.local_file_path, job.temp_dir, options, self.model)
+                    self.publish(job)
+                else:
+                    groups.setdefault(options["preset"], []).append(job)
             except Exception as e:
-                print(f"Error processing message: {e}")
-        await asyncio.sleep(1)
+                self.fail(job, e)
+
+        for preset, group in groups.items():
+            pending = {job.local_file_path: job for job in group}
+
+            def on_file_done(local_file_path, local_paths):
+                self.publish(pending.pop(local_file_path))
+
+            try:
+                predict_batch(list(pending), None, job_options(group[0]), self.model, on_file_done)
+            except Exception as e:
+                for job in pending.values():
+                    self.fail(job, e)
+
+    def publish(self, job: SeparationJob):
+        # blocks the model while upload_depth songs are waiting for their upload
+        self.upload_slots.acquire()
+        self.uploads.submit(self.upload, job)
+
+    def upload(self, job: SeparationJob):
+        try:
+            # the final stems replace the preview in the database
+            self.wait_preview(job)
+            publish_job(self.s3, job, self.cache)
+            print(f"Sepatation Completed ({job.name})")
+            self.results.pop(job.temp_dir).set_result(None)
+        except Exception as e:
+            self.results.pop(job.temp_dir).set_exception(e)
+        finally:
+            remove_job_files(job)
+            self.upload_slots.release()
+
+    def wait_preview(self, job: SeparationJob):
+        preview = self.previews.pop(job.temp_dir, None)
+        if preview is None:
+            return
+        try:
+            preview.result()
+        except Exception as e:
+            print(f"Error publishing preview of {job.path}: {e}")
+
+    def fail(self, job: SeparationJob, error: Exception):
+        self.wait_preview(job)
+        remove_job_files(job)
+        self.results.pop(job.temp_dir).set_exception(error)
+
+
+def main():
+    sqs = clients.sqs_client(settings)
+    queue_url = clients.queue_url(settings, "music.fifo")
+    # models stay resident for the lifetime of the worker, each job only reconfigures them
+    model = inference.EnsembleDemucsMDXMusicSeparationModel(load_options())
+    pipeline = SeparationPipeline(model, get_result_cache(settings))
+    pipeline.start()
+    runtime = WorkerRuntime(
+        sqs,
+        queue_url,
+        pipeline.handle,
+        batch_size=settings.max_batch_songs,
+        concurrency=pipeline.concurrency(),
+        visibility_timeout=settings.visibility_timeout,
+    )
+    runtime.run()
 
 
 if __name__ == "__main__":
-    asyncio.run(poll_sqs_messages())
+    main()
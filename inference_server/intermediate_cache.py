@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# bump when a model or its preprocessing changes, old outputs are then never read
+INTERMEDIATE_VERSION = 1
+
+VOCAL_MODELS = ["InstVoc", "VitLarge", "VOCFT"]
+
+
+def vocal_models(options):
+    """
+    Vocal models the ensemble of options mixes
+    """
+    if options["use_VOCFT"] is True:
+        return VOCAL_MODELS
+    return VOCAL_MODELS[:2]
+
+
+def model_params(model: str, options: dict):
+    """
+    Options that change the raw output of model, the ensemble weights and the
+    crossover are left out so they can be changed without rerunning it
+    """
+    if model == "InstVoc":
+        return {"overlap": float(options["overlap_InstVoc"]), "BigShifts": int(options["BigShifts"])}
+    if model == "VitLarge":
+        return {"overlap": float(options["overlap_VitLarge"]), "BigShifts": int(options["BigShifts"])}
+    if model == "VOCFT":
+        return {"overlap": float(options["overlap_VOCFT"]), "BigShifts": int(options["BigShifts"]) // 5}
+    raise ValueError("Unknown vocal model: {}".format(model))
+
+
+class IntermediateCache:
+    """
+    Raw vocal outputs of the single models, stored as {root}/{key}.npy where
+    key covers the audio hash, the model and model_params. The file mtime is
+    the last access, the oldest outputs are removed beyond max_bytes.
+    """
+
+    def __init__(self, root: str, max_bytes: int = None):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, pcm_hash: str, model: str, options: dict):
+        payload = json.dumps(
+            {
+                "version": INTERMEDIATE_VERSION,
+                "audio": pcm_hash,
+                "model": model,
+                "params": model_params(model, options),
+            },
+            sort_keys=True,
+        )
+        return os.path.join(self.root, hashlib.sha256(payload.encode()).hexdigest() + ".npy")
+
+    def load(self, pcm_hash: str, model: str, options: dict):
+        """
+        Cached output of model, None on a miss
+        """
+        path = self._path(pcm_hash, model, options)
+        if not os.path.isfile(path):
+            return None
+        os.utime(path)
+        return np.load(path)
+
+    def save(self, pcm_hash: str, model: str, options: dict, output: np.ndarray):
+        path = self._path(pcm_hash, model, options)
+        # np.save appends .npy to names without it
+        tmp_path = path[: -len(".npy")] + ".tmp.npy"
+        np.save(tmp_path, np.asarray(output, dtype=np.float32))
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def load_outputs(self, pcm_hash: str, options: dict):
+        """
+        All outputs the ensemble of options needs as {model: output}, None
+        when any of them is missing
+        """
+        outputs = {}
+        for model in vocal_models(options):
+            output = self.load(pcm_hash, model, options)
+            if output is None:
+                return None
+            outputs[model] = output
+        return outputs
+
+    def evict(self):
+        if self.max_bytes is None:
+            return
+        entries = []
+        total = 0
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.endswith(".tmp.npy") or not name.endswith(".npy"):
+                continue
+            size = os.path.getsize(path)
+            entries.append((os.path.getmtime(path), size, path))
+            total += size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+
+def intermediate_cache(options: dict):
+    """
+    IntermediateCache of options["intermediate_cache_dir"], None when unset
+    """
+    root = options.get("intermediate_cache_dir")
+    if not root:
+        return None
+    max_gb = options.get("intermediate_cache_max_gb")
+    return IntermediateCache(root, int(float(max_gb) * 2**30) if max_gb else None)
@@ -0,0 +1,95 @@
+from collections import OrderedDict
+
+import torch
+
+
+def model_size(model):
+    """
+    Bytes taken by the parameters and buffers of model
+    """
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class ModelResidency:
+    """
+    Hands out models that stay loaded between songs.
+
+    Up to memory_budget bytes of models are kept on the device. When a model
+    does not fit, the least recently used resident models are evicted:
+    evict_to="cpu" moves them to CPU RAM, evict_to="disk" drops them so the
+    next use reads them again from the local checkpoint cache.
+    """
+
+    def __init__(self, loader, device, memory_budget=None, evict_to="cpu"):
+        """
+        loader - function name -> model on the CPU
+        memory_budget - bytes of models allowed on device, None for no limit
+        """
+        if evict_to not in ("cpu", "disk"):
+            raise ValueError("evict_to must be 'cpu' or 'disk', got {}".format(evict_to))
+        self.loader = loader
+        self.device = device
+        self.memory_budget = memory_budget
+        self.evict_to = evict_to
+        self._models = OrderedDict()
+        self._resident = {}
+        self.loads = 0
+        self.evictions = 0
+
+    def get(self, name):
+        """
+        Returns model name on the device, loading or moving it back if needed
+        """
+        model = self._models.get(name)
+        if model is None:
+            model = self.loader(name)
+            model.eval()
+            self._models[name] = model
+            self.loads += 1
+        self._models.move_to_end(name)
+
+        if name not in self._resident:
+            size = model_size(model)
+            self._make_room(size, keep=name)
+            model.to(self.device)
+            self._resident[name] = size
+        return model
+
+    def _make_room(self, size, keep):
+        if self.memory_budget is None:
+            return
+        for name in list(self._models):
+            if sum(self._resident.values()) + size <= self.memory_budget:
+                break
+            if name != keep and name in self._resident:
+                self.evict(name)
+
+    def evict(self, name):
+        model = self._models[name]
+        self._resident.pop(name, None)
+        if self.evict_to == "disk":
+            del self._models[name]
+        else:
+            model.to("cpu")
+        del model
+        self.evictions += 1
+        if torch.device(self.device).type == "cuda":
+            torch.cuda.empty_cache()
+
+    def configure(self, device=None, memory_budget=None, evict_to=None):
+        """
+        Applies a new device, budget or eviction target to the loaded models
+        """
+        if evict_to is not None:
+            self.evict_to = evict_to
+        self.memory_budget = memory_budget
+        if device is not None and device != self.device:
+            self.device = device
+            for name in list(self._resident):
+                self._models[name].to(device)
+        self._make_room(0, keep=None)
+
+    @property
+    def resident(self):
+        return list(self._resident)
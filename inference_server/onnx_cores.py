@@ -0,0 +1,184 @@
+import argparse
+import inspect
+import json
+import os
+import sys
+
+import onnxruntime as ort
+import torch
+import torch.nn as nn
+
+
+def core_forward(model, x):
+    """
+    TFC_TDF_net / Segm_Models_Net forward between the STFT and the iSTFT:
+    spectrogram chunk (B, 2 * channels, dim_f, T) -> estimated spectrograms
+    """
+    mix = x = model.cac2cws(x)
+    first_conv_out = x = model.first_conv(x)
+    x = x.transpose(-1, -2)
+
+    if hasattr(model, "unet_model"):
+        x = model.unet_model(x)
+    else:
+        encoder_outputs = []
+        for block in model.encoder_blocks:
+            x = block.tfc_tdf(x)
+            encoder_outputs.append(x)
+            x = block.downscale(x)
+        x = model.bottleneck_block(x)
+        for block in model.decoder_blocks:
+            x = block.upscale(x)
+            x = torch.cat([x, encoder_outputs.pop()], 1)
+            x = block.tfc_tdf(x)
+
+    x = x.transpose(-1, -2)
+    x = x * first_conv_out
+    x = model.final_conv(torch.cat([mix, x], 1))
+    x = model.cws2cac(x)
+
+    if model.num_target_instruments > 1:
+        b, c, f, t = x.shape
+        x = x.reshape(b, model.num_target_instruments, -1, f, t)
+    return x
+
+
+class SpectrogramCore(nn.Module):
+    """
+    The exported part of a model, core_forward as a module
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        return core_forward(self.model, x)
+
+
+def core_path(checkpoint_path):
+    return os.path.splitext(checkpoint_path)[0] + ".core.onnx"
+
+
+def export_core(model, path, opset=17):
+    """
+    Writes the spectrogram core of model to path as ONNX with a dynamic batch
+    axis. The STFT and iSTFT stay in PyTorch.
+    """
+    config = model.config
+    frames = 2 * config.inference.dim_t
+    spec = torch.randn(1, 2 * config.audio.num_channels, config.audio.dim_f, frames)
+    core = SpectrogramCore(model.cpu().eval())
+    # newer torch exports through dynamo by default, the TorchScript exporter handles these models
+    export_options = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(
+            core,
+            (spec,),
+            path,
+            input_names=["spec"],
+            output_names=["estimate"],
+            dynamic_axes={"spec": {0: "batch"}, "estimate": {0: "batch"}},
+            opset_version=opset,
+            **export_options,
+        )
+    print("Exported {}".format(path))
+
+
+def session_options(options):
+    """
+    onnx_threads - intra op threads, all cores by default
+    """
+    so = ort.SessionOptions()
+    so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    so.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    so.intra_op_num_threads = int(options.get("onnx_threads") or os.cpu_count() or 1)
+    so.inter_op_num_threads = 1
+    return so
+
+
+class OnnxCoreModel(nn.Module):
+    """
+    Drop-in replacement of an eager TFC_TDF_net / Segm_Models_Net: the STFT
+    and iSTFT of the eager model around an onnxruntime session of its core.
+    Keeps config and num_target_instruments, the chunk planners read them.
+    """
+
+    def __init__(self, model, path, options):
+        super().__init__()
+        self.config = model.config
+        self.num_target_instruments = model.num_target_instruments
+        self.stft = model.stft
+        self.session = ort.InferenceSession(
+            path, sess_options=session_options(options), providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def forward(self, x):
+        device = x.device
+        spec = self.stft(x.float().cpu())
+        estimate = self.session.run(None, {self.input_name: spec.contiguous().numpy()})[0]
+        return self.stft.inverse(torch.from_numpy(estimate)).to(device)
+
+
+def load_core(model, checkpoint_path, options):
+    """
+    OnnxCoreModel of the exported core of checkpoint_path when the options
+    allow it (onnx_cores, CPU only) and it was exported, else model itself
+    """
+    path = core_path(checkpoint_path)
+    if not options.get("onnx_cores", True) or not os.path.isfile(path):
+        return model
+    print("Using ONNX core {}".format(path))
+    return OnnxCoreModel(model, path, options)
+
+
+def parity(model, path, options, batch_size=2, seed=0):
+    """
+    Max absolute difference between the eager model and OnnxCoreModel on
+    random chunks, relative to the largest eager output
+    """
+    config = model.config
+    chunk = config.audio.hop_length * (2 * config.inference.dim_t - 1)
+    generator = torch.Generator().manual_seed(seed)
+    x = 0.1 * torch.randn(batch_size, config.audio.num_channels, chunk, generator=generator)
+    with torch.no_grad():
+        expected = model.cpu().eval()(x)
+        result = OnnxCoreModel(model, path, options)(x)
+    return float((expected - result).abs().max() / expected.abs().max())
+
+
+def main():
+    import inference
+
+    m = argparse.ArgumentParser(description="Exports the MDXv3 and VitLarge cores to ONNX for CPU workers")
+    m.add_argument("--options", type=str, default="options.json")
+    m.add_argument("--opset", type=int, default=17)
+    m.add_argument("--check", action="store_true", help="Only compare the exported cores with the eager models")
+    m.add_argument("--tolerance", type=float, default=1e-4, help="Largest relative difference --check accepts")
+    args = m.parse_args()
+
+    with open(args.options) as f:
+        options = json.load(f)
+    # the eager models on the CPU, without the optional ones
+    options.update({"cpu": True, "vocals_only": True, "use_VOCFT": False, "onnx_cores": False})
+    ensemble = inference.EnsembleDemucsMDXMusicSeparationModel(options)
+    models = {
+        "InstVoc": (ensemble.model_mdxv3, ensemble.model_folder + inference.MDXV3_CHECKPOINT),
+        "VitLarge": (ensemble.model_vl, ensemble.model_folder + inference.VITLARGE_CHECKPOINT),
+    }
+
+    failed = False
+    for name, (model, checkpoint_path) in models.items():
+        path = core_path(checkpoint_path)
+        if not args.check:
+            export_core(model, path, args.opset)
+        difference = parity(model, path, options)
+        ok = difference <= args.tolerance
+        failed |= not ok
+        print("{}: relative difference {:.2e} {}".format(name, difference, "ok" if ok else "FAILED"))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+import json
+import os
+
+PRESETS_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "presets.json")
+
+
+def load_presets(path: str = PRESETS_FILE):
+    """
+    {"default": name, "presets": {name: {"description", "options", "measured"}}}.
+    options override options.json, measured holds the real-time factor and
+    SDR recorded by `benchmark.py separation --record`, None until then.
+    A preset with measured None is unvalidated, its speed and quality
+    relative to the others are only expected from its options.
+    """
+    with open(path) as f:
+        return json.load(f)
+
+
+def apply_preset(options: dict, preset: str = None, presets: dict = None):
+    """
+    Copy of options with the overrides of preset, the default preset when it is None
+    """
+    if presets is None:
+        presets = load_presets()
+    if preset is None:
+        preset = presets["default"]
+    if preset not in presets["presets"]:
+        raise ValueError("Unknown preset: {}, expected one of {}".format(preset, ", ".join(presets["presets"])))
+    options = dict(options)
+    options.update(presets["presets"][preset]["options"])
+    options["preset"] = preset
+    return options
@@ -0,0 +1,284 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+import soundfile as sf
+from audio_io import load_audio
+from botocore.exceptions import ClientError
+
+# bump when model weights or the ensemble change, old entries are then never hit
+CACHE_VERSION = 2
+
+# options that change speed or memory use but not the separated audio
+RUNTIME_OPTIONS = {
+    "batch_size_InstVoc",
+    "batch_size_VitLarge",
+    "batch_size_VOCFT",
+    "memory_budget_mb",
+    "demucs_memory_budget_mb",
+    "demucs_evict_to",
+    "fuse_BigShifts",
+    "large_gpu",
+    "cpu",
+    "chunk_size",
+    "intermediate_cache_dir",
+    "intermediate_cache_max_gb",
+    "preset",
+    "onnx_cores",
+    "onnx_threads",
+}
+
+
+def audio_hash(audio: np.ndarray):
+    digest = hashlib.sha256()
+    audio = np.ascontiguousarray(audio, dtype=np.float32)
+    digest.update(str(audio.shape).encode())
+    digest.update(audio.tobytes())
+    return digest.hexdigest()
+
+
+def audio_hash_file(path: str, block_frames: int = 1 << 20):
+    """
+    Hash of the decoded PCM of path, read block by block when soundfile can decode it
+    """
+    digest = hashlib.sha256()
+    try:
+        with sf.SoundFile(path) as f:
+            digest.update("{} {}".format(f.samplerate, f.channels).encode())
+            for block in f.blocks(blocksize=block_frames, dtype="float32", always_2d=True):
+                digest.update(np.ascontiguousarray(block).tobytes())
+    except RuntimeError:
+        audio, sr = load_audio(path)
+        digest.update(str(sr).encode())
+        digest.update(audio_hash(audio).encode())
+    return digest.hexdigest()
+
+
+def normalize_options(options: dict):
+    normalized = {}
+    for k, v in options.items():
+        if k in RUNTIME_OPTIONS:
+            continue
+        if isinstance(v, (int, float)) and not isinstance(v, bool):
+            v = float(v)
+        normalized[k] = v
+    return normalized
+
+
+def cache_key(pcm_hash: str, options: dict):
+    payload = json.dumps(
+        {"version": CACHE_VERSION, "audio": pcm_hash, "options": normalize_options(options)}, sort_keys=True
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class LocalDirectoryBackend:
+    """
+    Entries are directories {root}/{key}/ with one file per stem. The
+    directory mtime is the last access, the oldest entries are removed when
+    the cache grows beyond max_bytes.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key: str, stem: str = None):
+        if stem is None:
+            return os.path.join(self.root, key)
+        return os.path.join(self.root, key, f"{stem}.wav")
+
+    def contains(self, key: str, stems):
+        return all(os.path.isfile(self._path(key, stem)) for stem in stems)
+
+    def touch(self, key: str):
+        try:
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            # evicted meanwhile
+            pass
+
+    def fetch(self, key: str, stem: str, local_path: str):
+        shutil.copyfile(self._path(key, stem), local_path)
+
+    def publish(self, key: str, stem: str, s3, bucket: str, remote_path: str):
+        s3.upload_file(self._path(key, stem), bucket, remote_path)
+
+    def store(self, key: str, stem: str, local_path: str):
+        # copy under a temporary name so readers never see a partial file,
+        # unique per thread since two workers can store the same song
+        tmp_path = "{}.{}.{}.tmp".format(self._path(key, stem), os.getpid(), threading.get_ident())
+        # evict can remove the directory of the entry at any point, the
+        # store is retried once in a new directory
+        for attempt in range(2):
+            try:
+                os.makedirs(self._path(key), exist_ok=True)
+                shutil.copyfile(local_path, tmp_path)
+                os.replace(tmp_path, self._path(key, stem))
+                return
+            except FileNotFoundError:
+                if attempt == 1:
+                    raise
+
+    def evict(self):
+        entries = []
+        total = 0
+        for key in os.listdir(self.root):
+            path = self._path(key)
+            # entries are stored and evicted by other threads and processes meanwhile
+            try:
+                size = sum(
+                    os.path.getsize(os.path.join(path, name)) for name in os.listdir(path) if not name.endswith(".tmp")
+                )
+                entries.append((os.path.getmtime(path), size, key))
+            except FileNotFoundError:
+                continue
+            total += size
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self._path(key), ignore_errors=True)
+            total -= size
+
+
+class S3Backend:
+    """
+    Entries are objects {prefix}/{key}/{stem}.wav in an S3 bucket. A small
+    {prefix}/{key}/last_access object is rewritten on every hit and its
+    LastModified orders the entries for eviction. Hits are published with a
+    server side copy, the audio never passes through the worker.
+    """
+
+    def __init__(self, s3, bucket: str, prefix: str, max_bytes: int):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix.rstrip("/")
+        self.max_bytes = max_bytes
+
+    def _key(self, key: str, stem: str):
+        return f"{self.prefix}/{key}/{stem}.wav"
+
+    def _exists(self, object_key: str):
+        try:
+            self.s3.head_object(Bucket=self.bucket, Key=object_key)
+            return True
+        except ClientError:
+            return False
+
+    def contains(self, key: str, stems):
+        return all(self._exists(self._key(key, stem)) for stem in stems)
+
+    def touch(self, key: str):
+        self.s3.put_object(Bucket=self.bucket, Key=f"{self.prefix}/{key}/last_access", Body=str(time.time()).encode())
+
+    def fetch(self, key: str, stem: str, local_path: str):
+        self.s3.download_file(self.bucket, self._key(key, stem), local_path)
+
+    def publish(self, key: str, stem: str, s3, bucket: str, remote_path: str):
+        s3.copy({"Bucket": self.bucket, "Key": self._key(key, stem)}, bucket, remote_path)
+
+    def store(self, key: str, stem: str, local_path: str):
+        self.s3.upload_file(local_path, self.bucket, self._key(key, stem))
+        self.touch(key)
+
+    def evict(self):
+        entries = {}
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + "/"):
+            for item in page.get("Contents", []):
+                key = item["Key"][len(self.prefix) + 1 :].split("/")[0]
+                entry = entries.setdefault(key, {"size": 0, "last_access": item["LastModified"], "objects": []})
+                entry["size"] += item["Size"]
+                entry["objects"].append(item["Key"])
+                if item["Key"].endswith("/last_access"):
+                    entry["last_access"] = item["LastModified"]
+        total = sum(entry["size"] for entry in entries.values())
+        for entry in sorted(entries.values(), key=lambda entry: entry["last_access"]):
+            if total <= self.max_bytes:
+                break
+            self.s3.delete_objects(
+                Bucket=self.bucket, Delete={"Objects": [{"Key": object_key} for object_key in entry["objects"]]}
+            )
+            total -= entry["size"]
+
+
+class ResultCache:
+    """
+    Separation results keyed by the decoded audio and the separation options.
+
+    The backend calls run without a lock, the worker publishes and stores
+    from several threads at once. Eviction lists the whole cache, so it
+    runs once evict_every_bytes were stored since the last one (by default
+    1/20 of the backend size) instead of on every store, by one thread at
+    a time.
+    """
+
+    def __init__(self, backend, evict_every_bytes: int = None):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        if evict_every_bytes is None and backend is not None:
+            evict_every_bytes = backend.max_bytes // 20
+        self.evict_every_bytes = evict_every_bytes
+        self.stored_bytes = 0
+        # guards the counters above
+        self.lock = threading.Lock()
+        self.evicting = threading.Lock()
+
+    def _count(self, hit: bool):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def publish(self, key: str, remote_paths: dict, s3, bucket: str):
+        """
+        Copies the cached stems to remote_paths ({stem: key in bucket}).
+        Returns False on a miss, the caller then separates the song and
+        overwrites whatever was published.
+        """
+        if self.backend is None or not self.backend.contains(key, remote_paths):
+            self._count(False)
+            return False
+        try:
+            for stem, remote_path in remote_paths.items():
+                self.backend.publish(key, stem, s3, bucket, remote_path)
+            self.backend.touch(key)
+        except Exception as e:
+            # evicted by another worker between contains and publish
+            print(f"Error publishing cached result {key}: {e}")
+            self._count(False)
+            return False
+        self._count(True)
+        return True
+
+    def store(self, key: str, local_paths: dict):
+        if self.backend is None:
+            return
+        for stem, local_path in local_paths.items():
+            self.backend.store(key, stem, local_path)
+        self.backend.touch(key)
+
+        size = sum(os.path.getsize(local_path) for local_path in local_paths.values())
+        with self.lock:
+            self.stored_bytes += size
+            due = self.stored_bytes >= self.evict_every_bytes
+        if due and self.evicting.acquire(blocking=False):
+            try:
+                with self.lock:
+                    self.stored_bytes = 0
+                self.backend.evict()
+            finally:
+                self.evicting.release()
+
+    def stats(self):
+        with self.lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {"hits": hits, "misses": misses, "hit_rate": hits / lookups if lookups else 0.0}
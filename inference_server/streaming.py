@@ -0,0 +1,137 @@
+import os
+from math import gcd
+
+import numpy as np
+import soundfile as sf
+from audio_io import resample
+
+SAMPLE_RATE = 44100
+
+
+def output_stems(instruments, options):
+    """
+    Suffixes of the files a separation writes, in order
+    """
+    stems = list(instruments) + ["instrum"]
+    if options["vocals_only"] is False:
+        stems.append("instrum2")
+    return stems
+
+
+def stem_arrays(result, instruments, options):
+    arrays = {name: result[name] for name in instruments}
+    arrays["instrum"] = result["instrum"]
+    if options["vocals_only"] is False:
+        # instrumental part 2
+        arrays["instrum2"] = result["bass"] + result["drums"] + result["other"]  # 1.004
+    return arrays
+
+
+def audio_duration(input_audio):
+    """
+    Duration in seconds, None when soundfile can't read the file
+    """
+    try:
+        info = sf.info(input_audio)
+    except RuntimeError:
+        return None
+    return info.frames / info.samplerate
+
+
+def should_stream(input_audio, options):
+    """
+    options["streaming"] forces the streaming mode on or off, by default
+    inputs longer than stream_min_seconds are streamed
+    """
+    duration = audio_duration(input_audio)
+    if duration is None:
+        return False
+    streaming = str(options.get("streaming", "auto")).lower()
+    if streaming != "auto":
+        return streaming in ("true", "1", "yes")
+    return duration > options.get("stream_min_seconds", 600)
+
+
+class StreamingSeparator:
+    """
+    Separates a file window by window so memory stays O(window), not O(song).
+
+    Each window is read with context_seconds of extra audio on both sides,
+    which is at least one chunk of the largest model, so the models see the
+    same surroundings as in a full pass. Only the window itself is written,
+    adjacent windows are blended over crossfade_seconds taken from the
+    context. Outputs are appended to the stem files with soundfile.SoundFile.
+    """
+
+    def __init__(self, model, options, window_seconds=None, context_seconds=None, crossfade_seconds=None):
+        self.model = model
+        self.options = options
+        self.window_seconds = window_seconds or options.get("stream_window_seconds", 120)
+        if context_seconds is None:
+            context_seconds = options.get("stream_context_seconds") or model.chunk_length() / SAMPLE_RATE
+        self.context_seconds = context_seconds
+        if crossfade_seconds is None:
+            crossfade_seconds = options.get("stream_crossfade_seconds", 0.5)
+        self.crossfade_seconds = min(crossfade_seconds, context_seconds)
+
+    def separate(self, input_audio, output_folder):
+        """
+        Writes {name}_{stem}.wav files into output_folder and returns their paths
+        """
+        name = os.path.splitext(os.path.basename(input_audio))[0]
+        stems = output_stems(self.model.instruments, self.options)
+        paths = {stem: os.path.join(output_folder, "{}_{}.wav".format(name, stem)) for stem in stems}
+
+        with sf.SoundFile(input_audio) as source:
+            sr = source.samplerate
+            g = gcd(sr, SAMPLE_RATE)
+            up, down = SAMPLE_RATE // g, sr // g
+            # window borders are multiples of down, so they map to whole output samples
+            window = max(1, round(self.window_seconds * sr / down)) * down
+            context = round(self.context_seconds * sr / down) * down
+            crossfade = int(self.crossfade_seconds * SAMPLE_RATE)
+            ramp = np.linspace(0.0, 1.0, crossfade, endpoint=False, dtype=np.float32)[:, None]
+            print(
+                "Streaming {}: {:.0f} sec in windows of {:.0f} sec".format(input_audio, source.frames / sr, window / sr)
+            )
+
+            writers = {
+                stem: sf.SoundFile(path, "w", samplerate=SAMPLE_RATE, channels=2, subtype=self.options["output_format"])
+                for stem, path in paths.items()
+            }
+            tails = {}
+            try:
+                for start in range(0, source.frames, window):
+                    end = min(start + window, source.frames)
+                    a = max(0, start - context)
+                    b = min(source.frames, end + context)
+                    source.seek(a)
+                    block = source.read(b - a, dtype="float32", always_2d=True)
+                    if block.shape[1] == 1:
+                        block = np.concatenate([block, block], axis=1)
+                    block = block[:, :2]
+                    block = resample(block, sr, SAMPLE_RATE)
+
+                    result, _ = self.model.separate_music_file(block, SAMPLE_RATE)
+                    arrays = stem_arrays(result, self.model.instruments, self.options)
+
+                    begin = (start - a) * up // down
+                    length = -(-(end - start) * up // down)
+                    for stem, array in arrays.items():
+                        piece = array[begin : begin + length]
+                        if stem in tails:
+                            tail = tails.pop(stem)
+                            n = min(len(tail), len(piece))
+                            piece = piece.copy()
+                            piece[:n] = piece[:n] * ramp[:n] + tail[:n] * (1.0 - ramp[:n])
+                        writers[stem].write(piece)
+                        if end < source.frames and crossfade:
+                            tails[stem] = array[begin + length : begin + length + crossfade].copy()
+                    del result, arrays, block
+            finally:
+                for writer in writers.values():
+                    writer.close()
+
+        for path in paths.values():
+            print("File created: {}".format(path))
+        return list(paths.values())
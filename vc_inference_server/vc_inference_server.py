@@ -1,16 +1,15 @@
-import asyncio
 import glob
-import json
 import os
 import tempfile
+from typing import Optional
 
-import boto3
+import clients
+import music_db
 from dotenv import load_dotenv
 from main import run_infer_script
 from pydantic import BaseModel
 from pydantic_settings import BaseSettings
-from pymongo import MongoClient
-from pymongo import ReturnDocument
+from worker_runtime import WorkerRuntime
 
 load_dotenv()
 
@@ -21,6 +20,18 @@ class InferenceServerSettings(BaseSettings):
     aws_secret_access_key: str
     region_name: str
     mongodb_uri: str
+    sqs_batch_size: int = 1
+    # conversions run at once on the GPU
+    worker_concurrency: int = 1
+    # visibility lease of a message, extended by the worker heartbeat while it is processed
+    visibility_timeout: int = 60
+    # connection pools shared by the whole process, see clients.py
+    aws_max_pool_connections: int = 20
+    mongo_max_pool_size: int = 10
+    mongo_min_pool_size: int = 0
+    mongo_max_idle_time_ms: int = 300000
+    # S3 compatible endpoint (e.g. a local stand-in), AWS when None
+    s3_endpoint_url: Optional[str] = None
 
 
 settings = InferenceServerSettings()
@@ -35,42 +46,20 @@ class rvcInferenceRequest(BaseModel):
 class FetchToDB(BaseModel):
     user_id: str
     artist: str
+    # uploaded file of the song, gives its job key (music_db.job_key)
+    filename: str
     vc_vocal_url: str
 
 
 def fetch_to_db(save_data: FetchToDB, settings: InferenceServerSettings):
-    mongo = MongoClient(settings.mongodb_uri)
-    db = mongo["music_tools"]
-    collection = db["main"]
-
-    collection.find_one_and_update(
-        {"user_id": save_data.user_id, "artist": save_data.artist},
-        {"$set": {"vc_vocal_url": save_data.vc_vocal_url}},
-        return_document=ReturnDocument.AFTER,
+    music_db.update_song(
+        settings, save_data.user_id, save_data.artist, save_data.filename, vc=True, vc_vocal_url=save_data.vc_vocal_url
     )
     return print("db update completed")
 
 
-def get_s3_client(settings: InferenceServerSettings):
-    return boto3.client(
-        "s3",
-        aws_access_key_id=settings.aws_access_key,
-        aws_secret_access_key=settings.aws_secret_access_key,
-        region_name=settings.region_name,
-    )
-
-
-def get_sqs_client(settings: InferenceServerSettings):
-    return boto3.client(
-        "sqs",
-        aws_access_key_id=settings.aws_access_key,
-        aws_secret_access_key=settings.aws_secret_access_key,
-        region_name=settings.region_name,
-    )
-
-
 def rvc_inference_model(request: rvcInferenceRequest):
-    s3 = get_s3_client(settings)
+    s3 = clients.s3_client(settings)
 
     with tempfile.TemporaryDirectory() as temp_dir:
         logs_path = os.path.join(temp_dir, f"logs/{request.user_id}")
@@ -128,37 +117,32 @@ def rvc_inference_model(request: rvcInferenceRequest):
 
         vc_vocal_url = f"https://{settings.bucket_name}.s3.{settings.region_name}.amazonaws.com/{output_remote_path}"
 
-        save_data = FetchToDB(user_id=request.user_id, vc_vocal_url=vc_vocal_url, artist=request.artist)
-        fetch_to_db(save_data=save_data, settings=settings)
-
-
-async def poll_sqs_messages():
-    sqs = get_sqs_client(settings)
-    queue_url = sqs.get_queue_url(QueueName="rvc_inference.fifo")["QueueUrl"]
-    while True:
-        response = sqs.receive_message(
-            QueueUrl=queue_url,
-            MaxNumberOfMessages=1,
-            WaitTimeSeconds=5,
-            VisibilityTimeout=60,
+        save_data = FetchToDB(
+            user_id=request.user_id, filename=request.filename, vc_vocal_url=vc_vocal_url, artist=request.artist
         )
+        fetch_to_db(save_data=save_data, settings=settings)
 
-        messages = response.get("Messages", [])
-        print(messages)
-        for message in messages:
-            try:
-                message_body = json.loads(message["Body"])
-                user_id = message_body["user_id"]
-                filename = message_body["filename"]
-                artist = message_body["artist"]
-                request_model = rvcInferenceRequest(user_id=user_id, filename=filename, artist=artist)
-                rvc_inference_model(request_model)
 
-                sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=message["ReceiptHandle"])
-            except Exception as e:
-                print(f"Error processing message: {e}")
-        await asyncio.sleep(1)
+def handle_message(message_body: dict):
+    request_model = rvcInferenceRequest(
+        user_id=message_body["user_id"], filename=message_body["filename"], artist=message_body["artist"]
+    )
+    rvc_inference_model(request_model)
+
+
+def main():
+    sqs = clients.sqs_client(settings)
+    queue_url = clients.queue_url(settings, "rvc_inference.fifo")
+    runtime = WorkerRuntime(
+        sqs,
+        queue_url,
+        handle_message,
+        batch_size=settings.sqs_batch_size,
+        concurrency=settings.worker_concurrency,
+        visibility_timeout=settings.visibility_timeout,
+    )
+    runtime.run()
 
 
 if __name__ == "__main__":
-    asyncio.run(poll_sqs_messages())
+    main()
@@ -1,11 +1,11 @@
-import asyncio
 import glob
-import json
 import os
 import tempfile
 from pathlib import Path
+from typing import Optional
 
-import boto3
+import clients
+import music_db
 import requests
 from dotenv import load_dotenv
 from main import run_extract_script
@@ -13,8 +13,7 @@ from main import run_preprocess_script
 from main import run_train_script
 from pydantic import BaseModel
 from pydantic_settings import BaseSettings
-from pymongo import MongoClient
-from pymongo import ReturnDocument
+from worker_runtime import WorkerRuntime
 
 load_dotenv()
 
@@ -25,6 +24,18 @@ class TrainingServerSettings(BaseSettings):
     aws_secret_access_key: str
     region_name: str
     mongodb_uri: str
+    sqs_batch_size: int = 1
+    # trainings run at once, each one takes the whole GPU
+    worker_concurrency: int = 1
+    # visibility lease of a message, extended by the worker heartbeat while it is processed
+    visibility_timeout: int = 300
+    # connection pools shared by the whole process, see clients.py
+    aws_max_pool_connections: int = 20
+    mongo_max_pool_size: int = 10
+    mongo_min_pool_size: int = 0
+    mongo_max_idle_time_ms: int = 300000
+    # S3 compatible endpoint (e.g. a local stand-in), AWS when None
+    s3_endpoint_url: Optional[str] = None
 
 
 settings = TrainingServerSettings()
@@ -35,39 +46,13 @@ class vcTrainRequest(BaseModel):
     artist: str
 
 
-def get_s3_client(settings: TrainingServerSettings):
-    return boto3.client(
-        "s3",
-        aws_access_key_id=settings.aws_access_key,
-        aws_secret_access_key=settings.aws_secret_access_key,
-        region_name=settings.region_name,
-    )
-
-
-def get_sqs_client(settings: TrainingServerSettings):
-    return boto3.client(
-        "sqs",
-        aws_access_key_id=settings.aws_access_key,
-        aws_secret_access_key=settings.aws_secret_access_key,
-        region_name=settings.region_name,
-    )
-
-
 def fetch_to_db(user_id: str, artist: str):
-    mongo = MongoClient(settings.mongodb_uri)
-    db = mongo["music_tools"]
-    collection = db["main"]
-
-    collection.find_one_and_update(
-        {"user_id": user_id, "artist": artist},
-        {"$set": {"trained": True}},
-        return_document=ReturnDocument.AFTER,
-    )
+    music_db.set_trained(settings, user_id, artist)
     return print("db update completed")
 
 
 def vc_train_model(request: vcTrainRequest):
-    s3 = get_s3_client(settings)
+    s3 = clients.s3_client(settings)
 
     with tempfile.TemporaryDirectory() as temp_dir:
         datasets = os.path.join(temp_dir, "dataset")
@@ -150,28 +135,24 @@ def vc_train_model(request: vcTrainRequest):
         print("DB update completed")
 
 
-def poll_sqs_messages():
-    sqs = get_sqs_client(settings)
-    queue_url = sqs.get_queue_url(QueueName="rvc_training.fifo")["QueueUrl"]
-    while True:
-        response = sqs.receive_message(
-            QueueUrl=queue_url, MaxNumberOfMessages=1, WaitTimeSeconds=5, VisibilityTimeout=1000
-        )
+def handle_message(message_body: dict):
+    request = vcTrainRequest(user_id=message_body["user_id"], artist=message_body["artist"])
+    vc_train_model(request)
 
-        messages = response.get("Messages", [])
-        print(messages)
-        for message in messages:
-            try:
-                message_body = json.loads(message["Body"])
-                user_id = message_body["user_id"]
-                artist = message_body["artist"]
-                request = vcTrainRequest(user_id=user_id, artist=artist)
-                vc_train_model(request)
 
-                sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=message["ReceiptHandle"])
-            except Exception as e:
-                print(f"Error processing message: {e}")
+def main():
+    sqs = clients.sqs_client(settings)
+    queue_url = clients.queue_url(settings, "rvc_training.fifo")
+    runtime = WorkerRuntime(
+        sqs,
+        queue_url,
+        handle_message,
+        batch_size=settings.sqs_batch_size,
+        concurrency=settings.worker_concurrency,
+        visibility_timeout=settings.visibility_timeout,
+    )
+    runtime.run()
 
 
 if __name__ == "__main__":
-    asyncio.run(poll_sqs_messages())
+    main()
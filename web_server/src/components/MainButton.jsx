@@ -43,7 +43,19 @@ export default function MainButton() {
           params: { input: inputValue, user_id: "123" },
         }
       );
-      setAudioUrl(response.data);
+      // 다운로드는 백그라운드에서 진행되므로 완료될 때까지 작업 상태 확인
+      let job = response.data;
+      while (job.status === "Processing") {
+        await new Promise((resolve) => setTimeout(resolve, 2000));
+        const jobResponse = await axios.get(
+          `http://localhost:5000/jobs/${job.job_id}`
+        );
+        job = jobResponse.data;
+      }
+      if (job.status !== "Completed") {
+        throw new Error(job.error);
+      }
+      setAudioUrl(job.url);
     } catch (error) {
       console.error("API 호출 중 에러 발생:", error);
     }
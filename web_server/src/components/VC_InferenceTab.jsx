@@ -109,8 +109,21 @@ const VC_InferenceTab = () => {
         "http://localhost:5000/combine_inferencedAudio",
         combine_data
       );
-      console.log("Combined data", response3.data);
-      setAudioUrlCombined(response3.data);
+      console.log("Combined job", response3.data);
+
+      // 믹싱은 백그라운드에서 진행되므로 완료될 때까지 작업 상태 확인
+      let job = response3.data;
+      while (job.status === "Processing") {
+        await new Promise((resolve) => setTimeout(resolve, 2000));
+        const jobResponse = await axios.get(
+          `http://localhost:5000/jobs/${job.job_id}`
+        );
+        job = jobResponse.data;
+      }
+      if (job.status !== "Completed") {
+        throw new Error(job.error);
+      }
+      setAudioUrlCombined(job.url);
     } catch (error) {
       message.error("Voice conversion failed.");
       console.error("Error:", error);